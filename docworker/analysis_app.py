@@ -3,7 +3,6 @@ import os.path
 import io
 import time
 import functools
-from threading import Thread
 import flask
 from flask import Flask
 from flask import request
@@ -19,6 +18,19 @@ from . import doc_convert
 from . import prompts
 from . import document
 from . import doc_gen
+from . import doc_gen_async
+from . import completion_cache
+from . import rate_limit
+from . import retry_policy
+from . import section_util
+from . import metrics
+from . import tokenizers
+from . import pdf_extract
+from . import extract_store
+from . import jobs
+from . import doc_cache
+from . import doc_index
+from . import doc_store
 from . import analysis_util
 from . import users
 import openai
@@ -28,7 +40,8 @@ import click
 
 def create_app(test_config=None,
                fakeai=False,
-               instance_path=None):
+               instance_path=None,
+               start_workers=True):
   BASE_DIR = os.getcwd()
   log_file_name = os.path.join(BASE_DIR, 'docworker.log.txt')
   FORMAT = '%(asctime)s:%(levelname)s:%(name)s:%(message)s'
@@ -49,6 +62,31 @@ def create_app(test_config=None,
     SMTP_FROM = os.getenv('SMTP_FROM'),        
     AUTO_CREATE_USERS = False,
     NO_USER_LOGIN = False,
+    DOCGEN_RUN_WORKERS = 4,
+    DOCGEN_MAX_COMPLETIONS = 8,
+    DOCGEN_ASYNC = False,
+    DOCGEN_PIPELINE = True,
+    DOCGEN_JOB_WORKERS = 2,
+    CONVERT_JOB_WORKERS = 2,
+    COMPLETION_CACHE_SIZE = completion_cache.DEFAULT_MAX_BYTES,
+    AI_RATE_LIMIT = True,
+    AI_REQUESTS_PER_MINUTE = None,
+    AI_TOKENS_PER_MINUTE = None,
+    AI_MAX_TRIES = 5,
+    AI_STREAM = True,
+    AI_CIRCUIT_FAILURES = 5,
+    AI_CIRCUIT_RESET_SECONDS = 30,
+    TOKEN_COUNT_CACHE_SIZE = tokenizers.COUNT_CACHE_SIZE,
+    PDF_EXTRACT_WORKERS = 2,
+    PDF_EXTRACT_TIMEOUT = pdf_extract.TIMEOUT,
+    PDF_MAX_PAGES = pdf_extract.MAX_PAGES,
+    PDF_MEMORY_LIMIT_MB = 1024,
+    EXTRACT_STORE = True,
+    DOC_JOURNAL = True,
+    DOC_STORE = doc_store.PICKLE,
+    DOC_CACHE_MB = 64,
+    DOC_COMPRESS = True,
+    METRICS_USERS = [],
   )
   if test_config is None:
     app.config.from_pyfile('config.py', silent=True)
@@ -64,6 +102,11 @@ def create_app(test_config=None,
     logging.basicConfig(level=logging.INFO)
   
   doc_gen.FAKE_AI_COMPLETION=fakeai
+  doc_gen.DEFAULT_RUN_WORKERS=app.config['DOCGEN_RUN_WORKERS']
+  doc_gen.MAX_PARALLEL_COMPLETIONS=app.config['DOCGEN_MAX_COMPLETIONS']
+  doc_gen.DEFAULT_PIPELINE=app.config['DOCGEN_PIPELINE']
+  doc_gen.AI_STREAM=app.config['AI_STREAM']
+  doc_gen_async.MAX_ASYNC_COMPLETIONS=app.config['DOCGEN_MAX_COMPLETIONS']
 
   # If so configured, setup for running behind a reverse proxy.
   if app.config.get('PROXY_CONFIG'):
@@ -79,6 +122,96 @@ def create_app(test_config=None,
 
   openai.api_key = app.config['OPENAI_API_KEY']
 
+  # Setup the cache of completion results. A size of 0 disables it.
+  doc_gen.COMPLETION_CACHE = None
+  if app.config['COMPLETION_CACHE_SIZE'] > 0:
+    doc_gen.COMPLETION_CACHE = completion_cache.CompletionCache(
+      os.path.join(app.instance_path, 'completion_cache.sqlite'),
+      app.config['COMPLETION_CACHE_SIZE'])
+    metrics.register_source('completion_cache',
+                            doc_gen.COMPLETION_CACHE.stats)
+
+  # Share one request and token budget across all runs.
+  doc_gen.RATE_LIMITER = None
+  if app.config['AI_RATE_LIMIT']:
+    doc_gen.RATE_LIMITER = rate_limit.limiter_for_model(
+      section_util.AI_MODEL,
+      app.config['AI_REQUESTS_PER_MINUTE'],
+      app.config['AI_TOKENS_PER_MINUTE'])
+    metrics.register_source('rate_limit', doc_gen.RATE_LIMITER.stats)
+
+  # Retry failed completions, and stop all runs while the service
+  # is down. A failure count of 0 disables the circuit breaker.
+  doc_gen.RETRY_POLICY = retry_policy.RetryPolicy(
+    max_try=app.config['AI_MAX_TRIES'])
+  doc_gen.CIRCUIT_BREAKER = None
+  if app.config['AI_CIRCUIT_FAILURES'] > 0:
+    doc_gen.CIRCUIT_BREAKER = retry_policy.CircuitBreaker(
+      app.config['AI_CIRCUIT_FAILURES'],
+      app.config['AI_CIRCUIT_RESET_SECONDS'])
+    metrics.register_source('circuit_breaker',
+                            doc_gen.CIRCUIT_BREAKER.stats)
+
+  # Load the tokenizer once for all requests and runs, and remember
+  # token counts of text. A size of 0 disables remembering counts.
+  tokenizers.set_cache_size(app.config['TOKEN_COUNT_CACHE_SIZE'])
+  tokenizers.warm([ section_util.AI_MODEL ])
+  metrics.register_source('tokenizer', tokenizers.stats)
+
+  # Read PDF pages in other processes so uploads do not hold the GIL.
+  pdf_extract.WORKERS = app.config['PDF_EXTRACT_WORKERS']
+  pdf_extract.TIMEOUT = app.config['PDF_EXTRACT_TIMEOUT']
+  pdf_extract.MAX_PAGES = app.config['PDF_MAX_PAGES']
+  pdf_extract.MEMORY_LIMIT_MB = app.config['PDF_MEMORY_LIMIT_MB']
+
+  # Save changes to documents to journals.
+  document.JOURNAL = app.config['DOC_JOURNAL']
+  # Compress long text in .daf files, decompressed when read.
+  document.COMPRESS = app.config['DOC_COMPRESS']
+  # Keep documents in pickle files or SQLite tables. Documents are
+  # converted when next saved in full, or with python3 -m
+  # docworker.doc_store.
+  document.STORAGE = app.config['DOC_STORE']
+
+  # Keep loaded documents for pages polled while runs are going.
+  doc_cache.CACHE = None
+  if app.config['DOC_CACHE_MB'] > 0:
+    doc_cache.CACHE = doc_cache.DocCache(
+      app.config['DOC_CACHE_MB'] * 1024 * 1024)
+    metrics.register_source('doc_cache', doc_cache.CACHE.stats)
+
+  # Share the text extracted from a file among all documents made
+  # from the same file.
+  extract_store.STORE = None
+  extract_store.FALLBACK = None
+  store_path = os.path.join(app.instance_path, 'extract_store')
+  if app.config['EXTRACT_STORE']:
+    extract_store.STORE = extract_store.ExtractStore(store_path)
+    metrics.register_source('extract_store', extract_store.STORE.stats)
+  elif os.path.exists(store_path):
+    # Documents imported while the store was on still read their
+    # text from it.
+    extract_store.FALLBACK = extract_store.ExtractStore(store_path)
+
+  # Run queued doc generation jobs in this process. Jobs left by a
+  # previous server are resumed once their leases expire.
+  if os.path.exists(app.config['DATABASE']):
+    db = jobs.connect(app.config['DATABASE'])
+    jobs.ensure_schema(db)
+    db.close()
+  if start_workers and app.config['DOCGEN_JOB_WORKERS'] > 0:
+    pool = create_worker_pool(app, app.config['DOCGEN_JOB_WORKERS'])
+    if os.path.exists(app.config['DATABASE']):
+      pool.notify()
+
+  # Convert uploaded files in their own workers, so uploads return
+  # at once and do not wait behind runs.
+  if start_workers and app.config['CONVERT_JOB_WORKERS'] > 0:
+    pool = create_worker_pool(app, app.config['CONVERT_JOB_WORKERS'],
+                              kinds=[ jobs.KIND_CONVERT ])
+    if os.path.exists(app.config['DATABASE']):
+      pool.notify()
+
   app.register_blueprint(bp)
 
   @app.errorhandler(Exception)
@@ -94,6 +227,32 @@ def create_app(test_config=None,
   return app
 
 
+def create_worker_pool(app, size, idle_exit=True, kinds=None):
+  """
+  Create the pool of workers that run queued jobs of the given kinds
+  for the app, by default docgen jobs.
+  """
+  pool = jobs.WorkerPool(app.config['DATABASE'], app.instance_path,
+                         size, idle_exit, kinds)
+  app.extensions[worker_pool_name(pool.kinds[0])] = pool
+  return pool
+
+
+def worker_pool_name(kind):
+  if kind == jobs.KIND_DOCGEN:
+    return 'docworker_jobs'
+  return 'docworker_%s_jobs' % kind
+
+
+def notify_workers(kind=jobs.KIND_DOCGEN):
+  """
+  Wake workers to run a newly queued job.
+  """
+  pool = current_app.extensions.get(worker_pool_name(kind))
+  if pool is not None:
+    pool.notify()
+
+
 def get_db():
   if 'db' not in g:
     g.db = sqlite3.connect(
@@ -176,10 +335,33 @@ def get_document(doc_name):
   file_path = get_doc_file_path(doc_name)
   if not os.path.exists(file_path):
     return None
-  doc = document.load_document(file_path)
+  if doc_cache.CACHE is not None:
+    doc = doc_cache.CACHE.get(file_path)
+  else:
+    doc = document.load_document(file_path)
+  jobs.apply_run_leases(get_db(), g.user, doc_name, doc)
   return doc
 
     
+@bp.before_app_request
+def start_encode_count():
+  g.encodes = tokenizers.EncodeCounter()
+  g.encodes_token = tokenizers.start_counting(g.encodes)
+
+
+@bp.teardown_app_request
+def stop_encode_count(exc):
+  token = g.pop('encodes_token', None)
+  if token is None:
+    return
+  tokenizers.stop_counting(token)
+  stats = g.encodes.stats()
+  if stats['encodes'] > 0 or stats['count_hits'] > 0:
+    logging.info("%s: %d encodes of %d chars, %d cached counts",
+                 request.path, stats['encodes'], stats['encoded_chars'],
+                 stats['count_hits'])
+
+
 @bp.before_app_request
 def load_logged_in_user():
   user_key = session.get('user_key')
@@ -300,6 +482,7 @@ def main():
 
     file_path = get_doc_file_path(doc_id)
     run_state = doc_gen.start_docgen(file_path, doc, prompt, run_id, op_type)
+    run_state.use_cache = not request.form.get('no_cache')
     new_run_id = run_state.run_id
     logging.info("Start doc run. doc_id = %s, run_id = %s, new_run_id = %s" %
                  (doc_id, run_id, new_run_id))
@@ -308,36 +491,57 @@ def main():
     # Check if there are clearly not  enough tokens to run the generation
     if (doc_gen.run_input_tokens(doc, run_state) >
         users.token_count(get_db(), g.user)):
-      doc.mark_cancel_run("Not enough OpenAI tokens available.")
+      doc.mark_cancel_run("Not enough OpenAI tokens available.",
+                          new_run_id)
       document.save_document(file_path, doc)
     else:
-      t = Thread(target=background_docgen,
-                 args=[current_app.config['DATABASE'], g.user,
-                       file_path, doc, run_state])
-      t.start()
+      options = { 'use_cache': run_state.use_cache,
+                  'async': current_app.config['DOCGEN_ASYNC'] }
+      jobs.enqueue(get_db(), jobs.KIND_DOCGEN, g.user, doc_id,
+                   new_run_id, options)
+      notify_workers()
         
     return redirect(url_for('analysis.main',
                             doc=doc_id, run_id=new_run_id))
 
-    
-def background_docgen(db_config, username, file_path, doc, run_state):
+
+@bp.route("/resume", methods=("POST",))
+@login_required
+def resume():
   """
-  Runs from a background thread to process the document and 
-  update the consumed token accouting.
+  Continue an interrupted run from the last checkpoint.
   """
-  # Open database
-  db = sqlite3.connect(db_config, detect_types=sqlite3.PARSE_DECLTYPES)
-  db.row_factory = sqlite3.Row
-
-  id = doc_gen.run_all_docgen(file_path, doc, run_state)
-  if id is not None:
-    family = doc.get_completion_list(run_state.run_id)
-    tokens = sum(item.token_cost for item in family)
-    users.increment_tokens(db, username, tokens)
-    logging.info("updated cost for %s of %d tokens", username, tokens)
-  
-  # Close database
-  db.close()
+  doc_id = request.form.get('doc')
+  run_id = request.form.get('run_id')
+  doc = get_document(doc_id)
+  if doc is not None and doc.can_resume_run(run_id):
+    run_record = doc.get_run_record(run_id)
+    logging.info("Resume doc run. doc_id = %s, run_id = %d" %
+                 (doc_id, run_record.run_id))
+    jobs.resume_run(get_db(), g.user, doc_id, run_record.run_id)
+    notify_workers()
+  return redirect(url_for('analysis.main', doc=doc_id, run_id=run_id))
+
+
+@bp.route("/cancel", methods=("POST",))
+@login_required
+def cancel():
+  """
+  Stop a queued or running run.
+  """
+  doc_id = request.form.get('doc')
+  run_id = request.form.get('run_id')
+  doc = get_document(doc_id)
+  if doc is not None and doc.is_running(run_id):
+    run_record = doc.get_run_record(run_id)
+    logging.info("Cancel doc run. doc_id = %s, run_id = %d" %
+                 (doc_id, run_record.run_id))
+    state = jobs.cancel_run(get_db(), g.user, doc_id, run_record.run_id)
+    if state != jobs.STATE_RUNNING:
+      # No worker has the run, stop it here.
+      doc.mark_cancel_run("Run canceled.", run_record.run_id)
+      document.save_document(get_doc_file_path(doc_id), doc)
+  return redirect(url_for('analysis.main', doc=doc_id, run_id=run_id))
 
 
 @bp.route("/doclist", methods=("GET","POST"))
@@ -346,12 +550,27 @@ def doclist():
   if request.method == "GET":
     doc_id = request.args.get('doc')
     doc = get_document(doc_id)    
+    # A job id that is not a number is ignored
+    job_id = request.args.get('job', type=int)
+    if job_id is not None:
+      # Go to the document once an upload is converted
+      job = jobs.get_job(get_db(), job_id, g.user)
+      if job is not None and job['result'] is not None:
+        return redirect(url_for('analysis.main', doc=job['result']))
+      if job is not None and job['error'] is not None:
+        flask.flash("Error loading file: %s" % job['error'])
+        return redirect(url_for('analysis.doclist'))
+      if job is not None and job['state'] == jobs.STATE_FAILED:
+        flask.flash("Error loading file: %s" % job['doc_name'])
+        return redirect(url_for('analysis.doclist'))
+
     user_dir = os.path.join(current_app.instance_path, g.user)  
-    file_list = []
-    for filename in os.listdir(user_dir):
-      if filename.endswith('.daf'):
-        file_list.append(filename[:-4]) 
-    return render_template("doclist.html", files=file_list, doc=doc)
+    sort = request.args.get('sort', 'modified')
+    file_list = document.list_documents(user_dir, sort)
+    processing = jobs.get_active_jobs(get_db(), g.user, jobs.KIND_CONVERT)
+    return render_template("doclist.html", files=file_list, doc=doc,
+                           processing=processing, job_id=job_id,
+                           sort=sort, modified=doc_index.modified)
 
   else:
     if request.form.get('upload'):
@@ -363,6 +582,14 @@ def doclist():
       filename = werkzeug.utils.secure_filename(file.filename)
       user_dir = os.path.join(current_app.instance_path, g.user)
 
+      if current_app.config['CONVERT_JOB_WORKERS'] > 0:
+        # Convert the file in the background
+        upload = jobs.save_upload(current_app.instance_path, file)
+        job_id = jobs.enqueue(get_db(), jobs.KIND_CONVERT, g.user, filename,
+                              options={ 'upload': upload })
+        notify_workers(jobs.KIND_CONVERT)
+        return redirect(url_for('analysis.doclist', job=job_id))
+
       doc_id = None
       try:    
         doc_id = document.find_or_create_doc(user_dir, filename, file)
@@ -375,6 +602,19 @@ def doclist():
       
 
 
+@bp.route("/metrics", methods=("GET",))
+@login_required
+def metrics_report():
+  """
+  Report process wide counters as text, to the users in METRICS_USERS.
+  """
+  if g.user not in current_app.config['METRICS_USERS']:
+    abort(403)
+  lines = [ "%s %s" % (name, value) for (name, value) in metrics.snapshot() ]
+  return flask.Response('\n'.join(lines) + '\n',
+                        mimetype='text/plain;charset=utf-8')
+
+
 @bp.route("/runlist", methods=("GET",))
 @login_required
 def runlist():
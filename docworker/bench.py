@@ -0,0 +1,363 @@
+"""
+Benchmarks for document processing.
+
+Run with: python3 -m docworker.bench <command> [files]
+With no files, the bundled samples are used.
+"""
+from . import doc_convert
+from . import doc_store
+from . import document
+from . import extract_docx
+from . import pdf_extract
+from . import section_util
+import argparse
+import docx
+import glob
+import io
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+import pdfplumber
+
+
+SAMPLES_DIR = os.path.join(os.path.dirname(__file__), 'samples')
+
+
+def sample_files(pattern):
+  return sorted(glob.glob(os.path.join(SAMPLES_DIR, pattern)))
+
+
+def read_text(path):
+  with open(path, 'rb') as f:
+    return doc_convert.read_file(os.path.basename(path), f)
+
+
+def time_call(fn, repeat):
+  """
+  Return the best time in seconds of repeat calls to fn, and the
+  result of the last call.
+  """
+  best = None
+  for i in range(0, repeat):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return (best, result)
+
+
+#
+# Chunking
+#
+
+def reference_chunks(text, n, tokenizer, overlap):
+  """
+  The chunker before the single pass break search, which decodes the
+  chunk at every candidate break.
+  """
+  tokens = tokenizer.encode(text)
+  i = 0
+  while i < len(tokens):
+    if i + n > len(tokens):
+      j = len(tokens)
+    else:
+      j = reference_rsearch_break(tokens, i, n, tokenizer)
+    yield tokens[i:j]
+    if overlap > 0 and j != len(tokens):
+      delta = int((j - i) * overlap)
+      j = reference_rsearch_break(tokens, j - int(3 * delta / 2), delta,
+                                  tokenizer)
+    i = j
+
+
+def reference_rsearch_break(tokens, start, n, tokenizer):
+  low = start + int(0.5 * n)
+  for break_str in [ ".\n", ".", "\n" ]:
+    j = min(start + n, len(tokens))
+    while j > low:
+      if tokenizer.decode(tokens[start:j]).endswith(break_str):
+        return j
+      j -= 1
+  return min(start + n, len(tokens))
+
+
+def bench_chunk(files, repeat):
+  """
+  Time chunking of document text with the reference and current
+  break search.
+  """
+  tokenizer = section_util.get_tokenizer()
+  chunk_size = int(section_util.AI_MODEL_SIZE * 0.75)
+  print("%-30s %8s %10s %10s %8s" %
+        ("file", "tokens", "before(s)", "after(s)", "speedup"))
+  for path in files:
+    text = doc_convert.clean_text(read_text(path))
+    tokens = len(tokenizer.encode(text))
+    (before, old) = time_call(
+      lambda: list(reference_chunks(text, chunk_size, tokenizer, 0.1)),
+      repeat)
+    (after, new) = time_call(
+      lambda: list(doc_convert.chunks(text, chunk_size, tokenizer, 0.1)),
+      repeat)
+    if old != new:
+      print("%s: chunks differ" % path)
+    print("%-30s %8d %10.3f %10.3f %7.1fx" %
+          (os.path.basename(path), tokens, before, after, before / after))
+
+
+#
+# PDF memory
+#
+
+def reference_pages(path):
+  """
+  Extract pages as before streaming, keeping the parsed objects of
+  every page until the whole document is read.
+  """
+  with pdfplumber.open(path) as pdf:
+    return [ page.extract_text_simple() for page in pdf.pages ]
+
+
+def streamed_pages(path):
+  with open(path, 'rb') as f:
+    return list(pdf_extract.iter_pages(f))
+
+
+def memory_peak(fn):
+  """
+  Return the peak bytes allocated by a call to fn, and the result.
+  """
+  tracemalloc.start()
+  try:
+    result = fn()
+    (current, peak) = tracemalloc.get_traced_memory()
+  finally:
+    tracemalloc.stop()
+  return (peak, result)
+
+
+def bench_memory(files):
+  """
+  Compare peak memory of extracting PDF text with all pages kept and
+  with pages streamed.
+  """
+  pdf_extract.WORKERS = 0
+  print("%-30s %6s %12s %12s %12s" %
+        ("file", "pages", "before(KB)", "after(KB)", "text(KB)"))
+  for path in files:
+    (before, old) = memory_peak(lambda: reference_pages(path))
+    (after, new) = memory_peak(lambda: streamed_pages(path))
+    if old != new:
+      print("%s: text differs" % path)
+    text_size = sum([ len(text) for text in new ])
+    print("%-30s %6d %12d %12d %12d" %
+          (os.path.basename(path), len(new), before / 1024, after / 1024,
+           text_size / 1024))
+
+
+#
+# DOCX extraction
+#
+
+def table_doc(rows, cols):
+  """
+  Return a DOCX file with a table of the given size.
+  """
+  doc = docx.Document()
+  doc.add_paragraph('A document with a large table.')
+  table = doc.add_table(rows=1, cols=cols)
+  for (col, cell) in enumerate(table.rows[0].cells):
+    cell.text = 'Column %d' % col
+  for row in range(0, rows):
+    for (col, cell) in enumerate(table.add_row().cells):
+      cell.text = 'Value %d %d' % (row, col)
+  f = io.BytesIO()
+  doc.save(f)
+  return f.getvalue()
+
+
+def extract_docx_text(extract_class, data):
+  docx_extract = extract_class()
+  docx_extract.load_doc(io.BytesIO(data))
+  return docx_extract.get_result().read()
+
+
+def bench_docx(files, repeat, table):
+  """
+  Time DOCX extraction with python-docx and with lxml. The samples
+  have no tables, so a document with a large table may be added.
+  """
+  docs = []
+  for path in files:
+    with open(path, 'rb') as f:
+      docs.append((os.path.basename(path), f.read()))
+  if table:
+    docs.append(('table 50x12', table_doc(50, 12)))
+
+  print("%-30s %10s %10s %8s" % ("file", "before(s)", "after(s)", "speedup"))
+  for (name, data) in docs:
+    (before, old) = time_call(
+      lambda: extract_docx_text(extract_docx.DocXExtract, data), repeat)
+    (after, new) = time_call(
+      lambda: extract_docx_text(extract_docx.FastDocXExtract, data), repeat)
+    if old != new:
+      print("%s: text differs" % name)
+    print("%-30s %10.3f %10.3f %7.1fx" % (name, before, after, before / after))
+
+
+def make_doc(path, runs):
+  """
+  Return the document in the .daf file at path with runs added, each
+  with a completion for every segment and a result.
+  """
+  doc = document.load_document(path)
+  for i in range(0, runs):
+    prompt_id = doc.prompts.get_prompt_id("prompt %d" % i)
+    run_record = doc.new_run_record(prompt_id, document.OP_TYPE_CONSOLIDATE)
+    for segment in list(run_record.doc_segments):
+      run_record.add_new_completion([ segment.id() ], segment.text()[:2000],
+                                    500, 1000)
+    completion = run_record.add_new_completion(
+      [ item.id() for item in run_record.completions ], "result", 10, 100)
+    run_record.result_id = completion.id()
+    run_record.stop_time = run_record.start_time
+  return doc
+
+
+def doc_file_size(path):
+  size = os.path.getsize(path)
+  if os.path.exists(path + '.jnl'):
+    size += os.path.getsize(path + '.jnl')
+  return size
+
+
+def bench_save(files, steps, run_counts):
+  """
+  Time the saves of a run adding a completion and a status message
+  at each step, writing the whole document and with a journal.
+  """
+  print("%-30s %5s %12s %12s %12s %12s" %
+        ("file", "runs", "before(ms)", "after(ms)", "before(KB)", "after(KB)"))
+  for path in files:
+    for runs in run_counts:
+      results = []
+      for journal in [ False, True ]:
+        document.JOURNAL = journal
+        with tempfile.TemporaryDirectory() as tmp_dir:
+          doc_file = os.path.join(tmp_dir, 'bench.daf')
+          document.save_document(doc_file, make_doc(path, runs))
+          doc = document.load_document(doc_file)
+          run_record = doc.new_run_record(1, document.OP_TYPE_CONSOLIDATE)
+          document.save_document(doc_file, doc)
+          written = 0
+          start = time.perf_counter()
+          for segment in run_record.doc_segments[:steps]:
+            size = doc_file_size(doc_file)
+            doc.set_status_message("step %d" % segment.id(),
+                                   run_record.run_id)
+            document.save_document(doc_file, doc)
+            run_record.add_new_completion([ segment.id() ],
+                                          segment.text()[:2000], 500, 1000)
+            document.save_document(doc_file, doc)
+            # Bytes written: the whole file, or what was appended
+            new_size = doc_file_size(doc_file)
+            written += new_size if not journal else new_size - size
+          elapsed = time.perf_counter() - start
+          count = min(steps, len(run_record.doc_segments))
+          results.append((elapsed * 1000 / count, written / 1024 / count))
+      print("%-30s %5d %12.2f %12.2f %12.1f %12.1f" %
+            (os.path.basename(path), runs, results[0][0], results[1][0],
+             results[0][1], results[1][1]))
+  document.JOURNAL = True
+
+
+def view_document(doc_file):
+  """
+  Load a document and read what the main page shows: the status and
+  result of each run.
+  """
+  doc = document.load_document(doc_file)
+  for run_record in doc.run_list:
+    result = run_record.get_item_by_id(run_record.result_id)
+    if result is not None:
+      result.text()
+  return doc
+
+
+def bench_load(files, repeat, run_counts):
+  """
+  Time loading a document with runs kept in a pickle and in SQLite.
+  """
+  print("%-30s %5s %12s %12s %8s" %
+        ("file", "runs", "pickle(ms)", "sqlite(ms)", "speedup"))
+  for path in files:
+    for runs in run_counts:
+      doc = make_doc(path, runs)
+      with tempfile.TemporaryDirectory() as tmp_dir:
+        doc_file = os.path.join(tmp_dir, 'bench.daf')
+        document.save_document(doc_file, doc)
+        (before, result) = time_call(lambda: view_document(doc_file), repeat)
+        document.compact_document(doc_file, doc_store.SQLITE)
+        (after, result) = time_call(lambda: view_document(doc_file), repeat)
+      print("%-30s %5d %12.2f %12.2f %7.1fx" %
+            (os.path.basename(path), runs, before * 1000, after * 1000,
+             before / after))
+
+
+def bench_format(files, repeat, run_counts):
+  """
+  Compare the size and load time of documents saved as plain pickles
+  and with compressed text.
+  """
+  print("%-30s %5s %12s %12s %12s %12s" %
+        ("file", "runs", "before(KB)", "after(KB)", "before(ms)", "after(ms)"))
+  for path in files:
+    for runs in run_counts:
+      doc = make_doc(path, runs)
+      results = []
+      for compress in [ False, True ]:
+        document.COMPRESS = compress
+        with tempfile.TemporaryDirectory() as tmp_dir:
+          doc_file = os.path.join(tmp_dir, 'bench.daf')
+          document.save_document(doc_file, doc)
+          (elapsed, result) = time_call(lambda: view_document(doc_file),
+                                        repeat)
+          results.append((os.path.getsize(doc_file) / 1024, elapsed * 1000))
+      print("%-30s %5d %12.1f %12.1f %12.2f %12.2f" %
+            (os.path.basename(path), runs, results[0][0], results[1][0],
+             results[0][1], results[1][1]))
+  document.COMPRESS = True
+
+
+def main():
+  parser = argparse.ArgumentParser(description='DocWorker benchmarks.')
+  parser.add_argument('command',
+                      choices=[ 'chunk', 'memory', 'docx', 'save', 'load',
+                               'format' ])
+  parser.add_argument('files', nargs='*')
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.WARNING)
+
+  if args.command == 'chunk':
+    bench_chunk(args.files or sample_files('*.pdf'), args.repeat)
+  elif args.command == 'memory':
+    bench_memory(args.files or sample_files('*.pdf'))
+  elif args.command == 'docx':
+    bench_docx(args.files or sample_files('*.docx'), args.repeat,
+               len(args.files) == 0)
+  elif args.command == 'save':
+    bench_save(args.files or sample_files('*.daf'), 5, [ 1, 20 ])
+  elif args.command == 'load':
+    bench_load(args.files or sample_files('*.daf'), args.repeat,
+               [ 1, 10, 100 ])
+  elif args.command == 'format':
+    bench_format(args.files or sample_files('*.daf'), args.repeat,
+                 [ 1, 10, 100 ])
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,134 @@
+"""
+Persistent cache of AI completions.
+
+Entries are keyed by a hash of the model, the prompt, the input text
+and the request parameters, and are stored in a SQLite database.
+The least recently used entries are removed to keep the cache under
+a size limit.
+"""
+import sqlite3
+import hashlib
+import threading
+import time
+import logging
+
+# Default limit for the size of cached text
+DEFAULT_MAX_BYTES = 100 * 1000 * 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS completion (
+  key TEXT PRIMARY KEY,
+  text TEXT NOT NULL,
+  prompt_tokens INTEGER,
+  completion_tokens INTEGER,
+  truncated BOOLEAN,
+  size INTEGER,
+  last_used REAL
+);
+CREATE INDEX IF NOT EXISTS completion_last_used ON completion (last_used);
+"""
+
+
+def make_key(model, prompt, text, temperature, max_tokens):
+  """
+  Return the cache key for a completion request.
+  """
+  text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+  key = '\0'.join([ model, prompt, text_hash,
+                    repr(temperature), str(max_tokens) ])
+  return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class CachedCompletion:
+  def __init__(self, text, prompt_tokens, completion_tokens, truncated):
+    self.text = text
+    self.prompt_tokens = prompt_tokens
+    self.completion_tokens = completion_tokens
+    self.truncated = truncated
+
+
+class CompletionCache:
+  """
+  Size bounded LRU cache of completions in a SQLite file.
+  """
+  def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+    self.path = path
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.executescript(SCHEMA)
+    self.total_bytes = self.db.execute(
+      "SELECT COALESCE(SUM(size), 0) FROM completion").fetchone()[0]
+
+  def get(self, key):
+    """
+    Return the CachedCompletion for the key, or None on a miss.
+    """
+    with self.lock:
+      row = self.db.execute(
+        "SELECT text, prompt_tokens, completion_tokens, truncated " +
+        "FROM completion WHERE key = ?", (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+      self.db.execute("UPDATE completion SET last_used = ? WHERE key = ?",
+                      (time.time(), key))
+      self.db.commit()
+    return CachedCompletion(row[0], row[1], row[2], bool(row[3]))
+
+  def put(self, key, text, prompt_tokens, completion_tokens, truncated):
+    """
+    Add a completion to the cache.
+    """
+    size = len(text.encode('utf-8'))
+    if size > self.max_bytes:
+      return
+    with self.lock:
+      row = self.db.execute("SELECT size FROM completion WHERE key = ?",
+                            (key,)).fetchone()
+      if row is not None:
+        self.total_bytes -= row[0]
+      self.db.execute(
+        "INSERT OR REPLACE INTO completion (key, text, prompt_tokens, " +
+        "completion_tokens, truncated, size, last_used) " +
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (key, text, prompt_tokens, completion_tokens, truncated,
+         size, time.time()))
+      self.total_bytes += size
+      self.evict()
+      self.db.commit()
+
+  def evict(self):
+    """
+    Remove least recently used entries until under the size limit.
+    Called with the lock held.
+    """
+    while self.total_bytes > self.max_bytes:
+      row = self.db.execute(
+        "SELECT key, size FROM completion ORDER BY last_used LIMIT 1"
+      ).fetchone()
+      if row is None:
+        self.total_bytes = 0
+        break
+      self.db.execute("DELETE FROM completion WHERE key = ?", (row[0],))
+      self.total_bytes -= row[1]
+      self.evictions += 1
+      logging.debug("evicted cached completion %s", row[0])
+
+  def stats(self):
+    with self.lock:
+      entries = self.db.execute(
+        "SELECT COUNT(*) FROM completion").fetchone()[0]
+      return { 'hits': self.hits,
+               'misses': self.misses,
+               'evictions': self.evictions,
+               'entries': entries,
+               'bytes': self.total_bytes }
+
+  def close(self):
+    with self.lock:
+      self.db.close()
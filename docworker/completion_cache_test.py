@@ -0,0 +1,61 @@
+from . import completion_cache
+import unittest
+import tempfile
+import os
+
+
+class CompletionCacheTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.cache_dir.name, 'cache.sqlite')
+    self.cache = completion_cache.CompletionCache(self.path, 100)
+
+  def tearDown(self):
+    self.cache.close()
+    self.cache_dir.cleanup()
+
+  def testKey(self):
+    key1 = completion_cache.make_key('model', 'prompt', 'text', 0.1, 100)
+    key2 = completion_cache.make_key('model', 'prompt', 'text', 0.1, 100)
+    key3 = completion_cache.make_key('model', 'prompt', 'text', 0.1, 200)
+    key4 = completion_cache.make_key('model', 'prompt', 'text2', 0.1, 100)
+    self.assertEqual(key1, key2)
+    self.assertNotEqual(key1, key3)
+    self.assertNotEqual(key1, key4)
+
+  def testGetPut(self):
+    self.assertIsNone(self.cache.get('key1'))
+    self.cache.put('key1', 'some text', 10, 3, False)
+    entry = self.cache.get('key1')
+    self.assertEqual(entry.text, 'some text')
+    self.assertEqual(entry.prompt_tokens, 10)
+    self.assertEqual(entry.completion_tokens, 3)
+    self.assertFalse(entry.truncated)
+    stats = self.cache.stats()
+    self.assertEqual(stats['hits'], 1)
+    self.assertEqual(stats['misses'], 1)
+    self.assertEqual(stats['entries'], 1)
+
+    # Entries persist
+    self.cache.close()
+    self.cache = completion_cache.CompletionCache(self.path, 100)
+    self.assertIsNotNone(self.cache.get('key1'))
+    self.assertEqual(self.cache.stats()['bytes'], 9)
+
+  def testEviction(self):
+    self.cache.put('key1', 'a' * 40, 1, 1, False)
+    self.cache.put('key2', 'b' * 40, 1, 1, False)
+    # Use key1 so key2 is the oldest
+    self.assertIsNotNone(self.cache.get('key1'))
+    self.cache.put('key3', 'c' * 40, 1, 1, False)
+    self.assertIsNotNone(self.cache.get('key1'))
+    self.assertIsNone(self.cache.get('key2'))
+    self.assertIsNotNone(self.cache.get('key3'))
+    stats = self.cache.stats()
+    self.assertEqual(stats['evictions'], 1)
+    self.assertLessEqual(stats['bytes'], 100)
+
+    # Too large to cache
+    self.cache.put('key4', 'd' * 200, 1, 1, False)
+    self.assertIsNone(self.cache.get('key4'))
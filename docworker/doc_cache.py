@@ -0,0 +1,142 @@
+"""
+Cache of loaded documents.
+
+Pages of a document are polled while a run is going, and a request
+may get its document more than once, so loaded documents are kept in
+a bounded LRU keyed by path. An entry is used only while the document
+file and its journal have the same inode, size and time of change as
+when it was loaded, so saves by any thread or process are seen.
+
+Each get returns a copy, so the caller may change and save it while
+doc_gen threads work on their own copies. Text records do not change
+once made and are shared by the copies.
+"""
+import collections
+import logging
+import os
+import threading
+
+from . import doc_index
+from . import document
+
+# Cache used by the web app, None to load documents on every get
+CACHE = None
+
+# Bytes of documents kept by default
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Estimated bytes of a text record apart from its text
+RECORD_BYTES = 200
+
+
+def file_key(file_name):
+  """
+  Return what changes when a document file or its journal is written.
+  """
+  stat = os.stat(file_name)
+  key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+  try:
+    journal = os.stat(file_name + doc_index.JOURNAL_EXT)
+  except FileNotFoundError:
+    return key
+  return key + (journal.st_ino, journal.st_size, journal.st_mtime_ns)
+
+
+def source_size(source):
+  if isinstance(source, document.CompressedText):
+    return len(source.data)
+  return 0
+
+
+def estimate_size(doc):
+  """
+  Return an estimate of the bytes used by a loaded document. Text not
+  yet read from SQLite is not counted, and text shared by records is
+  counted once.
+  """
+  size = (len(doc.doc_text or '') +
+          source_size(getattr(doc, '_text_source', None)))
+  # Text the segments of runs are spans of
+  for source in getattr(doc, '_sources', {}).values():
+    if source.data is not None:
+      size += len(source.data)
+  blobs = set()
+  for run_record in doc.run_list:
+    for text_record in run_record.text_records.values():
+      size += RECORD_BYTES + len(text_record._text or '')
+      if id(text_record._source) not in blobs:
+        blobs.add(id(text_record._source))
+        size += source_size(text_record._source)
+  return size
+
+
+class DocCache:
+  """
+  LRU of loaded documents limited to max_bytes.
+  """
+  def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+    self.max_bytes = max_bytes
+    self.lock = threading.Lock()
+    # path: (file_key, document, size)
+    self.entries = collections.OrderedDict()
+    self.total_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, file_name):
+    """
+    Return a copy of the document saved in file_name, loading it if
+    the cached copy is missing or out of date.
+    """
+    # Taken before loading: a change during the load is seen next time
+    key = file_key(file_name)
+    with self.lock:
+      entry = self.entries.get(file_name)
+      if entry is not None and entry[0] == key:
+        self.entries.move_to_end(file_name)
+        self.hits += 1
+        doc = entry[1]
+      else:
+        self.misses += 1
+        doc = None
+    if doc is not None:
+      return doc.copy()
+
+    doc = document.load_document(file_name)
+    self.put(file_name, key, doc)
+    return doc.copy()
+
+  def put(self, file_name, key, doc):
+    size = estimate_size(doc)
+    with self.lock:
+      self.remove_locked(file_name)
+      if size > self.max_bytes:
+        return
+      self.entries[file_name] = (key, doc, size)
+      self.total_bytes += size
+      while self.total_bytes > self.max_bytes:
+        (name, entry) = self.entries.popitem(last=False)
+        self.total_bytes -= entry[2]
+        self.evictions += 1
+        logging.debug("evicted cached document %s", name)
+
+  def remove_locked(self, file_name):
+    entry = self.entries.pop(file_name, None)
+    if entry is not None:
+      self.total_bytes -= entry[2]
+
+  def remove(self, file_name):
+    with self.lock:
+      self.remove_locked(file_name)
+
+  def stats(self):
+    with self.lock:
+      requests = self.hits + self.misses
+      return { 'hits': self.hits,
+               'misses': self.misses,
+               'hit_rate': (round(self.hits / requests, 3)
+                            if requests > 0 else 0),
+               'evictions': self.evictions,
+               'entries': len(self.entries),
+               'bytes': self.total_bytes }
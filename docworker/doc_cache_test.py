@@ -0,0 +1,88 @@
+from . import doc_cache
+from . import doc_store
+from . import document
+import unittest
+import tempfile
+import os
+
+
+class DocCacheTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.user_dir = tempfile.TemporaryDirectory()
+    self.doc_file = os.path.join(self.user_dir.name, 'doc.daf')
+    doc = document.Document()
+    doc.doc_name = 'doc'
+    doc.doc_text = 'Some text of the document.'
+    run_record = doc.new_run_record(doc.prompts.get_prompt_id("prompt"),
+                                    document.OP_TYPE_CONSOLIDATE)
+    self.run_id = run_record.run_id
+    run_record.add_new_completion([ 1 ], "completion", 5, 10)
+    document.save_document(self.doc_file, doc)
+
+  def tearDown(self):
+    document.STORAGE = doc_store.PICKLE
+    self.user_dir.cleanup()
+
+  def testGet(self):
+    cache = doc_cache.DocCache()
+    doc = cache.get(self.doc_file)
+    doc2 = cache.get(self.doc_file)
+    self.assertEqual(cache.stats()['hits'], 1)
+    self.assertEqual(cache.stats()['misses'], 1)
+    self.assertIsNot(doc, doc2)
+
+    # Changes to a copy are not seen by other copies
+    doc.set_status_message("changed", self.run_id)
+    doc.get_run_record(self.run_id).completions[0].set_final_result()
+    doc.prompts.get_prompt_id("another prompt")
+    doc3 = cache.get(self.doc_file)
+    self.assertEqual(doc3.get_status_message(self.run_id), "")
+    self.assertFalse(
+      doc3.get_run_record(self.run_id).completions[0].is_final_result())
+    self.assertEqual(len(doc3.prompts.get_prompt_set()),
+                     len(doc2.prompts.get_prompt_set()))
+
+    # A save by a copy is seen
+    document.save_document(self.doc_file, doc)
+    doc4 = cache.get(self.doc_file)
+    self.assertEqual(doc4.get_status_message(self.run_id), "changed")
+    self.assertEqual(cache.stats()['misses'], 2)
+
+    # And copies keep saving to the journal
+    doc4.add_new_completion([ 1 ], "another", 5, 10)
+    document.save_document(self.doc_file, doc4)
+    self.assertTrue(os.path.exists(self.doc_file + '.jnl'))
+    doc5 = cache.get(self.doc_file)
+    self.assertEqual(
+      [ item.text() for item in doc5.get_run_record(self.run_id).completions ],
+      [ "completion", "another" ])
+
+  def testStored(self):
+    document.STORAGE = doc_store.SQLITE
+    document.compact_document(self.doc_file)
+    cache = doc_cache.DocCache()
+    doc = cache.get(self.doc_file)
+    for i in range(0, 3):
+      doc.set_status_message("status %d" % i, self.run_id)
+      document.save_document(self.doc_file, doc)
+      self.assertEqual(
+        cache.get(self.doc_file).get_status_message(self.run_id),
+        "status %d" % i)
+
+  def testEvict(self):
+    doc_file2 = os.path.join(self.user_dir.name, 'doc2.daf')
+    document.save_document(doc_file2, document.load_document(self.doc_file))
+    size = doc_cache.estimate_size(document.load_document(self.doc_file))
+    cache = doc_cache.DocCache(int(size * 1.5))
+    cache.get(self.doc_file)
+    cache.get(doc_file2)
+    self.assertEqual(cache.stats()['entries'], 1)
+    self.assertEqual(cache.stats()['evictions'], 1)
+    self.assertEqual(cache.stats()['bytes'], size)
+    cache.get(doc_file2)
+    self.assertEqual(cache.stats()['hits'], 1)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -5,11 +5,10 @@ content divided into chunks
 
 from . import section_util
 from . import extract_docx
+from . import pdf_extract
 import io
 import mimetypes
-import tiktoken
 import logging
-import pdfplumber
 
 
 def read_file(filename: str, file: io.BytesIO) -> str:
@@ -17,6 +16,22 @@ def read_file(filename: str, file: io.BytesIO) -> str:
   Reads a Text, DOCX, or PDF.
   Uses filename to detect the file type.
 
+  Throws exception on failure.
+  """
+  return ''.join(iter_text(filename, file))
+
+
+def iter_text(filename: str, file: io.BytesIO, page_counts=None,
+              progress=None):
+  """
+  Yield the text of a Text, DOCX, or PDF file in pieces: a page of
+  a PDF, a line of other files. The pieces joined give the text.
+  Uses filename to detect the file type.
+
+  If page_counts is a list, (characters, tokens) of each page of a
+  PDF are added to it. If given, progress is called with (pages read,
+  page count) as the pages of a PDF are read.
+
   Throws exception on failure.
   """
   (type, encoding)  = mimetypes.guess_type(filename)
@@ -26,28 +41,31 @@ def read_file(filename: str, file: io.BytesIO) -> str:
 
   elif type == 'application/vnd.openxmlformats-officedocument.wordprocessingml.document':
 
-    docx_extract = extract_docx.DocXExtract()
+    docx_extract = extract_docx.FastDocXExtract()
     try:
       docx_extract.load_doc(file)
     except Exception as e:
       raise DocError("Not a valid DOCX file")
-      in_file = docx_extract.get_result()
     in_file = docx_extract.get_result()
-    text = in_file.read()
-    return text
+    for line in in_file:
+      yield line
 
   elif type == 'application/pdf':
-    pages = []
-    pdf = pdfplumber.open(file)
-    for page in pdf.pages:
-      pages.append(page.extract_text_simple())
-    text = '\n'.join(pages)
-    return text
+    try:
+      pages = pdf_extract.iter_pages(file, progress)
+      for (index, text) in enumerate(pages):
+        if page_counts is not None:
+          page_counts.append(
+            (len(text), section_util.get_tokenizer().count(text, cache=False)))
+        yield text if index == 0 else '\n' + text
+    except pdf_extract.ExtractError as err:
+      raise DocError(str(err))
 
   elif type == 'text/plain':
     infile = io.TextIOWrapper(file, encoding='utf-8')
-    text = infile.read()
-    return text
+    for line in infile:
+      yield line
+    infile.detach()
 
   else:
     raise DocError("Unsupported file format: %s" % type)    
@@ -56,43 +74,82 @@ def clean_text(text: str):
   """
   Break text into lines and perform steps to clean up.
   """
-  step1 = text.split('\n')
-  step2 = []
-  for line in step1:
-    l2 = line.strip()
-    if len(l2) > 0:
-      step2.append(l2)
-  return '\n'.join(step2)
-  
+  return '\n'.join(clean_lines([ text ]))
+
+def clean_lines(pieces):
+  """
+  Yield the lines of the text given in pieces, cleaned up as
+  clean_text does.
+  """
+  rest = ''
+  for piece in pieces:
+    start = 0
+    end = piece.find('\n')
+    while end != -1:
+      line = (rest + piece[start:end]).strip()
+      rest = ''
+      if len(line) > 0:
+        yield line
+      start = end + 1
+      end = piece.find('\n', start)
+    rest += piece[start:]
+  rest = rest.strip()
+  if len(rest) > 0:
+    yield rest
+
 def token_count(text: str):
-  tokenizer = tiktoken.encoding_for_model(section_util.AI_MODEL)  
-  return len(tokenizer.encode(text))
+  return section_util.get_tokenizer().count(text)
+
+class TokenCounter:
+  """
+  Counts the tokens of text given a piece at a time. Text is encoded
+  up to the last newline followed by text, where no token can span
+  the break, so the count is that of the whole text.
+  """
+  def __init__(self, tokenizer):
+    self.tokenizer = tokenizer
+    self.rest = ''
+    self.count = 0
+
+  def add(self, text):
+    self.rest += text
+    end = self.rest.rfind('\n', 0, len(self.rest) - 1)
+    while end != -1 and self.rest[end + 1].isspace():
+      end = self.rest.rfind('\n', 0, end)
+    if end != -1:
+      self.count += self.tokenizer.count(self.rest[:end + 1], cache=False)
+      self.rest = self.rest[end + 1:]
+
+  def total(self):
+    if len(self.rest) > 0:
+      self.count += self.tokenizer.count(self.rest, cache=False)
+      self.rest = ''
+    return self.count
 
 def chunk_text(text: str, chunk_size, overlap):
   """
   Divide text into sections no larger than chunk size along natural
   breaks. Overlap sections by overlap percent.
   """
-  result = []
   if text is None:
-    return result
-  
-  tokenizer = tiktoken.encoding_for_model(section_util.AI_MODEL)  
-  text = clean_text(text)
-  
-  for chunk  in chunks(text, 
-                       chunk_size,
-                       tokenizer,
-                       overlap):
+    return []
+  return list(chunk_lines(clean_lines([ text ]), chunk_size, overlap))
+
+def chunk_lines(lines, chunk_size, overlap):
+  """
+  Yield sections of the cleaned lines no larger than chunk size as
+  they are ready. Overlap sections by overlap percent.
+  """
+  tokenizer = section_util.get_tokenizer()
+  for chunk in stream_chunks(lines, chunk_size, tokenizer, overlap):
     entry = section_util.Chunk()
     chunk_text = tokenizer.decode(chunk).strip()
     if len(chunk_text) > 0:
       entry.append(chunk_text, len(chunk))
-      result.append(entry)
-  return result
+      yield entry
   
 def docx_to_chunks(file: io.BytesIO) -> [section_util.Chunk]:
-    docx_extract = extract_docx.DocXExtract()
+    docx_extract = extract_docx.FastDocXExtract()
     try:
       docx_extract.load_doc(file)
     except Exception as e:
@@ -102,68 +159,150 @@ def docx_to_chunks(file: io.BytesIO) -> [section_util.Chunk]:
     return section_util.chunks_from_structured_file(in_file)
 
 def chunks(text, n, tokenizer, overlap):
-  # Split a text into smaller chunks of size n,
-  # preferably ending at the end of a sentence.
+  """
+  Yield successive n-sized chunks of the tokens of text, preferably
+  ending at the end of a sentence.
+  """
+  return stream_chunks([ text ], n, tokenizer, overlap, joined=True)
+
+
+# Characters of text encoded at a time
+ENCODE_BLOCK_SIZE = 16384
+
+def encode_lines(lines, tokenizer, joined=False):
+  """
+  Yield the tokens of lines joined by newlines, a block of lines at
+  a time. Lines must be cleaned: a newline followed by text never
+  falls inside a token, so the tokens are those of the joined text.
+  Set joined if the lines are already joined text.
+  """
+  if joined:
+    for text in lines:
+      yield tokenizer.encode(text)
+    return
+  block = []
+  size = 0
+  prev = None
+  for line in lines:
+    if prev is not None:
+      block.append(prev + '\n')
+      size += len(prev) + 1
+      if size >= ENCODE_BLOCK_SIZE:
+        yield tokenizer.encode(''.join(block))
+        block = []
+        size = 0
+    prev = line
+  if prev is not None:
+    block.append(prev)
+  if len(block) > 0:
+    yield tokenizer.encode(''.join(block))
+
+
+def stream_chunks(lines, n, tokenizer, overlap, joined=False):
+  """
+  Yield successive n-sized chunks of the tokens of lines, preferably
+  ending at the end of a sentence. Only the tokens of the current
+  chunk are kept, so the text is never tokenized all at once.
+  """
+  for (start, end, chunk) in iter_spans(encode_lines(lines, tokenizer, joined),
+                                        n, tokenizer, overlap):
+    yield chunk
+
+
+def chunk_spans(tokens, n, tokenizer, overlap):
+  """
+  Return the (start, end) offsets into tokens of the chunks that
+  stream_chunks yields for the same text.
+  """
+  return [ (start, end) for (start, end, chunk)
+           in iter_spans([ tokens ], n, tokenizer, overlap) ]
+
+
+def iter_spans(blocks, n, tokenizer, overlap):
+  """
+  Yield (start, end, tokens) of successive n-sized chunks of a stream
+  of blocks of tokens.
+  """
+  blocks = iter(blocks)
+  # Window of the token stream starting at position base
+  tokens = []
+  # Bytes of each token, to find breaks without decoding the chunk
+  token_bytes = []
+  base = 0
+  more = True
 
-  tokens = tokenizer.encode(text)
-  """Yield successive n-sized chunks from text."""
   i = 0
-  while i < len(tokens):
-    # Find the nearest end of sentence within a range of 0.5 * n and n tokens
+  while True:
+    # Read a token past the end of the chunk, to know if it is the last
+    while more and base + len(tokens) <= i + n:
+      block = next(blocks, None)
+      if block is None:
+        more = False
+      else:
+        tokens.extend(block)
+        token_bytes.extend([ tokenizer.decode_single_token_bytes(token)
+                             for token in block ])
+    length = base + len(tokens)
+    if i >= length:
+      break
 
-    j = min(i + int(1.0 * n), len(tokens))
+    # Find the nearest end of sentence within a range of 0.5 * n and n tokens
     # Check for last section
-    if i + n > len(tokens):
-      j = len(tokens)
+    if i + n > length:
+      j = length
     else:
       # Reverse search for a natural break.
-      j = rsearch_break(tokens, i, n, tokenizer)
-    yield tokens[i:j]
+      j = rsearch_break(token_bytes, i - base, n) + base
+    yield (i, j, tokens[i - base:j - base])
 
     # If there is an overlap, start next chunk before end of current
-    if overlap > 0 and j != len(tokens):
+    if overlap > 0 and j != length:
       delta = int((j - i) * overlap)
       # Search for break in portion between 3/2 and 1/2 delta prior to end.
-      j = rsearch_break(tokens, j - int(3 * delta / 2), delta, tokenizer)
-    i = j 
-
-def rsearch_break(tokens, start, n, tokenizer):
-  # Look for period - CR
-  j = rsearch_break_str(tokens, start, n, ".\n", tokenizer)
-
-  # If no period / CR found, just look for a period 
-  if j == start + int(0.5 * n):
-    j = rsearch_break_str(tokens, start, n, ".", tokenizer)
-    
-  # If no end of sentence found, use a CR
-  if j == start + int(0.5 * n):
-    j = rsearch_break_str(tokens, start, n, "\n", tokenizer)
-
-  # If still no end of sentence found, use n tokens as the chunk size
-  if j == start + int(0.5 * n):      
-    j = min(start + n, len(tokens))
-
-  return j
- 
-def rsearch_break_str(tokens, start, n, break_str, tokenizer):
-  """
-  Perform a reverse search on the tokens to find the break string.
-  Starting at start + n, search backward up to 50% of the section to 
-  match the break string. If found, return the end of the section.
-  If not found, returns n / 2
-
-  """
-  j = min(start + n, len(tokens))
-  while j > start + int(0.5 * n):
-    # Decode the tokens and check for period
-    # TODO: consider optimizing this and call only once
-    chunk = tokenizer.decode(tokens[start:j])
-    if chunk.endswith(break_str):
-      logging.debug("broke chunk on %s: %d", break_str, j)
-      break
+      j = rsearch_break(token_bytes, j - base - int(3 * delta / 2),
+                        delta) + base
+    i = j
+
+    # Drop tokens well before the next chunk
+    drop = max(0, i - n - base)
+    if drop > 0:
+      del tokens[:drop]
+      del token_bytes[:drop]
+      base += drop
+
+
+# Natural breaks, most preferred first
+BREAK_STRS = [ b".\n", b".", b"\n" ]
+
+def rsearch_break(token_bytes, start, n):
+  """
+  Perform a reverse search from start + n back to 50% of the section
+  for the end of a token that ends a sentence and line, then a
+  sentence, then a line. Returns the end of the section: the position
+  of the best break found, or start + n if there is none.
+
+  Makes a single pass, looking only at the bytes of the last tokens
+  at each position.
+  """
+  end = min(start + n, len(token_bytes))
+  low = start + int(0.5 * n)
+  found = [ None ] * len(BREAK_STRS)
+  j = end
+  while j > low and found[0] is None:
+    tail = token_bytes[j - 1]
+    if len(tail) < 2 and j - 2 >= start:
+      # A break may span the last two tokens
+      tail = token_bytes[j - 2] + tail
+    for (index, break_str) in enumerate(BREAK_STRS):
+      if found[index] is None and tail.endswith(break_str):
+        found[index] = j
     j -= 1
-  return j
 
+  for j in found:
+    if j is not None:
+      logging.debug("broke chunk at %d", j)
+      return j
+  return end
 
 
 class DocError(Exception):
@@ -1,5 +1,7 @@
+from . import bench
 from . import doc_convert
 from . import section_util
+import os
 import unittest
 import tiktoken
 
@@ -32,3 +34,38 @@ class DocConvertTestCase(unittest.TestCase):
 
 
     
+
+  def testChunkBreaks(self):
+    # Single pass break search matches decoding each candidate chunk
+    tokenizer = tiktoken.encoding_for_model(section_util.AI_MODEL)
+    for (size, overlap) in [ (20, 0), (20, 0.2), (37, 0.1), (200, 0) ]:
+      expected = list(bench.reference_chunks(TEXT, size, tokenizer, overlap))
+      chunks = list(doc_convert.chunks(TEXT, size, tokenizer, overlap))
+      self.assertEqual(chunks, expected)
+
+  def testCleanLines(self):
+    # Pieces split anywhere clean up the same as the whole text
+    pieces = [ TEXT[i:i + 37] for i in range(0, len(TEXT), 37) ]
+    self.assertEqual('\n'.join(doc_convert.clean_lines(pieces)),
+                     doc_convert.clean_text(TEXT))
+
+  def testChunkLines(self):
+    # Chunks of lines encoded a block at a time match the whole text
+    path = os.path.join(os.path.dirname(__file__), 'samples',
+                        'groff-dejoy.pdf')
+    with open(path, 'rb') as f:
+      text = doc_convert.read_file(path, f)
+    tokenizer = section_util.get_tokenizer()
+    expected = [ tokenizer.decode(chunk).strip() for chunk in
+                 bench.reference_chunks(doc_convert.clean_text(text),
+                                        200, tokenizer, 0.1) ]
+    chunks = doc_convert.chunk_text(text, 200, 0.1)
+    self.assertEqual([ chunk.get_text() for chunk in chunks ], expected)
+
+  def testTokenCounter(self):
+    tokenizer = section_util.get_tokenizer()
+    counter = doc_convert.TokenCounter(tokenizer)
+    text = TEXT + "\n  indented.\n\n\nend.\n"
+    for i in range(0, len(text), 23):
+      counter.add(text[i:i + 23])
+    self.assertEqual(counter.total(), len(tokenizer.encode(text)))
@@ -8,11 +8,17 @@ LLM. This utility supports:
 """
 from . import section_util
 from . import document
+from . import completion_cache
+from . import retry_policy
+from . import metrics
+from . import tokenizers
 import logging
 import datetime
-import math
 import time
-import tiktoken
+import threading
+import concurrent.futures
+import contextvars
+import functools
 import openai
 
 
@@ -24,6 +30,40 @@ FAKE_AI_SLEEP=5
 # Global value for base timeout in seconds
 AI_BASE_TIMEOUT=60
 
+# Global value to override the OpenAI API endpoint, None for default
+AI_API_BASE=None
+
+# Temperature used for completions
+AI_TEMPERATURE=0.1
+
+# Request completions as a stream of partial results
+AI_STREAM=True
+
+# Seconds between updates of the partial text of a streaming completion
+PARTIAL_UPDATE_SECONDS=1
+
+
+# Global CompletionCache for completion results, None to disable
+COMPLETION_CACHE=None
+
+# Global rate_limit.RateLimiter shared by all runs, None to disable
+RATE_LIMITER=None
+
+# Global retry_policy.RetryPolicy for failed completions
+RETRY_POLICY=retry_policy.RetryPolicy()
+
+# Global retry_policy.CircuitBreaker shared by all runs, None to disable
+CIRCUIT_BREAKER=None
+
+# Global limit on completions in flight across all runs
+MAX_PARALLEL_COMPLETIONS=8
+
+# Default limit on completions in flight for a single run
+DEFAULT_RUN_WORKERS=1
+
+# Default for starting consolidation before a round is complete
+DEFAULT_PIPELINE=False
+
 
 class ResponseRecord:
   def __init__(self,
@@ -31,104 +71,353 @@ class ResponseRecord:
                prompt_tokens,
                completion_tokens,
                truncated,
-               timeout_value):
+               timeout_value,
+               cached=False):
     self.text = text
     self.prompt_tokens = prompt_tokens
     self.completion_tokens = completion_tokens
     self.truncated = truncated
     self.timeout_value = timeout_value
+    # True if the result came from the completion cache
+    self.cached = cached
+    # Number of failed tries and seconds spent waiting to retry
+    self.retries = 0
+    self.retry_wait = 0
+    # True if the run was canceled before the completion finished
+    self.canceled = False
     
+
+@functools.lru_cache(maxsize=None)
+def chat_overhead_tokens():
+  """
+  Return the tokens the chat format adds to a request with a system
+  and a user message: a fixed number per message, the role names, and
+  the start of the reply.
+  """
+  tokenizer = section_util.get_tokenizer()
+  per_message = 3
+  reply_tokens = 3
+  return (2 * per_message + len(tokenizer.encode("system")) +
+          len(tokenizer.encode("user")) + reply_tokens)
+
+
+@functools.lru_cache(maxsize=64)
+def prompt_token_count(prompt):
+  """
+  Return the tokens in a system prompt, computed once per prompt.
+  """
+  return section_util.get_tokenizer().count(prompt)
+
+
+# Quotes wrapped around the text of a request
+TEXT_PREFIX = "\"\""
+TEXT_SUFFIX = "\"\"\""
+
+@functools.lru_cache(maxsize=None)
+def text_quote_tokens():
+  tokenizer = section_util.get_tokenizer()
+  return len(tokenizer.encode(TEXT_PREFIX)) + len(tokenizer.encode(TEXT_SUFFIX))
+
                
-def run_completion(prompt, text, max_tokens, timeout_value, status_cb=None):
+class CompletionCall:
+  """
+  State of a single AI completion request, including retries.
+  Shared by the threaded and asyncio versions of run_completion.
+  """
+  def __init__(self, prompt, text, max_tokens, timeout_value,
+               text_tokens=None):
+    self.prompt = build_prompt(prompt)
+    self.text = TEXT_PREFIX + text + TEXT_SUFFIX
+
+    self.done = False
+    self.policy = RETRY_POLICY
+    self.count = 0
+    self.timeouts = 0
+    self.request_timeout = 0
+    self.prev_wait = 0
+    self.retry_wait = 0
+    self.response_record = None
+    self.start_time = None
+    self.prompt_tokens = prompt_token_count(self.prompt)
+    # Use the count of the text when known by the caller
+    if text_tokens is None:
+      text_tokens = section_util.get_tokenizer().count(text)
+    self.text_tokens = text_tokens + text_quote_tokens()
+    self.overhead_tokens = chat_overhead_tokens()
+
+    # Enusre the total request is less than the max
+    limit_tokens =  (section_util.AI_MODEL_SIZE - self.input_tokens())
+    if max_tokens == -1 or max_tokens > limit_tokens:
+      max_tokens = limit_tokens
+    self.max_tokens = max_tokens
+    self.cache_key = completion_cache.make_key(section_util.AI_MODEL,
+                                               self.prompt, self.text,
+                                               AI_TEMPERATURE,
+                                               self.max_tokens)
+
+    self.base_timeout = timeout_value
+    if self.base_timeout == 0:
+      self.base_timeout = AI_BASE_TIMEOUT    
+
+    logging.info("prompt tokens: %d, text tokens: %d, max_tokens: %d, timeout: %d" %
+                 (self.prompt_tokens, self.text_tokens,
+                  self.max_tokens, self.base_timeout))
+    logging.info("Running completion: %s", self.prompt)  
+
+  def fake_response(self):
+    self.done = True
+    self.response_record = ResponseRecord(
+      "Dummy completion, this is filler text.\n" * 20,
+      prompt_tokens = 150,
+      completion_tokens = 50,
+      truncated=False,
+      timeout_value = 0)
+    return self.response_record
+
+  def check_cache(self):
+    """
+    Return a response from the completion cache, None on a miss.
+    """
+    if COMPLETION_CACHE is None:
+      return None
+    entry = COMPLETION_CACHE.get(self.cache_key)
+    if entry is None:
+      return None
+    logging.info("completion cache hit")
+    self.done = True
+    self.response_record = ResponseRecord(entry.text,
+                                          entry.prompt_tokens,
+                                          entry.completion_tokens,
+                                          entry.truncated,
+                                          0, cached=True)
+    return self.response_record
+
+  def update_cache(self):
+    """
+    Save a successful response in the completion cache.
+    """
+    record = self.response_record
+    if (COMPLETION_CACHE is not None and record is not None and
+        not record.cached and not record.canceled and record.text):
+      COMPLETION_CACHE.put(self.cache_key, record.text,
+                           record.prompt_tokens, record.completion_tokens,
+                           record.truncated)
+
+  def input_tokens(self):
+    """
+    Tokens in the request: the prompt, text and chat format.
+    """
+    return self.prompt_tokens + self.text_tokens + self.overhead_tokens
+
+  def request_tokens(self):
+    """
+    Tokens to reserve with the rate limiter for a request: the
+    prompt and input plus the most that may be generated.
+    """
+    return self.input_tokens() + max(0, self.max_tokens)
+
+  def wait_for_budget(self):
+    """
+    Wait for the rate limiter to allow the next request.
+    """
+    if RATE_LIMITER is not None:
+      RATE_LIMITER.acquire(self.request_tokens())
+
+  def release_budget(self, used):
+    if RATE_LIMITER is not None:
+      RATE_LIMITER.adjust(self.request_tokens(), used)
+
+  def wait_for_service(self):
+    """
+    Wait while the circuit breaker is open.
+    """
+    if CIRCUIT_BREAKER is not None:
+      self.retry_wait += CIRCUIT_BREAKER.wait()
+
+  def create_args(self):
+    """
+    Return the arguments for the next ChatCompletion call.
+    """
+    self.start_time = datetime.datetime.now()
+    self.request_timeout = self.policy.request_timeout(self.base_timeout,
+                                                       self.timeouts)
+    args = { 'model': section_util.AI_MODEL,
+             'max_tokens': self.max_tokens,
+             'temperature': AI_TEMPERATURE,
+             'messages': [ {"role": "system", "content": self.prompt},
+                           {"role": "user", "content": self.text }],
+             'request_timeout': self.request_timeout }
+    if AI_API_BASE is not None:
+      args['api_base'] = AI_API_BASE
+    if AI_STREAM:
+      args['stream'] = True
+    return args
+
+  def log_time(self):
+    end_time = datetime.datetime.now()
+    logging.info("completion required %d seconds" %
+                 (end_time - self.start_time).total_seconds())
+
+  def note_response(self, response):
+    self.log_time()
+    truncated = response['choices'][0]['finish_reason'] == "length"
+    self.response_record = ResponseRecord(
+      response['choices'][0]['message']['content'],
+      response['usage']['prompt_tokens'],
+      response['usage']['completion_tokens'],
+      truncated,
+      self.request_timeout)
+    self.release_budget(self.response_record.prompt_tokens +
+                        self.response_record.completion_tokens)
+    if CIRCUIT_BREAKER is not None:
+      CIRCUIT_BREAKER.record_success()
+    self.finish()
+
+  def start_stream(self):
+    self.stream_text = []
+    self.finish_reason = None
+    self.last_partial = time.monotonic()
+
+  def note_chunk(self, chunk, partial_cb):
+    """
+    Add a chunk of a streaming response. The partial text is passed
+    to partial_cb at most every PARTIAL_UPDATE_SECONDS.
+    """
+    if len(chunk['choices']) == 0:
+      return
+    choice = chunk['choices'][0]
+    content = choice['delta'].get('content')
+    if content:
+      self.stream_text.append(content)
+    if choice.get('finish_reason'):
+      self.finish_reason = choice['finish_reason']
+    now = time.monotonic()
+    if (partial_cb is not None and content and
+        now - self.last_partial >= PARTIAL_UPDATE_SECONDS):
+      self.last_partial = now
+      partial_cb(''.join(self.stream_text))
+
+  def note_stream_end(self, canceled=False):
+    """
+    Record the result of a streaming response. Streams do not report
+    usage so tokens are counted here.
+    """
+    self.log_time()
+    text = ''.join(self.stream_text)
+    self.response_record = ResponseRecord(
+      text,
+      self.input_tokens(),
+      section_util.get_tokenizer().count(text, cache=False),
+      self.finish_reason == "length",
+      self.request_timeout)
+    self.response_record.canceled = canceled
+    self.release_budget(self.response_record.prompt_tokens +
+                        self.response_record.completion_tokens)
+    if CIRCUIT_BREAKER is not None:
+      CIRCUIT_BREAKER.record_success()
+    self.finish()
+
+  def read_stream(self, response, partial_cb, cancel):
+    """
+    Read a streaming response, stopping early if cancel is set.
+    """
+    self.start_stream()
+    for chunk in response:
+      self.note_chunk(chunk, partial_cb)
+      if cancel is not None and cancel.is_set():
+        response.close()
+        self.note_stream_end(canceled=True)
+        return
+    self.note_stream_end()
+
+  def note_cancel(self):
+    """
+    Stop the call before a result was received.
+    """
+    self.response_record = ResponseRecord("", 0, 0, False,
+                                          self.request_timeout)
+    self.response_record.canceled = True
+    self.finish()
+
+  def finish(self):
+    """
+    Complete the call and note the retry counts in the response.
+    """
+    self.done = True
+    self.response_record.retries = self.count
+    self.response_record.retry_wait = self.retry_wait
+    metrics.incr('completion_retries', self.count)
+
+  def note_error(self, err, status_cb):
+    """
+    Record a failed call. Returns the number of seconds to wait
+    before trying again, or None when done.
+    """
+    self.log_time()
+    self.release_budget(0)
+    kind = self.policy.classify(err)
+    logging.error("%s error: %s", kind, str(err))
+    metrics.incr('completion_errors.%s' % kind)
+    if status_cb is not None:
+      status_cb(str(err))
+    if CIRCUIT_BREAKER is not None:
+      CIRCUIT_BREAKER.record_failure(kind)
+
+    self.count += 1
+    if kind == retry_policy.ERROR_TIMEOUT:
+      self.timeouts += 1
+    if not self.policy.should_retry(kind, self.count):
+      self.response_record = ResponseRecord("", 0, 0, False,
+                                            self.request_timeout)
+      self.finish()
+      return None
+
+    self.prev_wait = self.policy.next_wait(kind, self.prev_wait, err)
+    self.retry_wait += self.prev_wait
+    return self.prev_wait
+
+
+def run_completion(prompt, text, max_tokens, timeout_value, status_cb=None,
+                   use_cache=True, partial_cb=None, cancel=None,
+                   text_tokens=None):
   """
   Run an AI completion with the given prompt and text.
 
   max_tokens may limit the return size or be set to -1
   if status_cb set, called with updates
+  if use_cache is False, the completion cache is not checked
+  if partial_cb set, called with the text received so far
+  if cancel is set, a threading.Event that stops the completion
+  if text_tokens is set, the token count of text
   """
-
-  prompt = build_prompt(prompt)
-  tokenizer = tiktoken.encoding_for_model(section_util.AI_MODEL)
-  text = "\"\"" + text + "\"\"\""
-
-  done = False
-  max_try = 5
-  count = 0
-  request_timeout = 0 
-  wait = 5
-  completion = None
-  truncated = False
-  completion_token_count = 0
-  completion_cost = 0
-  prompt_tokens = len(tokenizer.encode(prompt))
-  text_tokens = len(tokenizer.encode(text))
-
-  # Enusre the total request is less than the max
-  # TODO: more accurate calc of size, don't use factor of 50
-  limit_tokens =  (section_util.AI_MODEL_SIZE -
-                  prompt_tokens - text_tokens - 50)
-  if max_tokens == -1 or max_tokens > limit_tokens:
-    max_tokens = limit_tokens
-
-  base_timeout = timeout_value
-  if base_timeout == 0:
-    base_timeout = AI_BASE_TIMEOUT    
-
-  logging.info("prompt tokens: %d, text tokens: %d, max_tokens: %d, timeout: %d" %
-               (prompt_tokens, text_tokens, max_tokens, base_timeout))
-  
-  logging.info("Running completion: %s", prompt)  
+  call = CompletionCall(prompt, text, max_tokens, timeout_value,
+                        text_tokens)
   if FAKE_AI_COMPLETION:
     time.sleep(FAKE_AI_SLEEP)
-    return ResponseRecord("Dummy completion, this is filler text.\n" * 20,
-                          prompt_tokens = 150,
-                          completion_tokens = 50,
-                          truncated=False,
-                          timeout_value = 0)
+    return call.fake_response()
 
-  # Loop with exponential retries
-  while not done:
-    try:
-      start_time = datetime.datetime.now()
-      request_timeout = base_timeout + (15 * count)
-      response = openai.ChatCompletion.create(
-        model=section_util.AI_MODEL,
-        max_tokens = max_tokens,
-        temperature = 0.1,
-        messages=[ {"role": "system", "content": prompt},
-                   {"role": "user", "content": text }],
-        request_timeout=request_timeout)
-      
-      completion = response['choices'][0]['message']['content']
-      completion_tokens = response['usage']['completion_tokens']
-      prompt_tokens = response['usage']['prompt_tokens']            
-      done = True
-      if response['choices'][0]['finish_reason'] == "length":
-        truncated = True
-      end_time = datetime.datetime.now()
+  if use_cache and call.check_cache() is not None:
+    return call.response_record
 
+  while not call.done:
+    if cancel is not None and cancel.is_set():
+      call.note_cancel()
+      break
+    call.wait_for_service()
+    call.wait_for_budget()
+    try:
+      response = openai.ChatCompletion.create(**call.create_args())
+      if isinstance(response, dict):
+        call.note_response(response)
+      else:
+        call.read_stream(response, partial_cb, cancel)
     except Exception as err:
-      end_time = datetime.datetime.now()
-      logging.error(str(err))      
-      if status_cb is not None:
-        status_cb(str(err))
+      wait_time = call.note_error(err, status_cb)
+      if wait_time is not None:
+        time.sleep(wait_time)
 
-    logging.info("completion required %d seconds" %
-                 (end_time - start_time).total_seconds())
-    count += 1
-    if count >= max_try and not done:
-      completion = ""
-      prompt_tokens = 0
-      completion_tokens = 0
-      truncated = False
-      done = True
-        
-    if not done:
-      wait_time = wait * math.pow(2, count - 1)
-      time.sleep(wait_time)
-
-  return ResponseRecord(completion, prompt_tokens,
-                        completion_tokens, truncated, request_timeout)
+  call.update_cache()
+  return call.response_record
 
 
 class RunState:
@@ -165,6 +454,35 @@ class RunState:
     # Last timeout theshold used where the call suceeded
     self.timeout_value = 0
 
+    # Max number of completions to run at the same time for this run
+    self.max_workers = DEFAULT_RUN_WORKERS
+
+    # Start consolidation of results before all of a round is complete
+    self.pipeline = DEFAULT_PIPELINE
+
+    # Use the completion cache for this run
+    self.use_cache = True
+
+    # ReduceLevel entries for a pipelined run. Level 0 is the source items
+    self.levels = []
+
+    # Item id lists of requests in a round that have no recorded result
+    self.started = []
+
+    # (level, slot, item ids, max tokens) of requests in a pipelined run
+    # that have no recorded result
+    self.running = []
+
+    # Set to stop the run
+    self.cancel = threading.Event()
+
+    # Set with cancel when another worker took over the run, which
+    # then stops without a final save
+    self.abandon = threading.Event()
+
+    # Tokenizer encodes done for the run
+    self.encodes = tokenizers.EncodeCounter()
+
     
   def start_run(self, prompt, item_ids, run_id, op_type):
     """
@@ -176,6 +494,60 @@ class RunState:
     self.source_items = item_ids.copy()
     self.op_type = op_type
 
+  def checkpoint(self):
+    """
+    Return the state needed to resume the run as plain data.
+    Items of requests without a result are returned to the todo list.
+    """
+    to_run = []
+    for item_ids in self.started:
+      to_run.extend(item_ids)
+    return {
+      'run_id': self.run_id,
+      'prompt': self.prompt,
+      'op_type': self.op_type,
+      'source_items': self.source_items.copy(),
+      'to_run': to_run + self.to_run,
+      'current_results': self.current_results.copy(),
+      'completed_run': self.completed_run.copy(),
+      'result_id': self.result_id,
+      'timeout_value': self.timeout_value,
+      'max_workers': self.max_workers,
+      'pipeline': self.pipeline,
+      'use_cache': self.use_cache,
+      'levels': [ { 'items': x.items.copy(),
+                    'consumed': x.consumed,
+                    'closed': x.closed } for x in self.levels ],
+      'running': [ (level, slot, item_ids.copy(), max_tokens)
+                   for (level, slot, item_ids, max_tokens) in self.running ],
+      }
+
+  def restore(self, data):
+    """
+    Set the state from the result of checkpoint.
+    """
+    self.run_id = data['run_id']
+    self.prompt = data['prompt']
+    self.op_type = data['op_type']
+    self.source_items = data['source_items'].copy()
+    self.to_run = data['to_run'].copy()
+    self.current_results = data['current_results'].copy()
+    self.completed_run = data['completed_run'].copy()
+    self.result_id = data['result_id']
+    self.timeout_value = data['timeout_value']
+    self.max_workers = data['max_workers']
+    self.pipeline = data['pipeline']
+    self.use_cache = data['use_cache']
+    self.levels = []
+    for entry in data['levels']:
+      level = ReduceLevel(entry['items'].copy(), entry['closed'])
+      level.consumed = entry['consumed']
+      self.levels.append(level)
+    self.started = []
+    self.running = [ (level, slot, item_ids.copy(), max_tokens)
+                     for (level, slot, item_ids, max_tokens)
+                     in data['running'] ]
+
   def next_item(self):
     """
     Return the next item to be processed, None if empty
@@ -240,6 +612,70 @@ class RunState:
   def get_source_items(self):
     return self.source_items
 
+  def start_pipeline(self):
+    """
+    Setup the levels of the reduction tree for a pipelined run.
+    """
+    self.levels = [ ReduceLevel(self.to_run, True) ]
+    self.to_run = []
+
+  def add_slot(self, level):
+    """
+    Reserve a place for a result in the given level of the tree.
+    Returns the index of the slot.
+    """
+    if level == len(self.levels):
+      self.levels.append(ReduceLevel([], False))
+    self.levels[level].items.append(0)
+    return len(self.levels[level].items) - 1
+
+  def fill_slot(self, level, slot, result_id, completed=True):
+    """
+    Records the result of a completion run by a pipelined run.
+    completed is False for an item passed through from the level
+    below, which is already recorded.
+    """
+    self.levels[level].items[slot] = result_id
+    self.running = [ x for x in self.running
+                     if x[0] != level or x[1] != slot ]
+    if completed:
+      self.completed_run.append(result_id)
+
+  def close_levels(self):
+    """
+    Mark levels that will get no more results as closed.
+    """
+    for index in range(1, len(self.levels)):
+      below = self.levels[index - 1]
+      if below.closed and below.consumed == len(below.items):
+        self.levels[index].closed = True
+
+  def pipeline_result(self):
+    """
+    Return the id of the final result of a pipelined run, 0 if
+    there is no result yet.
+    """
+    for level in self.levels[1:]:
+      if (level.closed and level.consumed == 0 and
+          len(level.items) == 1 and level.items[0] != 0):
+        return level.items[0]
+    return 0
+
+
+class ReduceLevel:
+  """
+  A level of the reduction tree in a pipelined run.
+  """
+  def __init__(self, items, closed):
+    # Item ids in source order, 0 for a completion still running
+    self.items = items
+
+    # Number of items packed into requests for the next level
+    self.consumed = 0
+
+    # True if no more items will be added to the level
+    self.closed = closed
+
 
 def build_prompt(prompt):
   """
@@ -279,10 +715,43 @@ def start_docgen(file_path, doc, prompt, src_run_id=None,
     item_ids.append(item.id())
         
   run_state.start_run(prompt, item_ids, run_id, op_type)
+  checkpoint_run(doc, run_state)
   document.save_document(file_path, doc)
   return run_state
 
 
+def checkpoint_run(doc, run_state):
+  """
+  Record the run state in the document. It is written with the
+  next save of the document.
+  """
+  doc.set_run_checkpoint(run_state.checkpoint(), run_state.run_id)
+
+
+def load_run_state(doc, run_id):
+  """
+  Build the run_state to continue a run from the last checkpoint.
+  Returns None if the run can not be continued.
+  """
+  run_record = doc.get_run_record(run_id)
+  if run_record is None or run_record.stop_time is not None:
+    return None
+  checkpoint = doc.get_run_checkpoint(run_id)
+  if checkpoint is not None:
+    run_state = RunState()
+    run_state.restore(checkpoint)
+    return run_state
+
+  # Runs from before checkpoints can only start from the beginning.
+  if len(run_record.completions) > 0:
+    return None
+  run_state = RunState()
+  item_ids = [ item.id() for item in doc.get_ordered_items(run_id) ]
+  run_state.start_run(doc.get_run_prompt(run_id), item_ids, run_id,
+                      run_record.op_type)
+  return run_state
+
+
 def run_input_tokens(doc, run_state):
   """
   Return the total number of tokens in the input
@@ -295,19 +764,46 @@ def run_input_tokens(doc, run_state):
   return count
 
 
-def run_next_docgen(file_path, doc, run_state):
+class CompletionRequest:
   """
-  Called by run_all_docgen to make one completion.
-  
-  Combines as many items on the todo list as possible.
+  A set of items packed together to run in a single completion.
+  """
+  def __init__(self):
+    self.item_ids = []
+    self.texts = []
+    self.names = []
+    self.token_count = 0
+    self.max_tokens = -1
+    # True for a single intermediate result that is not run again
+    self.skip = False
+
+  def add_item(self, item, count):
+    self.item_ids.append(item.id())
+    self.texts.append(item.text())
+    self.names.append(item.name())
+    self.token_count += count
+
+  def text(self):
+    return '\n'.join(self.texts)
+
+  def text_tokens(self):
+    """
+    Tokens in text(), at most one more for each separator.
+    """
+    return self.token_count + max(0, len(self.texts) - 1)
+
+  def status_message(self):
+    return ', '.join(self.names)
+
+
+def pack_next_request(doc, run_state):
+  """
+  Build a request from items on the todo list.
+  Combines as many items as possible, returns None if no items remain.
   """
-  tokenizer = section_util.get_tokenizer()
   done = False
-  item_id_list = []
-  text_list = []
-  token_count = 0
-  status_message = ""
-  
+  request = CompletionRequest()
+
   # Pull items until max size would be exceeded
   while not done:
     item_id = run_state.next_item()
@@ -320,60 +816,52 @@ def run_next_docgen(file_path, doc, run_state):
       run_state.pop_item()
       continue
     
-    count = len(tokenizer.encode(item.text()))
-    if (token_count != 0 and
-        count + token_count > section_util.TEXT_EMBEDDING_CHUNK_SIZE):
+    count = item.token_count()
+    if (request.token_count != 0 and
+        count + request.token_count > section_util.TEXT_EMBEDDING_CHUNK_SIZE):
       logging.debug("max would be hit, count = %d, token_count = %d" %
-                    (count, token_count))
+                    (count, request.token_count))
       done = True
       continue
 
     # Included the next item, remove from to do list
     run_state.pop_item()
-
-    item_id_list.append(item.id())
-    text_list.append(item.text())
-    token_count += count
+    request.add_item(item, count)
     logging.debug("add id %d to source list. count = %d, total = %d" %
-                  (item.id(), count, token_count))
-    # Build status message to include this item.
-    if len(status_message) > 0:
-      status_message += ", "
-    status_message += item.name()
-
-  if len(item_id_list) == 0:
-    logging.error("No content for docgen")
-    return
+                  (item.id(), count, request.token_count))
 
-  # Setup to run a completion
-  prompt = run_state.prompt
-  prompt_id = doc.prompts.get_prompt_id(prompt)
-                                        
-  logging.info("run completion with %d items" % len(item_id_list))
-
-  # Update status with last item
-  doc.set_status_message("%s on %s" %
-                         (prompt, status_message), run_state.run_id)
-  document.save_document(file_path, doc)
-  
-  err_message = ''
-  def status_cb(message):
-    err_message = str(message)
-    doc.set_status_message(str(message), run_state.run_id)
-    document.save_document(file_path, doc)
+  if len(request.item_ids) == 0:
+    return None
+  run_state.started.append(request.item_ids)
 
   # Ensure response is less than 1/2 the size of a request
   # to make progress on consolidation. Except on the last completion.
-  max_tokens = int(section_util.TEXT_EMBEDDING_CHUNK_SIZE / 2) - 1
+  request.max_tokens = int(section_util.TEXT_EMBEDDING_CHUNK_SIZE / 2) - 1
   if (run_state.is_last_completion() or
       run_state.op_type == document.OP_TYPE_TRANSFORM):
-    max_tokens = -1
+    request.max_tokens = -1
+  return request
 
-  response_record = run_completion(prompt, '\n'.join(text_list),
-                                   max_tokens,
-                                   run_state.timeout_value,
-                                   status_cb)
 
+def record_completion(doc, run_state, request, response_record,
+                      err_message=''):
+  """
+  Add the result of a completion to the document and the run state.
+  """
+  completion = add_completion(doc, run_state, request, response_record,
+                              err_message)
+  run_state.note_step_completed(completion.id())
+  if request.item_ids in run_state.started:
+    run_state.started.remove(request.item_ids)
+  checkpoint_run(doc, run_state)
+  return completion
+
+
+def add_completion(doc, run_state, request, response_record,
+                   err_message=''):
+  """
+  Add the result of a completion to the document.
+  """
   run_state.timeout_value = response_record.timeout_value
   post_process_completion(response_record)
   
@@ -382,12 +870,345 @@ def run_next_docgen(file_path, doc, run_state):
   else:
     text = response_record.text
     
+  # Cached results have no cost
+  token_cost = 0
+  if not response_record.cached:
+    token_cost = (response_record.prompt_tokens +
+                  response_record.completion_tokens)
   completion = doc.add_new_completion(
-    item_id_list,
+    request.item_ids,
     text,
     response_record.completion_tokens,
-    response_record.prompt_tokens + response_record.completion_tokens)
-  run_state.note_step_completed(completion.id())
+    token_cost, run_state.run_id)
+  completion.retries = response_record.retries
+  completion.retry_wait = response_record.retry_wait
+  return completion
+
+
+class PartialTextUpdate:
+  """
+  A partial_cb for run_completion that records the text of a running
+  completion in the document. When save is set the document is saved
+  at most every PARTIAL_UPDATE_SECONDS.
+
+  The status method is a status_cb for the same completions, saved on
+  the same schedule.
+  """
+  def __init__(self, file_path, doc, run_id, lock=None, save=True):
+    self.file_path = file_path
+    self.doc = doc
+    self.run_id = run_id
+    self.lock = lock or threading.Lock()
+    self.save = save
+    self.last_save = 0
+
+  def __call__(self, text):
+    with self.lock:
+      self.doc.set_partial_text(text, self.run_id)
+      self.save_soon()
+
+  def status(self, message):
+    with self.lock:
+      self.doc.set_status_message(str(message), self.run_id)
+      self.save_soon()
+
+  def save_soon(self):
+    now = time.monotonic()
+    if self.save and now - self.last_save >= PARTIAL_UPDATE_SECONDS:
+      self.last_save = now
+      document.save_document(self.file_path, self.doc)
+
+
+def run_next_docgen(file_path, doc, run_state):
+  """
+  Called by run_all_docgen to make one completion.
+  
+  Combines as many items on the todo list as possible.
+  """
+  request = pack_next_request(doc, run_state)
+  if request is None:
+    logging.error("No content for docgen")
+    return
+
+  # Setup to run a completion
+  prompt = run_state.prompt
+  logging.info("run completion with %d items" % len(request.item_ids))
+
+  # Update status with last item
+  doc.set_status_message("%s on %s" %
+                         (prompt, request.status_message()),
+                         run_state.run_id)
+  document.save_document(file_path, doc)
+  
+  err_message = ''
+  def status_cb(message):
+    err_message = str(message)
+    doc.set_status_message(str(message), run_state.run_id)
+    document.save_document(file_path, doc)
+
+  partial_cb = PartialTextUpdate(file_path, doc, run_state.run_id)
+  response_record = run_completion(prompt, request.text(),
+                                   request.max_tokens,
+                                   run_state.timeout_value,
+                                   status_cb, run_state.use_cache,
+                                   partial_cb, run_state.cancel,
+                                   request.text_tokens())
+  if response_record.canceled:
+    return
+  record_completion(doc, run_state, request, response_record, err_message)
+
+
+def pack_round(doc, run_state):
+  """
+  Pack all items on the todo list into a list of requests.
+  """
+  requests = []
+  request = pack_next_request(doc, run_state)
+  while request is not None:
+    requests.append(request)
+    request = pack_next_request(doc, run_state)
+
+  # As in a serial run, a single intermediate result left at the end
+  # is not run again. Return it to the todo list to be skipped.
+  if (len(requests) > 1 and len(requests[-1].item_ids) == 1 and
+      not requests[-1].item_ids[0] in run_state.source_items):
+    request = requests.pop()
+    run_state.started.remove(request.item_ids)
+    run_state.to_run.insert(0, request.item_ids[0])
+
+  # Only a single request that produces the final result may
+  # use the full response size.
+  if (len(requests) > 1 and
+      run_state.op_type != document.OP_TYPE_TRANSFORM):
+    for request in requests:
+      request.max_tokens = int(section_util.TEXT_EMBEDDING_CHUNK_SIZE / 2) - 1
+  return requests
+
+
+_completion_pool = None
+_completion_pool_lock = threading.Lock()
+
+def get_completion_pool():
+  """
+  Return the process wide pool used to run completions. The size
+  of the pool is the global limit on completions in flight.
+  """
+  global _completion_pool
+  with _completion_pool_lock:
+    if _completion_pool is None:
+      _completion_pool = concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_PARALLEL_COMPLETIONS,
+        thread_name_prefix='docgen')
+    return _completion_pool
+
+
+def run_round_parallel(file_path, doc, run_state):
+  """
+  Run all items on the todo list with up to run_state.max_workers
+  completions in flight. Results are recorded in the order of the
+  source items so the completion tree is the same as a serial run.
+  """
+  requests = pack_round(doc, run_state)
+  if len(requests) == 0:
+    return
+  prompt = run_state.prompt
+  pool = get_completion_pool()
+  doc_lock = threading.Lock()
+  in_flight = {}
+  next_submit = 0
+  next_record = 0
+  results = {}
+
+  partial_cb = PartialTextUpdate(file_path, doc, run_state.run_id, doc_lock)
+  status_cb = partial_cb.status
+
+  logging.info("run %d completions, %d workers" %
+               (len(requests), run_state.max_workers))
+  while next_record < len(requests) and not run_state.cancel.is_set():
+    # Keep the window of running completions full
+    while (next_submit < len(requests) and
+           len(in_flight) < run_state.max_workers):
+      request = requests[next_submit]
+      future = pool.submit(contextvars.copy_context().run,
+                           run_completion, prompt, request.text(),
+                           request.max_tokens, run_state.timeout_value,
+                           status_cb, run_state.use_cache,
+                           partial_cb, run_state.cancel,
+                           request.text_tokens())
+      in_flight[future] = next_submit
+      next_submit += 1
+
+    with doc_lock:
+      names = [ requests[i].status_message() for i in in_flight.values() ]
+      doc.set_status_message("%s on %s" % (prompt, ', '.join(names)),
+                             run_state.run_id)
+      document.save_document(file_path, doc)
+
+    (done, not_done) = concurrent.futures.wait(
+      in_flight.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+    for future in done:
+      results[in_flight.pop(future)] = future.result()
+
+    # Record results in order of the source items.
+    with doc_lock:
+      while next_record in results and not run_state.cancel.is_set():
+        record_completion(doc, run_state, requests[next_record],
+                          results.pop(next_record))
+        next_record += 1
+      document.save_document(file_path, doc)
+
+
+def pack_level_request(doc, run_state, index):
+  """
+  Build a request from the next items of a level of the reduction
+  tree. Returns None unless the request is known to be complete,
+  that is the next item would not fit, or the level is finished.
+  """
+  level = run_state.levels[index]
+  request = CompletionRequest()
+  next_index = level.consumed
+  full = False
+  while next_index < len(level.items) and not full:
+    item_id = level.items[next_index]
+    if item_id == 0:
+      # Wait for the running completion
+      return None
+
+    item = doc.get_item_by_id(run_state.run_id, item_id)
+    if item is None:
+      next_index += 1
+      continue
+
+    count = item.token_count()
+    if (request.token_count != 0 and
+        count + request.token_count > section_util.TEXT_EMBEDDING_CHUNK_SIZE):
+      full = True
+      continue
+    request.add_item(item, count)
+    next_index += 1
+
+  if not full and not level.closed:
+    # More items may still fit
+    return None
+  if len(request.item_ids) == 0:
+    level.consumed = next_index
+    return None
+
+  # A request that covers the entire level produces the final result.
+  request.max_tokens = int(section_util.TEXT_EMBEDDING_CHUNK_SIZE / 2) - 1
+  if level.consumed == 0 and next_index == len(level.items):
+    request.max_tokens = -1
+  # As in a round, a single intermediate result left at the end of
+  # a level is passed to the next level as is.
+  request.skip = (level.consumed != 0 and next_index == len(level.items) and
+                  len(request.item_ids) == 1 and
+                  not request.item_ids[0] in run_state.source_items)
+  level.consumed = next_index
+  return request
+
+
+def pack_pipeline(doc, run_state, capacity):
+  """
+  Return a list of (level, slot, request) entries ready to run,
+  at most capacity long. Levels closer to the final result are
+  packed first.
+  """
+  result = []
+  index = len(run_state.levels) - 1
+  while index >= 0 and len(result) < capacity:
+    # The final result is not consolidated further.
+    if run_state.pipeline_result() != 0:
+      break
+    request = pack_level_request(doc, run_state, index)
+    if request is None:
+      index -= 1
+      continue
+    slot = run_state.add_slot(index + 1)
+    if request.skip:
+      run_state.fill_slot(index + 1, slot, request.item_ids[0], False)
+    else:
+      run_state.running.append((index + 1, slot, request.item_ids,
+                                request.max_tokens))
+      result.append((index + 1, slot, request))
+    run_state.close_levels()
+    # A new level may be ready to pack.
+    index = len(run_state.levels) - 1
+  run_state.close_levels()
+  return result
+
+
+def restart_pipeline_requests(doc, run_state):
+  """
+  Return (level, slot, request) entries for the requests of a resumed
+  pipelined run that were started and have no result.
+  """
+  result = []
+  for (level, slot, item_ids, max_tokens) in run_state.running:
+    request = CompletionRequest()
+    for item in doc.get_items_for_ids(run_state.run_id, item_ids):
+      request.add_item(item, item.token_count())
+    request.max_tokens = max_tokens
+    result.append((level, slot, request))
+  return result
+
+
+def run_pipeline(file_path, doc, run_state):
+  """
+  Run a consolidation where the requests for a level of the tree
+  start as soon as enough results of the level below are available.
+  """
+  if len(run_state.levels) == 0:
+    run_state.start_pipeline()
+  prompt = run_state.prompt
+  pool = get_completion_pool()
+  doc_lock = threading.Lock()
+  in_flight = {}
+
+  partial_cb = PartialTextUpdate(file_path, doc, run_state.run_id, doc_lock)
+  status_cb = partial_cb.status
+
+  def start_request(level, slot, request):
+    future = pool.submit(contextvars.copy_context().run,
+                         run_completion, prompt, request.text(),
+                         request.max_tokens, run_state.timeout_value,
+                         status_cb, run_state.use_cache,
+                         partial_cb, run_state.cancel,
+                         request.text_tokens())
+    in_flight[future] = (level, slot, request)
+
+  for entry in restart_pipeline_requests(doc, run_state):
+    start_request(*entry)
+
+  while not run_state.cancel.is_set():
+    capacity = max(1, run_state.max_workers) - len(in_flight)
+    with doc_lock:
+      launches = pack_pipeline(doc, run_state, capacity)
+    for entry in launches:
+      start_request(*entry)
+
+    if len(in_flight) == 0:
+      break
+
+    with doc_lock:
+      names = [ x[2].status_message() for x in in_flight.values() ]
+      doc.set_status_message("%s on %s" % (prompt, ', '.join(names)),
+                             run_state.run_id)
+      document.save_document(file_path, doc)
+
+    (done, not_done) = concurrent.futures.wait(
+      in_flight.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+    with doc_lock:
+      for future in done:
+        (level, slot, request) = in_flight.pop(future)
+        if future.result().canceled:
+          continue
+        completion = add_completion(doc, run_state, request,
+                                    future.result())
+        run_state.fill_slot(level, slot, completion.id())
+      checkpoint_run(doc, run_state)
+      document.save_document(file_path, doc)
+
+  run_state.result_id = run_state.pipeline_result()
 
 
 def combine_results(doc, run_state):
@@ -395,23 +1216,21 @@ def combine_results(doc, run_state):
   # and make it the final result
   item_id_list = []
   text_list = []
+  text_tokens = 0
   while run_state.next_item():
     id = run_state.pop_item()
     item_id_list.append(id)
     completion = doc.get_item_by_id(run_state.run_id, id)
     text_list.append(completion.text() + '\n')
-
-  prompt = run_state.prompt
-  prompt_id = doc.prompts.get_prompt_id(prompt)
-  text = '\n'.join(text_list)
-  tokenizer = tiktoken.encoding_for_model(section_util.AI_MODEL)    
-  text_tokens = len(tokenizer.encode(text))
+    # Count of the result and the newline
+    text_tokens += completion.token_count() + 1
     
   completion = doc.add_new_completion(
     item_id_list,
     ''.join(text_list),
-    text_tokens, 0)
+    text_tokens, 0, run_state.run_id)
   run_state.note_step_completed(completion.id())
+  checkpoint_run(doc, run_state)
 
   
 def run_all_docgen(file_path, doc, run_state):
@@ -422,48 +1241,96 @@ def run_all_docgen(file_path, doc, run_state):
   # Save the file as progress is made so the status can be
   # read.
   #
-  done = False
-  result_id = None
-  doc.set_status_message("Running...")
-  while not done:
-    logging.debug("loop to run a set of docgen ops")      
-
-    # loop to consume all run items
-    while run_state.next_item() is not None:
-      if run_state.skip_remaining_gen():
-        # Skip procesing an already processed item
-        id = run_state.pop_item()
-        logging.debug("skip unnecessary docgen: %d", id)
-        # Add directly to results list for further processing
-        # TODO: is this a bug with result_id here and id above?
-        run_state.note_step_completed(result_id)
-      else:
-        logging.debug("loop for running docgen")
-        run_next_docgen(file_path, doc, run_state)
-        document.save_document(file_path, doc)
-
-    # If this a tranform, we combine the results into a final
-    # and we are done
-    if run_state.op_type == document.OP_TYPE_TRANSFORM:
-      if run_state.next_result_set():
-        combine_results(doc, run_state)
-
-    # Done with the to_run queue, check if we process the
-    # set of generated results.
-    if not run_state.next_result_set():
-      logging.info("doc gen complete")      
+  with tokenizers.counting(run_state.encodes):
+    done = False
+    doc.set_status_message("Running...", run_state.run_id)
+    checkpoint_run(doc, run_state)
+    if (run_state.pipeline and
+        run_state.op_type == document.OP_TYPE_CONSOLIDATE):
+      run_pipeline(file_path, doc, run_state)
       done = True
 
-  # Complete - mark final result and save
+    while not done and not run_state.cancel.is_set():
+      logging.debug("loop to run a set of docgen ops")      
+
+      # loop to consume all run items
+      while (run_state.next_item() is not None and
+             not run_state.cancel.is_set()):
+        if run_state.max_workers > 1 and not run_state.skip_remaining_gen():
+          logging.debug("run docgen round in parallel")
+          run_round_parallel(file_path, doc, run_state)
+        elif run_state.skip_remaining_gen():
+          # Skip procesing an already processed item
+          id = run_state.pop_item()
+          logging.debug("skip unnecessary docgen: %d", id)
+          # Add directly to results list for further processing
+          run_state.note_step_completed(id)
+        else:
+          logging.debug("loop for running docgen")
+          run_next_docgen(file_path, doc, run_state)
+          document.save_document(file_path, doc)
+
+      if run_state.cancel.is_set():
+        break
+
+      # If this a tranform, we combine the results into a final
+      # and we are done
+      if run_state.op_type == document.OP_TYPE_TRANSFORM:
+        if run_state.next_result_set():
+          combine_results(doc, run_state)
+
+      # Done with the to_run queue, check if we process the
+      # set of generated results.
+      if not run_state.next_result_set():
+        logging.info("doc gen complete")      
+        done = True
+
+    if run_state.cancel.is_set():
+      return cancel_docgen(file_path, doc, run_state)
+    return finish_docgen(file_path, doc, run_state)
+
+
+def log_encodes(run_state):
+  stats = run_state.encodes.stats()
+  logging.info("run %d: %d encodes of %d chars, %d cached counts",
+               run_state.run_id, stats['encodes'], stats['encoded_chars'],
+               stats['count_hits'])
+
+
+def cancel_docgen(file_path, doc, run_state):
+  """
+  Stop a canceled run and save. The run can not be resumed.
+  """
+  log_encodes(run_state)
+  if run_state.abandon.is_set():
+    logging.info("doc gen abandoned to another worker")
+    return None
+  logging.info("doc gen canceled")
+  doc.set_partial_text('', run_state.run_id)
+  doc.set_run_checkpoint(None, run_state.run_id)
+  doc.mark_cancel_run("Run canceled.", run_state.run_id)
+  document.save_document(file_path, doc)
+  return None
+
+
+def finish_docgen(file_path, doc, run_state):
+  """
+  Complete - mark final result and save.
+  Return the id of the result, None if there is no result.
+  """
+  result_id = None
+  log_encodes(run_state)
   completion = doc.get_item_by_id(run_state.run_id, run_state.result_id)
   if completion is not None:
     # TODO: make these less redundent 
-    doc.set_final_result(completion)
+    doc.set_final_result(completion, run_state.run_id)
     completion.set_final_result()    
     result_id = completion.id()
 
-  doc.set_status_message("")
-  doc.mark_complete_run()
+  doc.set_status_message("", run_state.run_id)
+  doc.set_partial_text('', run_state.run_id)
+  doc.set_run_checkpoint(None, run_state.run_id)
+  doc.mark_complete_run(run_state.run_id)
   document.save_document(file_path, doc)
   return result_id
   
@@ -0,0 +1,301 @@
+"""
+Asyncio versions of the doc generation functions.
+
+A single event loop runs the completions for all runs. The number of
+completions in flight is limited by semaphores instead of using an
+OS thread for each run.
+"""
+from . import doc_gen
+from . import doc_index
+from . import document
+from . import tokenizers
+import asyncio
+import logging
+import threading
+import weakref
+import openai
+
+
+# Global limit on completions in flight on one event loop
+MAX_ASYNC_COMPLETIONS=64
+
+_loop_semaphores = weakref.WeakKeyDictionary()
+
+def get_loop_semaphore():
+  """
+  Return the semaphore limiting completions on the running loop.
+  """
+  loop = asyncio.get_running_loop()
+  semaphore = _loop_semaphores.get(loop)
+  if semaphore is None:
+    semaphore = asyncio.Semaphore(MAX_ASYNC_COMPLETIONS)
+    _loop_semaphores[loop] = semaphore
+  return semaphore
+
+
+async def run_completion_async(prompt, text, max_tokens, timeout_value,
+                               status_cb=None, use_cache=True,
+                               partial_cb=None, cancel=None,
+                               text_tokens=None):
+  """
+  Run an AI completion with the given prompt and text.
+  Same as doc_gen.run_completion using the async OpenAI client.
+  """
+  call = doc_gen.CompletionCall(prompt, text, max_tokens, timeout_value,
+                                text_tokens)
+  if doc_gen.FAKE_AI_COMPLETION:
+    await asyncio.sleep(doc_gen.FAKE_AI_SLEEP)
+    return call.fake_response()
+
+  if use_cache and call.check_cache() is not None:
+    return call.response_record
+
+  while not call.done:
+    if cancel is not None and cancel.is_set():
+      call.note_cancel()
+      break
+    if doc_gen.CIRCUIT_BREAKER is not None:
+      call.retry_wait += await doc_gen.CIRCUIT_BREAKER.wait_async()
+    if doc_gen.RATE_LIMITER is not None:
+      await doc_gen.RATE_LIMITER.acquire_async(call.request_tokens())
+    try:
+      async with get_loop_semaphore():
+        response = await openai.ChatCompletion.acreate(**call.create_args())
+        if isinstance(response, dict):
+          call.note_response(response)
+        else:
+          await read_stream(call, response, partial_cb, cancel)
+    except Exception as err:
+      wait_time = call.note_error(err, status_cb)
+      if wait_time is not None:
+        await asyncio.sleep(wait_time)
+
+  call.update_cache()
+  return call.response_record
+
+
+async def read_stream(call, response, partial_cb, cancel):
+  """
+  Read a streaming response, stopping early if cancel is set.
+  """
+  call.start_stream()
+  async for chunk in response:
+    call.note_chunk(chunk, partial_cb)
+    if cancel is not None and cancel.is_set():
+      await response.aclose()
+      call.note_stream_end(canceled=True)
+      return
+  call.note_stream_end()
+
+
+async def save_document(file_path, doc):
+  """
+  Save the document without blocking the event loop. The document is
+  pickled on the loop, where the run changes it, and only the pickle
+  is written on another thread.
+  """
+  journal = document.get_journal(file_path, doc)
+  if not journal.lock.acquire(blocking=False):
+    await asyncio.to_thread(journal.lock.acquire)
+  try:
+    write_fn = document.prepare_save(file_path, doc)
+    await asyncio.to_thread(doc_index.write_document, file_path, doc,
+                            write_fn)
+  finally:
+    journal.lock.release()
+
+
+async def run_round_async(file_path, doc, run_state):
+  """
+  Run all items on the todo list with up to run_state.max_workers
+  completions in flight. Results are recorded in the order of the
+  source items.
+  """
+  requests = doc_gen.pack_round(doc, run_state)
+  if len(requests) == 0:
+    return
+  prompt = run_state.prompt
+  run_semaphore = asyncio.Semaphore(max(1, run_state.max_workers))
+
+  def status_cb(message):
+    doc.set_status_message(str(message), run_state.run_id)
+  partial_cb = doc_gen.PartialTextUpdate(file_path, doc, run_state.run_id,
+                                         save=False)
+
+  async def run_request(request):
+    async with run_semaphore:
+      return await run_completion_async(prompt, request.text(),
+                                        request.max_tokens,
+                                        run_state.timeout_value,
+                                        status_cb, run_state.use_cache,
+                                        partial_cb, run_state.cancel,
+                                        request.text_tokens())
+
+  names = ', '.join([ x.status_message() for x in requests ])
+  doc.set_status_message("%s on %s" % (prompt, names), run_state.run_id)
+  await save_document(file_path, doc)
+
+  tasks = [ asyncio.ensure_future(run_request(x)) for x in requests ]
+  try:
+    for (request, task) in zip(requests, tasks):
+      response_record = await task
+      if run_state.cancel.is_set():
+        break
+      doc_gen.record_completion(doc, run_state, request, response_record)
+      await save_document(file_path, doc)
+  finally:
+    for task in tasks:
+      task.cancel()
+
+
+async def run_pipeline_async(file_path, doc, run_state):
+  """
+  Run a consolidation where the requests for a level of the tree
+  start as soon as enough results of the level below are available.
+  """
+  if len(run_state.levels) == 0:
+    run_state.start_pipeline()
+  prompt = run_state.prompt
+  in_flight = {}
+
+  def status_cb(message):
+    doc.set_status_message(str(message), run_state.run_id)
+  partial_cb = doc_gen.PartialTextUpdate(file_path, doc, run_state.run_id,
+                                         save=False)
+
+  def start_request(level, slot, request):
+    task = asyncio.ensure_future(
+      run_completion_async(prompt, request.text(), request.max_tokens,
+                           run_state.timeout_value, status_cb,
+                           run_state.use_cache, partial_cb,
+                           run_state.cancel, request.text_tokens()))
+    in_flight[task] = (level, slot, request)
+
+  for entry in doc_gen.restart_pipeline_requests(doc, run_state):
+    start_request(*entry)
+
+  try:
+    while not run_state.cancel.is_set():
+      capacity = max(1, run_state.max_workers) - len(in_flight)
+      for entry in doc_gen.pack_pipeline(doc, run_state, capacity):
+        start_request(*entry)
+
+      if len(in_flight) == 0:
+        break
+
+      names = [ x[2].status_message() for x in in_flight.values() ]
+      doc.set_status_message("%s on %s" % (prompt, ', '.join(names)),
+                             run_state.run_id)
+      await save_document(file_path, doc)
+
+      (done, pending) = await asyncio.wait(
+        in_flight.keys(), return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        (level, slot, request) = in_flight.pop(task)
+        if task.result().canceled:
+          continue
+        completion = doc_gen.add_completion(doc, run_state, request,
+                                            task.result())
+        run_state.fill_slot(level, slot, completion.id())
+      doc_gen.checkpoint_run(doc, run_state)
+      await save_document(file_path, doc)
+  finally:
+    for task in in_flight.keys():
+      task.cancel()
+
+  run_state.result_id = run_state.pipeline_result()
+
+
+async def run_all_docgen_async(file_path, doc, run_state):
+  """
+  Run a Doc Gen process that has been initialized with
+  start doc gen. Return the id of the results.
+  """
+  with tokenizers.counting(run_state.encodes):
+    done = False
+    doc.set_status_message("Running...", run_state.run_id)
+    doc_gen.checkpoint_run(doc, run_state)
+    if (run_state.pipeline and
+        run_state.op_type == document.OP_TYPE_CONSOLIDATE):
+      await run_pipeline_async(file_path, doc, run_state)
+      done = True
+
+    while not done and not run_state.cancel.is_set():
+      # loop to consume all run items
+      while (run_state.next_item() is not None and
+             not run_state.cancel.is_set()):
+        if run_state.skip_remaining_gen():
+          id = run_state.pop_item()
+          logging.debug("skip unnecessary docgen: %d", id)
+          run_state.note_step_completed(id)
+        else:
+          await run_round_async(file_path, doc, run_state)
+
+      if run_state.cancel.is_set():
+        break
+
+      # If this a tranform, we combine the results into a final
+      # and we are done
+      if run_state.op_type == document.OP_TYPE_TRANSFORM:
+        if run_state.next_result_set():
+          doc_gen.combine_results(doc, run_state)
+
+      if not run_state.next_result_set():
+        logging.info("doc gen complete")      
+        done = True
+
+    if run_state.cancel.is_set():
+      return await asyncio.to_thread(doc_gen.cancel_docgen,
+                                     file_path, doc, run_state)
+    return await asyncio.to_thread(doc_gen.finish_docgen,
+                                   file_path, doc, run_state)
+
+
+class DocGenLoop:
+  """
+  An event loop running in a background thread that multiplexes
+  doc gen runs for all users.
+  """
+  def __init__(self):
+    self.loop = None
+    self.thread = None
+    self.lock = threading.Lock()
+
+  def start(self):
+    with self.lock:
+      if self.thread is None:
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.run_loop,
+                                       name='docgen-loop',
+                                       daemon=True)
+        self.thread.start()
+
+  def run_loop(self):
+    asyncio.set_event_loop(self.loop)
+    self.loop.run_forever()
+
+  def submit(self, coro):
+    """
+    Schedule the coroutine on the loop and return a
+    concurrent.futures.Future for the result.
+    """
+    self.start()
+    return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+  def stop(self):
+    with self.lock:
+      if self.thread is not None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.thread = None
+        self.loop = None
+
+
+_docgen_loop = DocGenLoop()
+
+def get_docgen_loop():
+  """
+  Return the process wide doc gen event loop.
+  """
+  return _docgen_loop
@@ -0,0 +1,164 @@
+from . import document
+from . import doc_gen
+from . import doc_gen_async
+from . import section_util
+import unittest
+import unittest.mock
+import tempfile
+import asyncio
+import threading
+import http.server
+import json
+import os
+import openai
+
+
+class FakeAIHandler(http.server.BaseHTTPRequestHandler):
+  """
+  Answer chat completion requests with a short canned response.
+  """
+  def do_POST(self):
+    length = int(self.headers['Content-Length'])
+    request = json.loads(self.rfile.read(length))
+    self.server.request_count += 1
+    if request.get('stream'):
+      self.send_stream(request)
+      return
+    body = json.dumps({
+      'id': 'chatcmpl-test',
+      'object': 'chat.completion',
+      'model': request['model'],
+      'choices': [ { 'index': 0,
+                     'finish_reason': 'stop',
+                     'message': { 'role': 'assistant',
+                                  'content': 'Fake summary text.\n' } } ],
+      'usage': { 'prompt_tokens': 100,
+                 'completion_tokens': 5,
+                 'total_tokens': 105 } }).encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def send_stream(self, request):
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.end_headers()
+    for (content, reason) in [ ('Fake summary ', None),
+                               ('text.\n', None),
+                               (None, 'stop') ]:
+      delta = {}
+      if content is not None:
+        delta['content'] = content
+      chunk = json.dumps({
+        'id': 'chatcmpl-test',
+        'object': 'chat.completion.chunk',
+        'model': request['model'],
+        'choices': [ { 'index': 0,
+                       'delta': delta,
+                       'finish_reason': reason } ] })
+      self.wfile.write(('data: %s\n\n' % chunk).encode('utf-8'))
+    self.wfile.write(b'data: [DONE]\n\n')
+    self.close_connection = True
+
+  def log_message(self, format, *args):
+    pass
+
+
+class AsyncDocGenTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                  FakeAIHandler)
+    self.server.request_count = 0
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    doc_gen.AI_API_BASE = 'http://127.0.0.1:%d/v1' % self.server.server_port
+    doc_gen.FAKE_AI_COMPLETION = False
+    openai.api_key = 'test-key'
+
+    self.user_dir = tempfile.TemporaryDirectory()        
+    orig_file = 'PA utility.docx'
+    path = os.path.join(os.path.dirname(__file__),
+                        'samples/', orig_file)
+    with open(path, 'rb') as f:
+      filename = document.find_or_create_doc(self.user_dir.name,
+                                             orig_file, f)
+    self.doc_path = os.path.join(self.user_dir.name, filename + '.daf')
+    self.document = document.load_document(self.doc_path)
+
+  def tearDown(self):
+    doc_gen.AI_API_BASE = None
+    self.server.shutdown()
+    self.server.server_close()
+    self.thread.join()
+    self.user_dir.cleanup()
+
+  def testCompletion(self):
+    response = asyncio.run(
+      doc_gen_async.run_completion_async("A prompt", "Some text", -1, 0))
+    self.assertEqual(response.text, 'Fake summary text.\n')
+    # Streamed responses are counted locally
+    tokenizer = section_util.get_tokenizer()
+    self.assertEqual(response.completion_tokens,
+                     len(tokenizer.encode(response.text)))
+    self.assertEqual(self.server.request_count, 1)
+
+  def testCompletionNoStream(self):
+    doc_gen.AI_STREAM = False
+    try:
+      response = asyncio.run(
+        doc_gen_async.run_completion_async("A prompt", "Some text", -1, 0))
+    finally:
+      doc_gen.AI_STREAM = True
+    self.assertEqual(response.text, 'Fake summary text.\n')
+    self.assertEqual(response.completion_tokens, 5)
+
+  def testFullRun(self):
+    run_state = doc_gen.start_docgen(self.doc_path, self.document,
+                                     "A prompt")
+    run_state.max_workers = 4
+    result_id = asyncio.run(
+      doc_gen_async.run_all_docgen_async(self.doc_path, self.document,
+                                         run_state))
+    self.assertIsNotNone(result_id)
+    self.assertFalse(self.document.is_running())
+    completions = self.document.get_completion_list(run_state.run_id)
+    self.assertEqual(len(completions), self.server.request_count)
+
+    # Saved document matches
+    doc = document.load_document(self.doc_path)
+    self.assertEqual(doc.get_result_item(run_state.run_id).text(),
+                     'Fake summary text.\n')
+
+  def testSaveOnLoop(self):
+    run_state = doc_gen.start_docgen(self.doc_path, self.document,
+                                     "A prompt")
+    run_state.max_workers = 4
+    # The document is pickled on the loop thread that changes it
+    threads = set()
+    run_state_fn = document.run_state
+    def record_thread(run_record):
+      threads.add(threading.current_thread())
+      return run_state_fn(run_record)
+    with unittest.mock.patch.object(document, 'run_state', record_thread):
+      asyncio.run(doc_gen_async.run_round_async(self.doc_path, self.document,
+                                                run_state))
+    self.assertEqual(threads, { threading.current_thread() })
+
+    doc = document.load_document(self.doc_path)
+    self.assertEqual(len(doc.get_completion_list(run_state.run_id)),
+                     self.server.request_count)
+
+  def testDocGenLoop(self):
+    loop = doc_gen_async.DocGenLoop()
+    run_state = doc_gen.start_docgen(self.doc_path, self.document,
+                                     "A prompt",
+                                     op_type=document.OP_TYPE_TRANSFORM)
+    future = loop.submit(
+      doc_gen_async.run_all_docgen_async(self.doc_path, self.document,
+                                         run_state))
+    self.assertIsNotNone(future.result(timeout=30))
+    loop.stop()
+    self.assertFalse(self.document.is_running())
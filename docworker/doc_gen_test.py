@@ -1,7 +1,14 @@
 from . import document
 from . import doc_gen
+from . import section_util
+from . import completion_cache
 import unittest
+import unittest.mock
+import openai
 import tempfile
+import random
+import time
+import threading
 import os
 
 
@@ -30,6 +37,39 @@ class RunStateTestCase(unittest.TestCase):
     
 
 
+class TokenCountTestCase(unittest.TestCase):
+
+  def testChatTokens(self):
+    # Count the request as described for the chat format
+    tokenizer = section_util.get_tokenizer()
+    call = doc_gen.CompletionCall("A prompt", "Some text", -1, 0)
+    messages = doc_gen.CompletionCall("A prompt", "Some text", -1,
+                                      0).create_args()['messages']
+    count = 3
+    for message in messages:
+      count += 3
+      for value in message.values():
+        count += len(tokenizer.encode(value))
+    self.assertEqual(call.input_tokens(), count)
+    self.assertEqual(call.max_tokens, section_util.AI_MODEL_SIZE - count)
+
+    # Same result with the text count given
+    call = doc_gen.CompletionCall("A prompt", "Some text", -1, 0,
+                                  len(tokenizer.encode("Some text")))
+    self.assertEqual(call.input_tokens(), count)
+
+  def testRequestTokens(self):
+    tokenizer = section_util.get_tokenizer()
+    doc = document.Document()
+    doc.doc_text = ("Some words for a sentence.\n" * 400)
+    run_id = doc.mark_start_run("A prompt")
+    request = doc_gen.CompletionRequest()
+    for item in doc.get_ordered_items(run_id):
+      request.add_item(item, item.token_count())
+    self.assertGreaterEqual(request.text_tokens(),
+                            len(tokenizer.encode(request.text())))
+
+
 class MiscCoverageTestCase(unittest.TestCase):
   def testPrompt(self):
     self.assertIsNotNone(doc_gen.build_prompt("A prompt"))
@@ -42,6 +82,151 @@ class MiscCoverageTestCase(unittest.TestCase):
     
     
 
+class CachedCompletionTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_dir = tempfile.TemporaryDirectory()
+    doc_gen.COMPLETION_CACHE = completion_cache.CompletionCache(
+      os.path.join(self.cache_dir.name, 'cache.sqlite'))
+    doc_gen.FAKE_AI_COMPLETION = False
+
+  def tearDown(self):
+    doc_gen.COMPLETION_CACHE.close()
+    doc_gen.COMPLETION_CACHE = None
+    self.cache_dir.cleanup()
+
+  @unittest.mock.patch('openai.ChatCompletion.create')
+  def testCachedCompletion(self, create):
+    create.return_value = {
+      'choices': [ { 'finish_reason': 'stop',
+                     'message': { 'content': 'A result' } } ],
+      'usage': { 'prompt_tokens': 20, 'completion_tokens': 2 } }
+    response = doc_gen.run_completion("A prompt", "Some text", -1, 0)
+    self.assertFalse(response.cached)
+    response = doc_gen.run_completion("A prompt", "Some text", -1, 0)
+    self.assertTrue(response.cached)
+    self.assertEqual(response.text, 'A result')
+    self.assertEqual(create.call_count, 1)
+
+    # Bypass the cache
+    response = doc_gen.run_completion("A prompt", "Some text", -1, 0,
+                                      use_cache=False)
+    self.assertFalse(response.cached)
+    self.assertEqual(create.call_count, 2)
+
+    # Cached results have no cost
+    doc = document.Document()
+    doc.doc_text = "Some text"
+    run_state = doc_gen.RunState()
+    run_state.run_id = doc.mark_start_run("A prompt")
+    request = doc_gen.CompletionRequest()
+    completion = doc_gen.add_completion(
+      doc, run_state, request,
+      doc_gen.run_completion("A prompt", "Some text", -1, 0))
+    self.assertEqual(completion.token_cost, 0)
+    self.assertEqual(completion.token_count(), 2)
+
+
+class RetryCompletionTestCase(unittest.TestCase):
+
+  def setUp(self):
+    doc_gen.FAKE_AI_COMPLETION = False
+    self.sleeps = []
+
+  def fake_sleep(self, seconds):
+    self.sleeps.append(seconds)
+
+  @unittest.mock.patch('openai.ChatCompletion.create')
+  def testRetries(self, create):
+    create.side_effect = [
+      openai.error.RateLimitError("slow down",
+                                  headers={ 'Retry-After': '20' }),
+      openai.error.Timeout("timed out"),
+      { 'choices': [ { 'finish_reason': 'stop',
+                       'message': { 'content': 'A result' } } ],
+        'usage': { 'prompt_tokens': 20, 'completion_tokens': 2 } } ]
+    with unittest.mock.patch.object(doc_gen.time, 'sleep', self.fake_sleep):
+      response = doc_gen.run_completion("A prompt", "Some text", -1, 60,
+                                        use_cache=False)
+    self.assertEqual(response.text, 'A result')
+    self.assertEqual(response.retries, 2)
+    self.assertGreaterEqual(self.sleeps[0], 20)
+    self.assertAlmostEqual(response.retry_wait, sum(self.sleeps))
+    # Only a timeout increases the request timeout
+    timeouts = [ x.kwargs['request_timeout'] for x in create.call_args_list ]
+    self.assertEqual(timeouts[0], timeouts[1])
+    self.assertGreater(timeouts[2], timeouts[1])
+
+    # Recorded with the completion
+    doc = document.Document()
+    doc.doc_text = "Some text"
+    run_state = doc_gen.RunState()
+    run_state.run_id = doc.mark_start_run("A prompt")
+    completion = doc_gen.add_completion(doc, run_state,
+                                        doc_gen.CompletionRequest(),
+                                        response)
+    self.assertEqual(completion.retry_stats(), (2, response.retry_wait))
+    self.assertEqual(doc.get_retry_stats()[0], 2)
+
+  @unittest.mock.patch('openai.ChatCompletion.create')
+  def testNoRetry(self, create):
+    create.side_effect = openai.error.InvalidRequestError("too long", None)
+    with unittest.mock.patch.object(doc_gen.time, 'sleep', self.fake_sleep):
+      response = doc_gen.run_completion("A prompt", "Some text", -1, 0,
+                                        use_cache=False)
+    self.assertEqual(response.text, '')
+    self.assertEqual(create.call_count, 1)
+    self.assertEqual(self.sleeps, [])
+
+
+def stream_chunks(words):
+  for word in words:
+    yield { 'choices': [ { 'delta': { 'content': word },
+                           'finish_reason': None } ] }
+  yield { 'choices': [ { 'delta': {}, 'finish_reason': 'stop' } ] }
+
+
+class StreamingCompletionTestCase(unittest.TestCase):
+
+  def setUp(self):
+    doc_gen.FAKE_AI_COMPLETION = False
+    self.update_seconds = doc_gen.PARTIAL_UPDATE_SECONDS
+    doc_gen.PARTIAL_UPDATE_SECONDS = 0
+
+  def tearDown(self):
+    doc_gen.PARTIAL_UPDATE_SECONDS = self.update_seconds
+
+  @unittest.mock.patch('openai.ChatCompletion.create')
+  def testStream(self, create):
+    create.return_value = stream_chunks([ "one ", "two ", "three" ])
+    partials = []
+    response = doc_gen.run_completion("A prompt", "Some text", -1, 0,
+                                      use_cache=False,
+                                      partial_cb=partials.append)
+    self.assertTrue(create.call_args.kwargs['stream'])
+    self.assertEqual(response.text, "one two three")
+    self.assertEqual(partials, [ "one ", "one two ", "one two three" ])
+    self.assertEqual(response.completion_tokens, 3)
+    self.assertGreater(response.prompt_tokens, 0)
+    self.assertFalse(response.truncated)
+    self.assertFalse(response.canceled)
+
+  @unittest.mock.patch('openai.ChatCompletion.create')
+  def testCancel(self, create):
+    stream = stream_chunks([ "one ", "two ", "three" ])
+    create.return_value = stream
+    cancel = threading.Event()
+    def partial_cb(text):
+      cancel.set()
+    response = doc_gen.run_completion("A prompt", "Some text", -1, 0,
+                                      use_cache=False,
+                                      partial_cb=partial_cb, cancel=cancel)
+    self.assertTrue(response.canceled)
+    self.assertEqual(response.text, "one ")
+    # The stream was closed
+    self.assertEqual(list(stream), [])
+
+
 class BasicDocGenTestCase(unittest.TestCase):
 
   def setUp(self):
@@ -127,6 +312,25 @@ class BasicDocGenTestCase(unittest.TestCase):
     self.assertTrue(len(completion.text()) < 1000)
     self.assertFalse(self.document.is_running())
 
+  def testOlderRun(self):
+    # A run queued before a newer run of the document was started
+    run_state = doc_gen.start_docgen(self.doc_path,
+                                     self.document,
+                                     "A prompt")
+    newer = doc_gen.start_docgen(self.doc_path,
+                                 self.document,
+                                 "Another prompt")
+    doc_gen.run_all_docgen(self.doc_path, self.document, run_state)
+
+    run_record = self.document.get_run_record(run_state.run_id)
+    self.assertIsNotNone(run_record.stop_time)
+    self.assertNotEqual(run_record.result_id, 0)
+    self.assertEqual(self.document.get_status_message(run_state.run_id), "")
+    newer_record = self.document.get_run_record(newer.run_id)
+    self.assertIsNone(newer_record.stop_time)
+    self.assertEqual(len(newer_record.completions), 0)
+    self.assertEqual(newer_record.completed_steps, 0)
+
   def testFullTransOpRun(self):
     run_state = doc_gen.start_docgen(self.doc_path,
                                      self.document,
@@ -140,3 +344,241 @@ class BasicDocGenTestCase(unittest.TestCase):
     self.assertIsNotNone(completion)
     self.assertTrue(len(completion.text()) > 1000)
     self.assertFalse(self.document.is_running())
+
+  def testParallelRun(self):
+    # Serial run for reference
+    run_state = doc_gen.start_docgen(self.doc_path,
+                                     self.document,
+                                     "A prompt")
+    doc_gen.run_all_docgen(self.doc_path, self.document, run_state)
+    serial = [ x.input_ids for x in
+               self.document.get_completion_list(run_state.run_id) ]
+
+    run_state = doc_gen.start_docgen(self.doc_path,
+                                     self.document,
+                                     "A prompt")
+    run_state.max_workers = 4
+    doc_gen.run_all_docgen(self.doc_path, self.document, run_state)
+    parallel = [ x.input_ids for x in
+                 self.document.get_completion_list(run_state.run_id) ]
+    self.assertEqual(serial, parallel)
+    self.assertIsNotNone(self.document.get_result_item(run_state.run_id))
+    self.assertFalse(self.document.is_running())
+
+
+def long_completion(prompt, text, max_tokens, timeout_value, status_cb=None,
+                    use_cache=True, partial_cb=None, cancel=None,
+                    text_tokens=None):
+  """
+  Stand in for run_completion that returns about 1000 tokens and
+  takes a random amount of time.
+  """
+  time.sleep(random.random() * 0.01)
+  return doc_gen.ResponseRecord("word " * 1000, 100, 1000, False, 0)
+
+
+class PipelineDocGenTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.user_dir = tempfile.TemporaryDirectory()
+    self.doc_path = os.path.join(self.user_dir.name, 'test.daf')
+    self.document = document.Document()
+    self.document.doc_text = "Document test"
+    document.save_document(self.doc_path, self.document)
+
+  def tearDown(self):
+    self.user_dir.cleanup()
+
+  def start_run(self, segments=12):
+    run_state = doc_gen.start_docgen(self.doc_path, self.document,
+                                     "A prompt")
+    run_record = self.document.get_current_run_record()
+    for i in range(0, segments):
+      segment = run_record.add_new_segment("text " * 900, 900)
+      run_state.to_run.append(segment.id())
+      run_state.source_items.append(segment.id())
+    return run_state
+
+  def leaf_sets(self, run_id):
+    # Describe the tree by the segments below each completion
+    def leaves(item):
+      if item.is_doc_segment():
+        return [ item.id() ]
+      result = []
+      for id in item.input_ids:
+        result.extend(leaves(self.document.get_item_by_id(run_id, id)))
+      return result
+    return sorted([ tuple(sorted(leaves(x))) for x in
+                    self.document.get_completion_list(run_id) ])
+
+  @unittest.mock.patch.object(doc_gen, 'run_completion', long_completion)
+  def testPipelineMatchesRounds(self):
+    run_state = self.start_run()
+    doc_gen.run_all_docgen(self.doc_path, self.document, run_state)
+    rounds = self.leaf_sets(run_state.run_id)
+
+    run_state = self.start_run()
+    run_state.max_workers = 4
+    run_state.pipeline = True
+    result_id = doc_gen.run_all_docgen(self.doc_path, self.document,
+                                       run_state)
+    self.assertIsNotNone(result_id)
+    self.assertEqual(rounds, self.leaf_sets(run_state.run_id))
+    self.assertFalse(self.document.is_running())
+
+    # Every item appears once in the family of the final result
+    (depth, entries) = self.document.get_completion_family(run_state.run_id)
+    self.assertEqual(depth, 4)
+    ids = [ x[1].id() for x in entries ]
+    self.assertEqual(len(ids), len(set(ids)))
+    self.assertEqual(entries[0][1].id(), result_id)
+
+  @unittest.mock.patch.object(doc_gen, 'run_completion', long_completion)
+  def testLeftoverResult(self):
+    # A single intermediate result is left at the end of a level
+    counts = []
+    for (workers, pipeline) in [ (1, False), (4, False), (4, True) ]:
+      run_state = self.start_run(10)
+      run_state.max_workers = workers
+      run_state.pipeline = pipeline
+      doc_gen.run_all_docgen(self.doc_path, self.document, run_state)
+      counts.append(len(self.document.get_completion_list(run_state.run_id)))
+    self.assertEqual(counts, [ 6, 6, 6 ])
+
+  def testStatusSaves(self):
+    # Status updates from running completions do not each save
+    def busy_completion(*args, **kwargs):
+      for i in range(50):
+        args[4]("rate_limit error")
+      return long_completion(*args, **kwargs)
+
+    for pipeline in [ False, True ]:
+      run_state = self.start_run()
+      run_state.max_workers = 4
+      run_state.pipeline = pipeline
+      with unittest.mock.patch.object(doc_gen, 'run_completion',
+                                      busy_completion):
+        with unittest.mock.patch.object(document, 'save_document',
+                                        wraps=document.save_document) as save:
+          result_id = doc_gen.run_all_docgen(self.doc_path, self.document,
+                                             run_state)
+      self.assertIsNotNone(result_id)
+      self.assertLess(save.call_count, 100)
+
+
+class FailingCompletion:
+  """
+  Stand in for run_completion that fails after a number of calls,
+  as if the process was stopped.
+  """
+  def __init__(self, count):
+    self.count = count
+    self.calls = 0
+
+  def __call__(self, *args, **kwargs):
+    self.calls += 1
+    if self.calls > self.count:
+      raise RuntimeError("interrupted")
+    return long_completion(*args, **kwargs)
+
+
+class ResumeDocGenTestCase(PipelineDocGenTestCase):
+
+  def interrupt_and_resume(self, run_state, count=5):
+    failing = FailingCompletion(count)
+    with unittest.mock.patch.object(doc_gen, 'run_completion', failing):
+      with self.assertRaises(RuntimeError):
+        doc_gen.run_all_docgen(self.doc_path, self.document, run_state)
+
+    # Continue from what was saved
+    self.document = document.load_document(self.doc_path)
+    done = len(self.document.get_completion_list(run_state.run_id))
+    self.assertGreater(done, 0)
+    # As if the lease of the job running the run expired
+    self.document.get_run_record(run_state.run_id).lease_expires = 0
+    self.assertTrue(self.document.can_resume_run(run_state.run_id))
+    run_state = doc_gen.load_run_state(self.document, run_state.run_id)
+    self.assertEqual(len(run_state.completed_run),
+                     len(set(run_state.completed_run)))
+
+    resumed = FailingCompletion(100)
+    with unittest.mock.patch.object(doc_gen, 'run_completion', resumed):
+      result_id = doc_gen.run_all_docgen(self.doc_path, self.document,
+                                         run_state)
+    self.assertIsNotNone(result_id)
+    self.assertFalse(self.document.can_resume_run(run_state.run_id))
+    self.assertIsNone(self.document.get_run_checkpoint(run_state.run_id))
+
+    # Recorded completions were not run again
+    total = len(self.document.get_completion_list(run_state.run_id))
+    self.assertEqual(total, done + resumed.calls)
+    return run_state.run_id
+
+  @unittest.mock.patch.object(doc_gen, 'run_completion', long_completion)
+  def testResumeRounds(self):
+    run_state = self.start_run()
+    doc_gen.run_all_docgen(self.doc_path, self.document, run_state)
+    rounds = self.leaf_sets(run_state.run_id)
+
+    run_state = self.start_run()
+    run_state.max_workers = 4
+    run_id = self.interrupt_and_resume(run_state)
+    self.assertEqual(rounds, self.leaf_sets(run_id))
+
+  @unittest.mock.patch.object(doc_gen, 'run_completion', long_completion)
+  def testResumePipeline(self):
+    run_state = self.start_run()
+    doc_gen.run_all_docgen(self.doc_path, self.document, run_state)
+    rounds = self.leaf_sets(run_state.run_id)
+
+    run_state = self.start_run()
+    run_state.max_workers = 4
+    run_state.pipeline = True
+    run_id = self.interrupt_and_resume(run_state)
+    self.assertEqual(rounds, self.leaf_sets(run_id))
+
+  @unittest.mock.patch.object(doc_gen, 'run_completion', long_completion)
+  def testResumePassThrough(self):
+    # The checkpoint is saved after a level with an item passed
+    # through from the level below
+    run_state = self.start_run(28)
+    doc_gen.run_all_docgen(self.doc_path, self.document, run_state)
+    rounds = self.leaf_sets(run_state.run_id)
+
+    run_state = self.start_run(28)
+    run_state.max_workers = 1
+    run_state.pipeline = True
+    run_id = self.interrupt_and_resume(run_state, 14)
+    self.assertEqual(rounds, self.leaf_sets(run_id))
+
+
+class CancelDocGenTestCase(PipelineDocGenTestCase):
+
+  def run_canceled(self, run_state):
+    calls = []
+    def cancel_completion(*args, **kwargs):
+      calls.append(1)
+      if len(calls) == 3:
+        run_state.cancel.set()
+      return long_completion(*args, **kwargs)
+
+    with unittest.mock.patch.object(doc_gen, 'run_completion',
+                                    cancel_completion):
+      result_id = doc_gen.run_all_docgen(self.doc_path, self.document,
+                                         run_state)
+    self.assertIsNone(result_id)
+    self.assertLess(len(calls), 12)
+    doc = document.load_document(self.doc_path)
+    self.assertFalse(doc.is_running(run_state.run_id))
+    self.assertFalse(doc.can_resume_run(run_state.run_id))
+    self.assertEqual(doc.get_status_message(run_state.run_id),
+                     "Run canceled.")
+
+  def testCancelSerial(self):
+    self.run_canceled(self.start_run())
+
+  def testCancelPipeline(self):
+    run_state = self.start_run()
+    run_state.max_workers = 2
+    run_state.pipeline = True
+    self.run_canceled(run_state)
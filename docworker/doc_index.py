@@ -0,0 +1,259 @@
+"""
+Index of the documents of a user.
+
+Each user directory has a SQLite file with a row for each document:
+the name, md5 digest of the original file, size, token count, number
+of runs and time of last change. Saving a document updates its row,
+so finding a duplicate upload or listing documents does not load any
+document. Documents kept in SQLite have their rows in the same file,
+see doc_store.
+
+Document files changed without a save, such as copied samples, are
+found by comparing the size and mtime of each file with its row, and
+only those are read, from the header of the file when it has one.
+"""
+import collections
+import datetime
+import logging
+import os
+import sqlite3
+
+# File in the user directory holding the index
+INDEX_FILE = 'documents.sqlite'
+
+DOC_EXT = '.daf'
+
+# Changes appended to a document file, see document.save_document
+JOURNAL_EXT = '.jnl'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS doc (
+  name TEXT PRIMARY KEY,
+  md5_digest BLOB,
+  size INTEGER,
+  doc_tokens INTEGER,
+  run_count INTEGER,
+  mtime REAL
+);
+CREATE INDEX IF NOT EXISTS doc_digest ON doc (md5_digest);
+CREATE TABLE IF NOT EXISTS stored_doc (
+  name TEXT PRIMARY KEY,
+  journal_id TEXT,
+  state BLOB,
+  doc_text TEXT
+);
+CREATE TABLE IF NOT EXISTS stored_run (
+  name TEXT NOT NULL,
+  run_id INTEGER NOT NULL,
+  state BLOB,
+  PRIMARY KEY (name, run_id)
+);
+CREATE TABLE IF NOT EXISTS stored_item (
+  name TEXT NOT NULL,
+  run_id INTEGER NOT NULL,
+  id INTEGER NOT NULL,
+  kind INTEGER,
+  item_name TEXT,
+  token_count INTEGER,
+  state BLOB,
+  PRIMARY KEY (name, run_id, id)
+);
+CREATE TABLE IF NOT EXISTS stored_text (
+  name TEXT NOT NULL,
+  run_id INTEGER NOT NULL,
+  id INTEGER NOT NULL,
+  text TEXT,
+  PRIMARY KEY (name, run_id, id)
+);
+CREATE TABLE IF NOT EXISTS stored_blob (
+  name TEXT NOT NULL,
+  digest BLOB NOT NULL,
+  text TEXT,
+  PRIMARY KEY (name, digest)
+);
+"""
+
+# Tables of the documents kept in SQLite
+STORED_TABLES = ( 'stored_doc', 'stored_run', 'stored_item', 'stored_text',
+                  'stored_blob' )
+
+# Orders of the document list
+SORT_ORDERS = {
+  'name': 'name',
+  'modified': 'mtime DESC, name',
+  'size': 'size DESC, name',
+  'tokens': 'doc_tokens DESC, name',
+}
+
+DocInfo = collections.namedtuple(
+  'DocInfo', [ 'name', 'md5_digest', 'size', 'doc_tokens', 'run_count',
+               'mtime' ])
+
+# What the index keeps of a document
+Summary = collections.namedtuple(
+  'Summary', [ 'md5_digest', 'doc_tokens', 'run_count' ])
+
+
+def summarize(document):
+  return Summary(document.md5_digest, document.get_doc_token_count(),
+                 len(document.run_list))
+
+
+def modified(info):
+  """
+  Return the time a document was last changed, without microseconds.
+  """
+  return datetime.datetime.fromtimestamp(int(info.mtime)).isoformat(sep=' ')
+
+
+# Index files this process has created the schema of
+READY = set()
+
+
+def connect(user_dir):
+  path = os.path.join(user_dir, INDEX_FILE)
+  exists = os.path.exists(path)
+  db = sqlite3.connect(path, timeout=30, isolation_level=None)
+  if not exists or path not in READY:
+    # Text of documents kept in SQLite is read while a save is running.
+    # The journal mode is kept in the file.
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    READY.add(path)
+  return db
+
+
+def doc_name(file_path):
+  """
+  Return the name of the document saved in a file, None if the file
+  is not a document.
+  """
+  file_name = os.path.basename(file_path)
+  if not file_name.endswith(DOC_EXT):
+    return None
+  return file_name[:-len(DOC_EXT)]
+
+
+def file_stat(file_path):
+  """
+  Return (size, mtime) of a document file and its journal.
+  """
+  stat = os.stat(file_path)
+  try:
+    journal = os.stat(file_path + JOURNAL_EXT)
+  except FileNotFoundError:
+    return (stat.st_size, stat.st_mtime)
+  return (stat.st_size + journal.st_size,
+          max(stat.st_mtime, journal.st_mtime))
+
+
+def update_locked(db, file_path, summary):
+  """
+  Set the row of a document saved in file_path. Run in a transaction.
+  """
+  (size, mtime) = file_stat(file_path)
+  db.execute(
+    "INSERT OR REPLACE INTO doc (name, md5_digest, size, doc_tokens, " +
+    "run_count, mtime) VALUES (?, ?, ?, ?, ?, ?)",
+    (doc_name(file_path), summary.md5_digest, size, summary.doc_tokens,
+     summary.run_count, mtime))
+
+
+def write_document(file_path, document, write_fn):
+  """
+  Call write_fn to save document to file_path and update the index in
+  one transaction, so the index matches the saved file. write_fn is
+  given the connection to the index, None if file_path is not in a
+  user directory. Other saves wait while write_fn runs, so it should
+  only write what was prepared before.
+  """
+  user_dir = os.path.dirname(file_path)
+  if doc_name(file_path) is None:
+    write_fn(None)
+    return
+  summary = summarize(document)
+  db = connect(user_dir)
+  try:
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      write_fn(db)
+      update_locked(db, file_path, summary)
+      db.execute("COMMIT")
+    except:
+      db.execute("ROLLBACK")
+      raise
+  finally:
+    db.close()
+
+
+def sync(db, user_dir, summary_fn):
+  """
+  Update the rows of documents changed without a save, and remove the
+  rows of removed documents. summary_fn returns the Summary of the
+  document in a file.
+  """
+  rows = {}
+  for (name, size, mtime) in db.execute(
+      "SELECT name, size, mtime FROM doc").fetchall():
+    rows[name] = (size, mtime)
+
+  for entry in os.scandir(user_dir):
+    name = doc_name(entry.name)
+    if name is None or not entry.is_file():
+      continue
+    if rows.pop(name, None) == file_stat(entry.path):
+      continue
+    logging.info("index document %s", entry.path)
+    try:
+      summary = summary_fn(entry.path)
+    except Exception:
+      logging.exception("can not index %s", entry.path)
+      continue
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      update_locked(db, entry.path, summary)
+      db.execute("COMMIT")
+    except:
+      db.execute("ROLLBACK")
+      raise
+
+  for name in rows.keys():
+    db.execute("BEGIN IMMEDIATE")
+    try:
+      for table in ('doc',) + STORED_TABLES:
+        db.execute("DELETE FROM %s WHERE name = ?" % table, (name,))
+      db.execute("COMMIT")
+    except:
+      db.execute("ROLLBACK")
+      raise
+
+
+def list_docs(user_dir, summary_fn, sort='modified'):
+  """
+  Return a list of DocInfo for the documents in user_dir.
+  """
+  order = SORT_ORDERS.get(sort, SORT_ORDERS['modified'])
+  db = connect(user_dir)
+  try:
+    sync(db, user_dir, summary_fn)
+    return [ DocInfo(*row) for row in db.execute(
+      "SELECT name, md5_digest, size, doc_tokens, run_count, mtime " +
+      "FROM doc ORDER BY " + order).fetchall() ]
+  finally:
+    db.close()
+
+
+def lookup(user_dir, summary_fn, md5_digest):
+  """
+  Return the set of names of documents with md5_digest, and the set
+  of all document names.
+  """
+  db = connect(user_dir)
+  try:
+    sync(db, user_dir, summary_fn)
+    matches = db.execute("SELECT name FROM doc WHERE md5_digest = ?",
+                         (md5_digest,)).fetchall()
+    names = db.execute("SELECT name FROM doc").fetchall()
+  finally:
+    db.close()
+  return (set([ row[0] for row in matches ]), set([ row[0] for row in names ]))
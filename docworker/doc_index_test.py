@@ -0,0 +1,112 @@
+from . import doc_index
+from . import document
+import unittest
+import tempfile
+import shutil
+import os
+
+
+class DocIndexTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.user_dir = tempfile.TemporaryDirectory()
+    self.loads = 0
+
+  def tearDown(self):
+    self.user_dir.cleanup()
+
+  def load(self, path):
+    self.loads += 1
+    return document.read_summary(path)
+
+  def sample_path(self, filename):
+    return os.path.join(os.path.dirname(__file__), 'samples/', filename)
+
+  def testSaveAndList(self):
+    doc = document.Document()
+    doc.doc_name = 'doc1'
+    doc.doc_text = 'Some text'
+    doc.md5_digest = b'1234'
+    document.save_document(os.path.join(self.user_dir.name, 'doc1.daf'), doc)
+
+    docs = doc_index.list_docs(self.user_dir.name, self.load)
+    self.assertEqual(self.loads, 0)
+    self.assertEqual(len(docs), 1)
+    self.assertEqual(docs[0].name, 'doc1')
+    self.assertEqual(docs[0].md5_digest, b'1234')
+    self.assertEqual(docs[0].run_count, 0)
+    self.assertGreater(docs[0].size, 0)
+    self.assertEqual(doc_index.lookup(self.user_dir.name, self.load, b'1234'),
+                     ({ 'doc1' }, { 'doc1' }))
+
+    doc.new_run_record(1, document.OP_TYPE_CONSOLIDATE)
+    document.save_document(os.path.join(self.user_dir.name, 'doc1.daf'), doc)
+    docs = doc_index.list_docs(self.user_dir.name, self.load)
+    self.assertEqual(docs[0].run_count, 1)
+    self.assertEqual(self.loads, 0)
+
+  def testSync(self):
+    # Copied files are loaded once
+    shutil.copyfile(self.sample_path('PA_utility.docx.daf'),
+                    os.path.join(self.user_dir.name, 'PA_utility.docx.daf'))
+    shutil.copyfile(self.sample_path('groff-dejoy.pdf.daf'),
+                    os.path.join(self.user_dir.name, 'groff-dejoy.pdf.daf'))
+    docs = doc_index.list_docs(self.user_dir.name, self.load, 'name')
+    self.assertEqual([ info.name for info in docs ],
+                     [ 'PA_utility.docx', 'groff-dejoy.pdf' ])
+    self.assertGreater(docs[0].doc_tokens, 0)
+    self.assertEqual(self.loads, 2)
+    doc_index.list_docs(self.user_dir.name, self.load)
+    self.assertEqual(self.loads, 2)
+
+    # Removed files are dropped
+    os.remove(os.path.join(self.user_dir.name, 'groff-dejoy.pdf.daf'))
+    docs = doc_index.list_docs(self.user_dir.name, self.load)
+    self.assertEqual([ info.name for info in docs ], [ 'PA_utility.docx' ])
+
+  def testSchema(self):
+    doc = document.Document()
+    doc.doc_name = 'doc1'
+    doc.doc_text = 'Some text'
+    file_name = os.path.join(self.user_dir.name, 'doc1.daf')
+    document.save_document(file_name, doc)
+    path = os.path.join(self.user_dir.name, doc_index.INDEX_FILE)
+    self.assertIn(path, doc_index.READY)
+
+    # A removed index is created again
+    os.remove(path)
+    document.save_document(file_name, doc)
+    docs = doc_index.list_docs(self.user_dir.name, self.load)
+    self.assertEqual([ info.name for info in docs ], [ 'doc1' ])
+
+  def testPrepare(self):
+    doc = document.Document()
+    doc.doc_name = 'doc1'
+    doc.doc_text = 'Some text'
+    doc._journal = document.Journal(None)
+    file_name = os.path.join(self.user_dir.name, 'doc1.daf')
+
+    # The document is pickled while another save holds the index
+    db = doc_index.connect(self.user_dir.name)
+    db.execute("BEGIN IMMEDIATE")
+    write_fn = document.prepare_base(file_name, doc)
+    self.assertFalse(os.path.exists(file_name))
+    db.execute("COMMIT")
+    db.close()
+    doc_index.write_document(file_name, doc, write_fn)
+    self.assertEqual(document.load_document(file_name).doc_text, 'Some text')
+
+  def testFindOrCreate(self):
+    filename = 'PA utility.docx'
+    with open(self.sample_path(filename), 'rb') as f:
+      name1 = document.find_or_create_doc(self.user_dir.name, filename, f)
+    # A different file with the same name gets a new name
+    with open(self.sample_path('PA Agenda.docx'), 'rb') as f:
+      name2 = document.find_or_create_doc(self.user_dir.name, filename, f)
+    self.assertEqual(name2, filename + '(1)')
+    with open(self.sample_path('PA Agenda.docx'), 'rb') as f:
+      name3 = document.find_or_create_doc(self.user_dir.name, filename, f)
+    self.assertEqual(name2, name3)
+    with open(self.sample_path(filename), 'rb') as f:
+      name4 = document.find_or_create_doc(self.user_dir.name, filename, f)
+    self.assertEqual(name1, name4)
@@ -0,0 +1,363 @@
+"""
+Documents kept in SQLite tables instead of a pickle file.
+
+The state of a document, of each of its runs, and the text records
+of the runs are rows in the index file of the user directory, see
+doc_index. Loading a document reads the state of the document and
+its runs and the names and token counts of the text records. The
+text of a record, and the text of the document, is read when it is
+used, so a page reads only the text it shows.
+
+Long text is kept once for each document in stored_blob, by its
+digest, however many records have it.
+
+The document file holds a short stub, so the files of a user
+directory still name its documents.
+
+Convert the documents of user directories with:
+
+  python3 -m docworker.doc_store --to sqlite dir ...
+"""
+import argparse
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from . import doc_index
+from . import document
+
+# Ways to keep a document, see document.STORAGE
+PICKLE = 'pickle'
+SQLITE = 'sqlite'
+STORAGES = ( PICKLE, SQLITE )
+
+# Start of the file of a document kept in SQLite
+MAGIC = b'DAFSQL\n'
+
+# Kinds of stored_item rows
+SEGMENT = 0
+COMPLETION = 1
+
+
+class StoreError(Exception):
+  pass
+
+
+def is_stub(file_name):
+  """
+  True if the document file is the stub of a document kept in SQLite.
+  """
+  with open(file_name, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+
+def db_path(file_name):
+  return os.path.join(os.path.dirname(file_name), doc_index.INDEX_FILE)
+
+
+class Reader:
+  """
+  Connection used to read the text of a loaded document, shared by
+  the threads using the document.
+  """
+  def __init__(self, db):
+    self.db = db
+    self.lock = threading.Lock()
+
+  def read(self, query, args):
+    with self.lock:
+      row = self.db.execute(query, args).fetchone()
+    return None if row is None else row[0]
+
+
+class TextSource:
+  """
+  Reads the text of the records of a run when it is used.
+  """
+  def __init__(self, reader, name, run_id):
+    self.reader = reader
+    self.name = name
+    self.run_id = run_id
+
+  def load(self, id):
+    return self.reader.read("SELECT text FROM stored_text " +
+                            "WHERE name = ? AND run_id = ? AND id = ?",
+                            (self.name, self.run_id, id))
+
+
+class DocTextSource:
+  """
+  Reads the text of a document when it is used.
+  """
+  def __init__(self, reader, name):
+    self.reader = reader
+    self.name = name
+
+  def load(self):
+    return self.reader.read("SELECT doc_text FROM stored_doc WHERE name = ?",
+                            (self.name,))
+
+
+class BlobSource:
+  """
+  Reads text kept in stored_blob when it is used.
+  """
+  def __init__(self, reader, name, digest):
+    self.reader = reader
+    self.name = name
+    self.digest = digest
+
+  def load(self, id=None):
+    return self.reader.read("SELECT text FROM stored_blob " +
+                            "WHERE name = ? AND digest = ?",
+                            (self.name, self.digest))
+
+
+def item_text(item):
+  """
+  Return (text, digest) to keep for an item. The digest is None if
+  the text is kept with the item.
+  """
+  source = item.text_record._source
+  if isinstance(source, document.TextSpan):
+    return (None, None)
+  # Reading the text of a lazily loaded record may query the index
+  text = item.text()
+  if text is None or len(text) < document.COMPRESS_MIN_CHARS:
+    return (text, None)
+  digest = getattr(source, 'digest', None)
+  if digest is None:
+    digest = document.text_digest(text)
+  return (text, digest)
+
+
+def item_state(item, digest):
+  state = { key: value for (key, value) in item.__dict__.items()
+            if key != 'text_record' }
+  span = item.text_record._source
+  if isinstance(span, document.TextSpan):
+    state['_span'] = (span.offset, span.length)
+  if digest is not None:
+    state['_blob'] = digest
+  # Segments have no state
+  if len(state) == 0:
+    return None
+  return pickle.dumps(state)
+
+
+def item_rows(name, run_id, kind, items):
+  rows = []
+  for item in items:
+    (text, digest) = item_text(item)
+    rows.append((name, run_id, item.id(), kind, item.name(),
+                 item.token_count(), item_state(item, digest), text, digest))
+  return rows
+
+
+def insert_items(db, rows):
+  # The text is apart, so loading the items does not read it
+  db.executemany(
+    "INSERT OR IGNORE INTO stored_item (name, run_id, id, kind, item_name, " +
+    "token_count, state) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    [ row[:7] for row in rows ])
+  db.executemany(
+    "INSERT OR IGNORE INTO stored_text (name, run_id, id, text) " +
+    "VALUES (?, ?, ?, ?)", [ row[:3] + row[7:8] for row in rows
+                             if row[8] is None ])
+  # Text kept once for the document
+  db.executemany(
+    "INSERT OR IGNORE INTO stored_blob (name, digest, text) " +
+    "VALUES (?, ?, ?)", [ (row[0], row[8], row[7]) for row in rows
+                          if row[8] is not None ])
+
+
+def insert_run(db, name, run_id, state):
+  # Keep the rowid, which orders the runs
+  db.execute(
+    "INSERT INTO stored_run (name, run_id, state) VALUES (?, ?, ?) " +
+    "ON CONFLICT (name, run_id) DO UPDATE SET state = excluded.state",
+    (name, run_id, state))
+
+
+def delete_rows(db, name):
+  for table in doc_index.STORED_TABLES:
+    db.execute("DELETE FROM %s WHERE name = ?" % table, (name,))
+
+
+def prepare_document(file_name, doc):
+  """
+  Make the rows of a document, and return the function that replaces
+  the rows and writes the stub in the transaction of
+  doc_index.write_document.
+  """
+  name = doc_index.doc_name(file_name)
+  # Read all text before the old rows are removed
+  doc_text = doc.get_loaded_text()
+  state = document.doc_state(doc)
+  journal_id = doc.journal_id
+  runs = []
+  items = []
+  for run_record in doc.run_list:
+    runs.append((run_record.run_id, document.run_state(run_record)))
+    items.extend(item_rows(name, run_record.run_id, SEGMENT,
+                           run_record.doc_segments))
+    items.extend(item_rows(name, run_record.run_id, COMPLETION,
+                           run_record.completions))
+
+  def write(db):
+    delete_rows(db, name)
+    db.execute("INSERT INTO stored_doc (name, journal_id, state, " +
+               "doc_text) VALUES (?, ?, ?, ?)",
+               (name, journal_id, state, doc_text))
+    for (run_id, data) in runs:
+      insert_run(db, name, run_id, data)
+    insert_items(db, items)
+
+    with open(file_name + '.tmp', 'wb') as f:
+      f.write(MAGIC + journal_id.encode('utf-8') + b'\n')
+    os.replace(file_name + '.tmp', file_name)
+  return write
+
+
+def prepare_changes(file_name, records):
+  """
+  Make the rows of the changes found by document.Journal.changes, and
+  return the function that writes them in the transaction of
+  doc_index.write_document.
+  """
+  name = doc_index.doc_name(file_name)
+  changes = []
+  for record in records:
+    if record[0] == 'items':
+      changes.append(('items',
+                      item_rows(name, record[1], SEGMENT, record[2]) +
+                      item_rows(name, record[1], COMPLETION, record[3])))
+    else:
+      changes.append(record)
+
+  def write(db):
+    for change in changes:
+      if change[0] == 'doc':
+        db.execute("UPDATE stored_doc SET state = ? WHERE name = ?",
+                   (change[1], name))
+      elif change[0] == 'run':
+        insert_run(db, name, change[1], change[2])
+      elif change[0] == 'items':
+        insert_items(db, change[1])
+    # Mark the change for doc_index.sync and doc_cache. File times may
+    # be coarser than the time between saves, so always move forward.
+    mtime = max(time.time_ns(), os.stat(file_name).st_mtime_ns + 1)
+    os.utime(file_name, ns=(mtime, mtime))
+  return write
+
+
+def load_document(file_name):
+  """
+  Load a document kept in SQLite, without the text of the document or
+  of its text records.
+  """
+  name = doc_index.doc_name(file_name)
+  path = db_path(file_name)
+  # Kept open to read text
+  db = sqlite3.connect(path, timeout=30, isolation_level=None,
+                       check_same_thread=False)
+  reader = Reader(db)
+  try:
+    # Read the rows of one save
+    db.execute("BEGIN")
+    row = db.execute("SELECT journal_id, state FROM stored_doc " +
+                     "WHERE name = ?", (name,)).fetchone()
+    if row is None:
+      raise StoreError("%s is not in %s" % (name, path))
+    doc = document.Document.__new__(document.Document)
+    doc.__dict__.update(pickle.loads(row[1]))
+    doc.journal_id = row[0]
+    doc.doc_text = None
+    doc.run_list = []
+    doc._text_source = DocTextSource(reader, name)
+    # digest: BlobSource shared by the records with the text
+    blobs = {}
+
+    runs = {}
+    for (run_id, state) in db.execute(
+        "SELECT run_id, state FROM stored_run WHERE name = ? ORDER BY rowid",
+        (name,)).fetchall():
+      run_record = document.RunRecord.__new__(document.RunRecord)
+      run_record.__dict__.update(pickle.loads(state))
+      run_record.text_records = {}
+      run_record.doc_segments = []
+      run_record.completions = []
+      run_record.lease_expires = None
+      doc.run_list.append(run_record)
+      runs[run_id] = (run_record, TextSource(reader, name, run_id))
+
+    for (run_id, id, kind, item_name, token_count, state) in db.execute(
+        "SELECT run_id, id, kind, item_name, token_count, state " +
+        "FROM stored_item WHERE name = ? ORDER BY rowid", (name,)).fetchall():
+      (run_record, source) = runs[run_id]
+      text_record = document.TextRecord(id, item_name, None, token_count)
+      text_record._source = source
+      if kind == SEGMENT:
+        item = document.Segment.__new__(document.Segment)
+        items = run_record.doc_segments
+      else:
+        item = document.Completion.__new__(document.Completion)
+        items = run_record.completions
+      if state is not None:
+        state = pickle.loads(state)
+        span = state.pop('_span', None)
+        if span is not None:
+          # Linked to the source text by document.load_document
+          text_record._source = document.TextSpan(*span)
+        digest = state.pop('_blob', None)
+        if digest is not None:
+          if digest not in blobs:
+            blobs[digest] = BlobSource(reader, name, digest)
+          text_record._source = blobs[digest]
+        item.__dict__.update(state)
+      item.text_record = text_record
+      run_record.text_records[id] = text_record
+      items.append(item)
+  finally:
+    db.execute("COMMIT")
+  return doc
+
+
+def convert_dir(user_dir, storage):
+  """
+  Rewrite the documents of a directory that are not kept as storage.
+  Returns the number of documents converted.
+  """
+  count = 0
+  for file_name in sorted(os.listdir(user_dir)):
+    if doc_index.doc_name(file_name) is None:
+      continue
+    file_path = os.path.join(user_dir, file_name)
+    if is_stub(file_path) == (storage == SQLITE):
+      continue
+    start = time.time()
+    document.compact_document(file_path, storage)
+    logging.info("converted %s in %.3fs", file_path, time.time() - start)
+    count += 1
+  return count
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description='Convert the documents of user directories')
+  parser.add_argument('--to', choices=STORAGES, default=SQLITE,
+                      help='how to keep the documents')
+  parser.add_argument('dirs', nargs='+', help='user directories')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.INFO)
+
+  for user_dir in args.dirs:
+    count = convert_dir(user_dir, args.to)
+    print("%s: converted %d documents" % (user_dir, count))
+
+
+if __name__ == '__main__':
+  main()
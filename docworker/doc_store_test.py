@@ -0,0 +1,162 @@
+from . import doc_index
+from . import doc_store
+from . import document
+import unittest
+import tempfile
+import shutil
+import pickle
+import os
+
+
+class DocStoreTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.user_dir = tempfile.TemporaryDirectory()
+    self.doc_file = os.path.join(self.user_dir.name, 'doc.daf')
+    document.STORAGE = doc_store.SQLITE
+
+  def tearDown(self):
+    document.STORAGE = doc_store.PICKLE
+    self.user_dir.cleanup()
+
+  def sample_path(self, filename):
+    return os.path.join(os.path.dirname(__file__), 'samples/', filename)
+
+  def make_doc(self):
+    doc = document.Document()
+    doc.doc_name = 'doc'
+    doc.doc_text = 'Some text of the document.'
+    doc.md5_digest = b'1234'
+    run_record = doc.new_run_record(doc.prompts.get_prompt_id("prompt"),
+                                    document.OP_TYPE_CONSOLIDATE)
+    completion = run_record.add_new_completion([ 1 ], "completion", 5, 10)
+    run_record.result_id = completion.id()
+    return (doc, run_record)
+
+  def testSaveAndLoad(self):
+    (doc, run_record) = self.make_doc()
+    document.save_document(self.doc_file, doc)
+    self.assertTrue(doc_store.is_stub(self.doc_file))
+
+    doc2 = document.load_document(self.doc_file)
+    # Text is read when used
+    self.assertIsNone(doc2.doc_text)
+    run_record2 = doc2.get_run_record(run_record.run_id)
+    completion = run_record2.completions[0]
+    self.assertIsNone(completion.text_record._text)
+    self.assertEqual(completion.text(), "completion")
+    self.assertTrue(completion.is_final_result())
+    self.assertEqual(doc2.get_doc_text(), doc.doc_text)
+    self.assertEqual([ item.name() for item in run_record2.doc_segments ],
+                     [ item.name() for item in run_record.doc_segments ])
+    self.assertEqual(run_record2.get_src_text(), run_record.get_src_text())
+    self.assertEqual(doc2.prompts.get_prompt_id("prompt"),
+                     doc.prompts.get_prompt_id("prompt"))
+
+    # Changes are saved as rows
+    doc2.set_status_message("status", run_record.run_id)
+    run_record2.add_new_completion([ 1 ], "another", 5, 10)
+    stub = os.stat(self.doc_file)
+    document.save_document(self.doc_file, doc2)
+    self.assertEqual(os.stat(self.doc_file).st_ino, stub.st_ino)
+    doc3 = document.load_document(self.doc_file)
+    run_record3 = doc3.get_run_record(run_record.run_id)
+    self.assertEqual(doc3.get_status_message(run_record.run_id), "status")
+    self.assertEqual([ item.text() for item in run_record3.completions ],
+                     [ "completion", "another" ])
+    self.assertEqual(run_record3.next_text_id, run_record2.next_text_id)
+
+    # The index follows the saves
+    docs = doc_index.list_docs(self.user_dir.name, document.read_summary)
+    self.assertEqual([ (info.name, info.run_count) for info in docs ],
+                     [ ('doc', 1) ])
+
+    # A pickle holds the text
+    doc4 = pickle.loads(pickle.dumps(doc3))
+    self.assertEqual(doc4.doc_text, doc.doc_text)
+    self.assertEqual(doc4.get_run_record(run_record.run_id).
+                     completions[1].text(), "another")
+
+  def testSharedText(self):
+    (doc, run_record) = self.make_doc()
+    text = "Long completion text. " * 20
+    run_record.add_new_completion([ 1 ], text, 5, 10)
+    document.save_document(self.doc_file, doc)
+    doc2 = document.load_document(self.doc_file)
+    doc2.get_run_record(run_record.run_id).add_new_completion(
+      [ 1 ], text, 5, 10)
+    document.save_document(self.doc_file, doc2)
+
+    # Kept once, read by both records
+    db = doc_index.connect(self.user_dir.name)
+    try:
+      self.assertEqual(
+        db.execute("SELECT COUNT(*) FROM stored_blob").fetchone()[0], 1)
+    finally:
+      db.close()
+    doc3 = document.load_document(self.doc_file)
+    self.assertEqual([ item.text() for item in
+                       doc3.get_run_record(run_record.run_id).completions ],
+                     [ "completion", text, text ])
+    document.compact_document(self.doc_file, doc_store.PICKLE)
+    doc4 = document.load_document(self.doc_file)
+    completions = doc4.get_run_record(run_record.run_id).completions
+    self.assertIs(completions[1].text_record._source,
+                  completions[2].text_record._source)
+
+  def testConvert(self):
+    document.STORAGE = doc_store.PICKLE
+    shutil.copyfile(self.sample_path('PA_utility.docx.daf'),
+                    os.path.join(self.user_dir.name, 'PA_utility.docx.daf'))
+    (doc, run_record) = self.make_doc()
+    document.save_document(self.doc_file, doc)
+    pickled = [ document.load_document(self.doc_file),
+                document.load_document(
+                  os.path.join(self.user_dir.name, 'PA_utility.docx.daf')) ]
+
+    self.assertEqual(doc_store.convert_dir(self.user_dir.name,
+                                           doc_store.SQLITE), 2)
+    self.assertEqual(doc_store.convert_dir(self.user_dir.name,
+                                           doc_store.SQLITE), 0)
+    stored = [ document.load_document(self.doc_file),
+               document.load_document(
+                 os.path.join(self.user_dir.name, 'PA_utility.docx.daf')) ]
+    for (doc1, doc2) in zip(pickled, stored):
+      self.assertEqual(doc2.get_doc_text(), doc1.get_doc_text())
+      self.assertEqual(len(doc2.run_list), len(doc1.run_list))
+      for (run1, run2) in zip(doc1.run_list, doc2.run_list):
+        self.assertEqual([ item.text() for item in run2.completions ],
+                         [ item.text() for item in run1.completions ])
+
+    # And back, leaving no rows
+    self.assertEqual(doc_store.convert_dir(self.user_dir.name,
+                                           doc_store.PICKLE), 2)
+    self.assertFalse(doc_store.is_stub(self.doc_file))
+    doc3 = document.load_document(self.doc_file)
+    self.assertEqual(doc3.doc_text, doc.doc_text)
+    self.assertEqual(doc3.get_run_record(run_record.run_id).
+                     completions[0].text(), "completion")
+    db = doc_index.connect(self.user_dir.name)
+    try:
+      for table in doc_index.STORED_TABLES:
+        self.assertEqual(
+          db.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0], 0)
+    finally:
+      db.close()
+
+  def testRemoved(self):
+    (doc, run_record) = self.make_doc()
+    document.save_document(self.doc_file, doc)
+    os.remove(self.doc_file)
+    self.assertEqual(
+      doc_index.list_docs(self.user_dir.name, document.read_summary), [])
+    db = doc_index.connect(self.user_dir.name)
+    try:
+      self.assertEqual(
+        db.execute("SELECT COUNT(*) FROM stored_text").fetchone()[0], 0)
+    finally:
+      db.close()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -5,13 +5,25 @@ that document.
 from . import prompts
 from . import section_util
 from . import doc_convert
+from . import extract_store
+from . import doc_index
+from . import doc_store
+import copy
+import array
+import io
+import itertools
 import pickle
 import re
 import logging
 import datetime
+import time
 import tempfile
 import hashlib
 import os
+import threading
+import uuid
+import weakref
+import zlib
 
 
 # Types of operations supported
@@ -19,6 +31,138 @@ import os
 OP_TYPE_CONSOLIDATE=1
 OP_TYPE_TRANSFORM=2
 
+# (chunk size, overlap) of the segments of each type of operation
+CHUNK_PARAMS = {
+  OP_TYPE_CONSOLIDATE: (int(section_util.AI_MODEL_SIZE * 0.75), 0.1),
+  OP_TYPE_TRANSFORM: (int(section_util.AI_MODEL_SIZE * 0.45), 0),
+}
+
+def chunk_params(op_type):
+  if op_type == OP_TYPE_CONSOLIDATE:
+    return CHUNK_PARAMS[OP_TYPE_CONSOLIDATE]
+  return CHUNK_PARAMS[OP_TYPE_TRANSFORM]
+
+
+# Save long text compressed, read when used
+COMPRESS = True
+
+# Text shorter than this is saved as is
+COMPRESS_MIN_CHARS = 256
+
+# zlib level. Records are compressed once, when first saved.
+COMPRESS_LEVEL = 6
+
+
+class CompressedText:
+  """
+  Text of a record or document kept compressed until it is read.
+  Records with the same text share one, see get_blob.
+  """
+  # sha256 of the text, None if saved before texts were shared
+  digest = None
+
+  def __init__(self, data, digest=None):
+    self.data = data
+    self.digest = digest
+
+  def load(self, id=None):
+    return zlib.decompress(self.data).decode('utf-8')
+
+  def __reduce__(self):
+    if self.digest is None:
+      return (CompressedText, (self.data,))
+    return (load_blob, (self.data, self.digest))
+
+
+# Compressed texts in memory by digest, shared by all documents
+BLOBS = weakref.WeakValueDictionary()
+BLOBS_LOCK = threading.Lock()
+
+
+def text_digest(text):
+  return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+def load_blob(data, digest):
+  """
+  Return the shared CompressedText of a digest, kept as data if new.
+  """
+  with BLOBS_LOCK:
+    blob = BLOBS.get(digest)
+    if blob is None:
+      blob = CompressedText(data, digest)
+      BLOBS[digest] = blob
+    return blob
+
+
+def get_blob(text):
+  """
+  Return the shared CompressedText of text.
+  """
+  digest = text_digest(text)
+  with BLOBS_LOCK:
+    blob = BLOBS.get(digest)
+  if blob is not None:
+    return blob
+  return load_blob(zlib.compress(text.encode('utf-8'), COMPRESS_LEVEL),
+                   digest)
+
+
+class SourceText:
+  """
+  Cleaned text of the source of a run, as UTF-8 bytes. The segments
+  of the run are spans of it.
+  """
+  def __init__(self, read_fn):
+    self.read_fn = read_fn
+    self.lock = threading.Lock()
+    self.data = None
+
+  def get_data(self):
+    with self.lock:
+      if self.data is None:
+        text = doc_convert.clean_text(self.read_fn() or '')
+        self.data = memoryview(text.encode('utf-8'))
+      return self.data
+
+
+class TextSpan:
+  """
+  Text of a segment kept as the offset and length of its bytes in the
+  SourceText of the run, decoded each time it is read.
+  """
+  def __init__(self, offset, length, source=None):
+    self.offset = offset
+    self.length = length
+    # Set when the document is loaded, see Document.link_spans
+    self.source = source
+
+  def load(self, id=None):
+    data = self.source.get_data()[self.offset:self.offset + self.length]
+    # As tokenizer.decode of the tokens of the segment
+    return str(data, 'utf-8', 'replace').strip()
+
+  def __getstate__(self):
+    return { 'offset': self.offset, 'length': self.length, 'source': None }
+
+
+def pack_text(source, read_fn):
+  """
+  Return (text, source) to save for text with the given source, read
+  with read_fn if needed: the text, or None and a shared
+  CompressedText or a TextSpan.
+  """
+  if isinstance(source, TextSpan):
+    return (None, source)
+  if (COMPRESS and isinstance(source, CompressedText) and
+      source.digest is not None):
+    return (None, source)
+  text = read_fn()
+  if COMPRESS and text is not None and len(text) >= COMPRESS_MIN_CHARS:
+    # Pickled once however many records have the text
+    return (None, get_blob(text))
+  return (text, None)
+
 
 class TextRecord:
   """
@@ -29,8 +173,39 @@ class TextRecord:
   def __init__(self, id, name, text, token_count):
     self.id = id
     self.name = name
-    self.text = text
+    self._text = text
     self.token_count = token_count
+    # Loads the text when it is not in memory
+    self._source = None
+
+  @property
+  def text(self):
+    if isinstance(self._source, TextSpan):
+      # Not kept, so only the source text is in memory
+      return self._source.load(self.id)
+    if self._text is None and self._source is not None:
+      self._text = self._source.load(self.id)
+    return self._text
+
+  @text.setter
+  def text(self, text):
+    self._text = text
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    (state['_text'], state['_source']) = pack_text(self._source,
+                                                   lambda: self.text)
+    if state['_source'] is not None:
+      # The text does not change, compress it once
+      self._source = state['_source']
+    return state
+
+  def __setstate__(self, state):
+    # Records saved before text was loaded on demand
+    if 'text' in state:
+      state['_text'] = state.pop('text')
+    state.setdefault('_source', None)
+    self.__dict__.update(state)
   
 class Segment:
   """
@@ -73,6 +248,9 @@ class Completion:
     self.text_record = text_record
     self.token_cost = token_cost
     self.final_result = False
+    # Failed tries and seconds waited before the completion succeeded
+    self.retries = 0
+    self.retry_wait = 0
     
   def id(self):
     return self.text_record.id
@@ -113,6 +291,17 @@ class Completion:
   def is_doc_segment(self):
     return False
 
+  def copy(self):
+    completion = Completion.__new__(Completion)
+    completion.__dict__.update(self.__dict__)
+    return completion
+
+  def retry_stats(self):
+    """
+    Return (retries, seconds waited) for the completion.
+    """
+    return (getattr(self, 'retries', 0), getattr(self, 'retry_wait', 0))
+
 
 class RunRecord:
   """
@@ -139,6 +328,29 @@ class RunRecord:
     self.doc_segments = []
     self.completions = []
     self.status_message = ''
+    # Expiration of the job lease when run by a worker, None otherwise
+    self.lease_expires = None
+    # State of doc_gen.RunState to resume the run, None when complete
+    self.checkpoint = None
+    # Text received so far for a running completion
+    self.partial_text = ''
+    # Key of the SourceText the segments are spans of, see
+    # Document.get_source_text. None if segments hold their text.
+    self.segment_source = None
+
+  def copy(self):
+    """
+    Return a copy sharing the text records and doc segments, which
+    do not change.
+    """
+    run_record = RunRecord.__new__(RunRecord)
+    run_record.__dict__.update(self.__dict__)
+    run_record.text_records = dict(self.text_records)
+    run_record.doc_segments = list(self.doc_segments)
+    run_record.completions = [ item.copy() for item in self.completions ]
+    if 'checkpoint' in self.__dict__:
+      run_record.checkpoint = copy.deepcopy(self.checkpoint)
+    return run_record
 
   def get_item_by_name(self, name):
     if name is None:
@@ -173,10 +385,12 @@ class RunRecord:
     self.next_text_id += 1
     return text_record
 
-  def add_new_segment(self, text, token_count):
+  def add_new_segment(self, text, token_count, span=None):
     # name of segment is just Block 1, Block 2, Block 3, ...
     name = "Block " + str(len(self.doc_segments) + 1)
     text_record = self.new_text_record(name, text, token_count)
+    # Text is read from the span when given
+    text_record._source = span
     segment = Segment(text_record)
     self.doc_segments.append(segment)
     return segment
@@ -343,6 +557,15 @@ class RunRecord:
   def run_type_consolidate(self):
     return self.op_type == OP_TYPE_CONSOLIDATE
 
+  def get_retry_stats(self):
+    retries = 0
+    wait = 0
+    for completion in self.completions:
+      (count, seconds) = completion.retry_stats()
+      retries += count
+      wait += seconds
+    return (retries, wait)
+
   def get_completion_cost(self):
     """
     Return the total number of prompt and completion tokens
@@ -365,8 +588,47 @@ class Document:
     self.run_list = []     # List of RunRecord instances
     self.doc_name = None
     self.doc_text = None
+    # Key of the text in the extract store, if the text is kept there
+    self.text_key = None
     self.doc_tokens = 0
+    # (characters, tokens) of each page of a PDF
+    self.page_counts = []
     self.prompts = prompts.Prompts()
+    # Matches the journal of changes to the saved file
+    self.journal_id = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    # Journal state is for the loaded copy only
+    state.pop('_journal', None)
+    state.pop('_sources', None)
+    (state['doc_text'], state['_text_source']) = pack_text(
+      getattr(self, '_text_source', None), self.get_loaded_text)
+    return state
+
+  def copy(self):
+    """
+    Return a copy that may be changed and saved without changing
+    this document.
+    """
+    doc = Document.__new__(Document)
+    doc.__dict__.update(self.__dict__)
+    doc.run_list = [ run_record.copy() for run_record in self.run_list ]
+    doc.page_counts = list(self.get_page_counts())
+    doc.prompts = copy.deepcopy(self.prompts)
+    if getattr(self, '_journal', None) is not None:
+      doc._journal = self._journal.copy()
+    return doc
+
+  def get_loaded_text(self):
+    """
+    Return the text of the document if it is kept with the document,
+    loading it if it was not read with the document.
+    """
+    source = getattr(self, '_text_source', None)
+    if self.doc_text is None and source is not None:
+      return source.load()
+    return self.doc_text
 
 
   def name(self):
@@ -446,7 +708,7 @@ class Document:
   def get_src_text(self, run_id=None):
     record = self.get_run_record(run_id)    
     if run_id is None or record is None:
-      return self.doc_text
+      return self.get_doc_text()
     return record.get_src_text()
 
   def get_src_tokens(self, run_id=None):
@@ -473,6 +735,15 @@ class Document:
       return record.get_completion_cost()
     return 0
 
+  def get_retry_stats(self, run_id=None):
+    """
+    Return (retries, seconds waited) for the completions of a run.
+    """
+    record = self.get_run_record(run_id)
+    if record is not None:
+      return record.get_retry_stats()
+    return (0, 0)
+
   def get_item_by_name(self, run_id, name):
     record = self.get_run_record(run_id)
     if record is None:
@@ -511,8 +782,8 @@ class Document:
     if record is not None:
       for id in ids:
         item = record.get_item_by_id(id)
-      if item is not None:
-        items.append(item)
+        if item is not None:
+          items.append(item)
     return items
 
   def get_result_item(self, run_id=None):
@@ -593,9 +864,12 @@ class Document:
 
   def get_doc_token_count(self):
     if not hasattr(self, 'doc_tokens'):
-      self.doc_tokens = doc_convert.token_count(self.doc_text)
+      self.doc_tokens = doc_convert.token_count(self.get_doc_text())
     return self.doc_tokens
 
+  def get_page_counts(self):
+    return getattr(self, 'page_counts', [])
+
   def gen_tokens(self):
     total = 0
     for run_record in self.run_list:
@@ -629,30 +903,83 @@ class Document:
     self.next_run_id += 1
     self.run_list.append(run_record)
 
+    (chunk_size, overlap) = chunk_params(op_type)
+
     # By default, we process the doc text
-    if src_run_id is None:    
-      text = self.doc_text
+    if src_run_id is None:
+      key = ('doc',)
     else:
       # But may process a previous result
-      text = ""
       item = self.get_result_item(src_run_id)
-      if item is not None:
-        text = item.text()
-        
+      if item is None:
+        return run_record
+      key = ('item', src_run_id, item.id())
+
     # Populate source items
+    self.add_span_segments(run_record, key, chunk_size, overlap)
+    return run_record
 
-    if op_type == OP_TYPE_CONSOLIDATE:
-      chunk_size = int(section_util.AI_MODEL_SIZE * 0.75)
-      overlap = 0.1
+  def get_source_text(self, key):
+    """
+    Return the SourceText for a key: ('doc',) for the document text,
+    or ('item', run_id, id) for the text of an item of a run.
+    """
+    sources = self.__dict__.setdefault('_sources', {})
+    source = sources.get(key)
+    if source is None:
+      if key[0] == 'doc':
+        source = SourceText(self.get_doc_text)
+      else:
+        source = SourceText(
+          lambda: self.get_item_by_id(key[1], key[2]).text())
+      sources[key] = source
+    return source
+
+  def add_span_segments(self, run_record, key, chunk_size, overlap):
+    """
+    Add segments that are spans of the source text. The tokens and
+    chunk plan of the document text are read from the extract store
+    when the text is kept there.
+    """
+    tokenizer = section_util.get_tokenizer()
+    source = self.get_source_text(key)
+    spans = None
+    if key[0] == 'doc' and self.text_stored():
+      store = extract_store.reader()
+      tokens = store.get_tokens(self.text_key).tolist()
+      entry = store.get(self.text_key)
+      if entry is not None:
+        spans = entry.get_plan(chunk_size, overlap)
     else:
-      chunk_size = int(section_util.AI_MODEL_SIZE * 0.45)
-      overlap = 0
-      
-    chunks = doc_convert.chunk_text(text, chunk_size, overlap)
-    for chunk in chunks:
-      run_record.add_new_segment(chunk.get_text(), chunk.size)
-      
-    return run_record
+      tokens = []
+      text = str(source.get_data(), 'utf-8')
+      for block in doc_convert.encode_lines(text.split('\n'), tokenizer):
+        tokens.extend(block)
+    if spans is None:
+      spans = doc_convert.chunk_spans(tokens, chunk_size, tokenizer, overlap)
+
+    # Byte offset of each token in the source text
+    offsets = array.array('Q', itertools.accumulate(
+      (len(tokenizer.decode_single_token_bytes(token)) for token in tokens),
+      initial=0))
+    run_record.segment_source = key
+    for (start, end) in spans:
+      span = TextSpan(offsets[start], offsets[end] - offsets[start], source)
+      if len(span.load()) > 0:
+        run_record.add_new_segment(None, end - start, span)
+
+  def link_spans(self):
+    """
+    Point the segments that are spans at the source text of their run.
+    """
+    for run_record in self.run_list:
+      key = getattr(run_record, 'segment_source', None)
+      if key is None:
+        continue
+      source = self.get_source_text(key)
+      for segment in run_record.doc_segments:
+        if isinstance(segment.text_record._source, TextSpan):
+          segment.text_record._source.source = source
   
 
   #
@@ -660,8 +987,15 @@ class Document:
   #
 
   def is_running(self, run_id=None):
-    # Time limit on how long a task can be considered running.
     run_record = self.get_run_record(run_id)
+    if run_record is None:
+      return False
+    # Use the job lease if the run has been queued as a job.
+    lease_expires = getattr(run_record, 'lease_expires', None)
+    if lease_expires is not None:
+      return run_record.stop_time is None and time.time() < lease_expires
+
+    # Time limit on how long a task can be considered running.
     if run_record is not None:    
       return (run_record.start_time is not None and
               run_record.stop_time is None and
@@ -669,6 +1003,40 @@ class Document:
                run_record.start_time).total_seconds() < 60 * 60)
     return False
 
+  def can_resume_run(self, run_id=None):
+    """
+    Return True if the run was interrupted and can continue from
+    a checkpoint.
+    """
+    run_record = self.get_run_record(run_id)
+    return (run_record is not None and
+            run_record is self.get_current_run_record() and
+            run_record.stop_time is None and
+            getattr(run_record, 'checkpoint', None) is not None and
+            not self.is_running(run_record.run_id))
+
+  def set_run_checkpoint(self, checkpoint, run_id=None):
+    run_record = self.get_run_record(run_id)
+    if run_record is not None:
+      run_record.checkpoint = checkpoint
+
+  def set_partial_text(self, text, run_id=None):
+    run_record = self.get_run_record(run_id)
+    if run_record is not None:
+      run_record.partial_text = text
+
+  def get_partial_text(self, run_id=None):
+    run_record = self.get_run_record(run_id)
+    if run_record is not None:
+      return getattr(run_record, 'partial_text', '')
+    return ''
+
+  def get_run_checkpoint(self, run_id=None):
+    run_record = self.get_run_record(run_id)
+    if run_record is not None:
+      return getattr(run_record, 'checkpoint', None)
+    return None
+
   def mark_start_run(self, prompt, src_run_id=None,
                      op_type=OP_TYPE_CONSOLIDATE):
     op_flag = op_type == OP_TYPE_CONSOLIDATE
@@ -676,25 +1044,26 @@ class Document:
     run_record = self.new_run_record(prompt_id, op_type, src_run_id)
     return run_record.run_id
 
-  def mark_complete_run(self):
-    run_record = self.get_current_run_record()
+  def mark_complete_run(self, run_id=None):
+    run_record = self.get_run_record(run_id)
     if run_record is not None:
       run_record.stop_time = datetime.datetime.now()
 
-  def mark_cancel_run(self, message):
-    self.set_status_message(message)
-    self.mark_complete_run()
+  def mark_cancel_run(self, message, run_id=None):
+    self.set_status_message(message, run_id)
+    self.mark_complete_run(run_id)
 
-  def add_new_completion(self, item_id_list, text, comp_tokens, token_cost):
-    run_record = self.get_current_run_record()
+  def add_new_completion(self, item_id_list, text, comp_tokens, token_cost,
+                         run_id=None):
+    run_record = self.get_run_record(run_id)
     if run_record is not None:
       run_record.completed_steps += 1      
       return run_record.add_new_completion(item_id_list, text,
                                            comp_tokens, token_cost)
     return None
 
-  def set_final_result(self, completion):
-    run_record = self.get_current_run_record()
+  def set_final_result(self, completion, run_id=None):
+    run_record = self.get_run_record(run_id)
     if run_record is not None:
       completion.set_final_result()
       run_record.result_id = completion.id()
@@ -756,60 +1125,650 @@ class Document:
       return prompt
     return ""
 
+  def text_stored(self):
+    if getattr(self, 'text_key', None) is None:
+      return False
+    if extract_store.reader() is None:
+      raise doc_convert.DocError(
+        "text of %s is in an extract store that is not open" %
+        self.doc_name)
+    return True
+
   def get_doc_text(self):
-    return self.doc_text
+    if self.doc_text is None and self.text_stored():
+      return extract_store.reader().get_text(self.text_key)
+    return self.get_loaded_text()
   
-  def read_file(self, name, file, md5_digest):
+  def read_file(self, name, file, md5_digest, progress=None,
+                filename=None):
+    """
+    Read the text of a file for a document called name. The type of
+    the file is found from filename, by default name.
+    """
     self.doc_name = os.path.basename(name)      
-    self.doc_text = doc_convert.read_file(name, file)
-    self.doc_tokens = doc_convert.token_count(self.doc_text)
+    # Count tokens as the text is extracted
+    counter = doc_convert.TokenCounter(section_util.get_tokenizer())
+    pieces = []
+    self.page_counts = []
+    for piece in doc_convert.iter_text(filename or name, file,
+                                       self.page_counts, progress):
+      pieces.append(piece)
+      counter.add(piece)
+    self.doc_text = ''.join(pieces)
+    self.doc_tokens = counter.total()
     self.md5_digest = md5_digest
 
+  def read_file_to_store(self, name, file, md5_digest, key, username,
+                         progress=None, filename=None):
+    """
+    Read the text of a file for a document called name into the
+    extract store under key, as read_file and store_text do, without
+    holding the whole text or its tokens.
+    """
+    self.doc_name = os.path.basename(name)
+    counter = doc_convert.TokenCounter(section_util.get_tokenizer())
+    self.page_counts = []
+    self.md5_digest = md5_digest
+
+    def pieces():
+      for piece in doc_convert.iter_text(filename or name, file,
+                                         self.page_counts, progress):
+        counter.add(piece)
+        yield piece
+      # Counted before the entry is added
+      self.doc_tokens = counter.total()
+    self.store_pieces(key, username, pieces())
+    self.text_key = key
+
+  def store_text(self, key, username):
+    """
+    Move the text of the document into the extract store under key,
+    with its tokens and chunk plans. The text is not stored again if
+    the store has it.
+    """
+    if not extract_store.STORE.add_ref(username, self.doc_name, key):
+      self.store_pieces(key, username, [ self.get_loaded_text() ])
+    self.doc_text = None
+    self._text_source = None
+    self.text_key = key
+
+  def store_pieces(self, key, username, pieces):
+    """
+    Add the text given in pieces to the extract store under key. The
+    text and tokens are written to the store as they are made, and
+    the chunk plans read the tokens back a block at a time.
+    """
+    store = extract_store.STORE
+    tokenizer = section_util.get_tokenizer()
+    writer = store.new_entry(key)
+    try:
+      def written():
+        for piece in pieces:
+          writer.write_text(piece)
+          yield piece
+      for block in doc_convert.encode_lines(
+          doc_convert.clean_lines(written()), tokenizer):
+        writer.write_tokens(block)
+      plans = {}
+      for (chunk_size, overlap) in CHUNK_PARAMS.values():
+        plans[extract_store.plan_key(chunk_size, overlap)] = [
+          (start, end) for (start, end, chunk) in doc_convert.iter_spans(
+            writer.token_blocks(), chunk_size, tokenizer, overlap) ]
+    except:
+      writer.discard()
+      raise
+    store.put_entry(writer, self.get_doc_token_count(),
+                    self.get_page_counts(), plans, username, self.doc_name)
+
+  def use_stored_text(self, name, entry, md5_digest):
+    """
+    Refer to text in the extract store instead of reading a file.
+    """
+    self.doc_name = os.path.basename(name)
+    self.doc_text = None
+    self._text_source = None
+    self.text_key = entry.key
+    self.doc_tokens = entry.doc_tokens
+    self.page_counts = entry.page_counts
+    self.md5_digest = md5_digest
+
+#
+# A .daf file is a pickle of the document, or with COMPRESS, FORMAT_MAGIC,
+# a pickled header and the pickle of the document with long text
+# compressed. The header has FORMAT_VERSION and what the index keeps,
+# so documents can be listed without reading the document. Records
+# with the same long text share one CompressedText, which is pickled
+# once.
+#
+
+FORMAT_MAGIC = b'DAF\x00'
+FORMAT_VERSION = 3
+
+
+def write_pickle(f, document):
+  if not COMPRESS:
+    pickle.dump(document, f)
+    return
+  summary = doc_index.summarize(document)
+  f.write(FORMAT_MAGIC)
+  pickle.dump({ 'version': FORMAT_VERSION,
+                'journal_id': document.journal_id,
+                'md5_digest': summary.md5_digest,
+                'doc_tokens': summary.doc_tokens,
+                'run_count': summary.run_count }, f)
+  pickle.dump(document, f)
+
+
+def read_header(f):
+  """
+  Return the header of an open .daf file, None if the file has none.
+  Leaves f at the pickle of the document.
+  """
+  start = f.read(len(FORMAT_MAGIC))
+  if start != FORMAT_MAGIC:
+    f.seek(0, 0)
+    return None
+  header = pickle.load(f)
+  if header['version'] > FORMAT_VERSION:
+    raise doc_convert.DocError("Document format %d is newer than %d" %
+                               (header['version'], FORMAT_VERSION))
+  return header
+
+
 def load_document(file_name):
   f = open(file_name, 'rb')
-  document = pickle.load(f) 
+  if f.read(len(doc_store.MAGIC)) == doc_store.MAGIC:
+    f.close()
+    document = doc_store.load_document(file_name)
+    document._journal = Journal(file_name, doc_store.SQLITE)
+    document._journal.set_saved(file_name, document, 0)
+    mark_final_results(document)
+  else:
+    f.seek(0, 0)
+    read_header(f)
+    document = pickle.load(f) 
+    f.close()
+    read_journal(file_name, document)
   document.prompts.fixup_prompts()
-  f.close()
+  document.link_spans()
   return document
+
+
+def read_summary(file_name):
+  """
+  Return the doc_index.Summary of a saved document, from the header
+  when the document has no journal.
+  """
+  if not os.path.exists(journal_path(file_name)):
+    with open(file_name, 'rb') as f:
+      header = read_header(f)
+    if header is not None:
+      return doc_index.Summary(header['md5_digest'], header['doc_tokens'],
+                               header['run_count'])
+  return doc_index.summarize(load_document(file_name))
+
   
+def get_journal(file_name, document):
+  """
+  Return the Journal of a document, starting one for a new document.
+  Saves of the document hold its lock.
+  """
+  journal = getattr(document, '_journal', None)
+  if journal is None:
+    journal = Journal(file_name)
+    document._journal = journal
+  return journal
+
+
+def prepare_save(file_name, document):
+  """
+  Pickle what a save of document writes, and return the function that
+  writes it in the transaction of doc_index.write_document. Called
+  with the journal lock held.
+  """
+  journal = document._journal
+  if not journal.can_append(file_name, document):
+    journal.file_name = file_name
+    return prepare_base(file_name, document)
+  return journal.prepare_append(document)
+
+
 def save_document(file_name, document):
-  # Write and rename to avoid a read of a partial write.
-  # TODO: use tmp file to avoid corruptiojn of two writes
-  f = open(file_name + '.tmp', 'wb')
-  pickle.dump(document, f)
-  f.close()
-  os.replace(file_name + '.tmp', file_name)
+  journal = get_journal(file_name, document)
+  with journal.lock:
+    # Pickle before the index is locked for the write
+    doc_index.write_document(file_name, document,
+                             prepare_save(file_name, document))
+
+
+#
+# Changes to a document are appended to a journal file next to the
+# pickle of the document, the base. A save writes the new text
+# records of each run, and the other state of the document and of the
+# runs when it has changed. A compressed text already in the base or
+# the journal is written as its digest. When the journal is large
+# compared to the base, the next save writes a new base and removes
+# the journal.
+#
+# A document kept in SQLite, see doc_store, writes the same changes
+# as rows.
+#
+
+# How documents are saved, doc_store.PICKLE or doc_store.SQLITE.
+# Documents kept another way are converted on their next full save.
+STORAGE = 'pickle'
+
+# Set False to write the whole document on every save
+JOURNAL = True
 
+# Journal bytes always allowed before a new base is written
+JOURNAL_MIN_BYTES = 1024 * 1024
 
-def find_or_create_doc(user_dir, filename, file):
+# Size of the journal relative to the base at which a new base is written
+JOURNAL_RATIO = 0.5
+
+# Attributes of a Document and a RunRecord not kept as their state
+DOC_STATE_SKIP = ( 'run_list', 'doc_text', 'journal_id', '_journal',
+                   '_text_source', '_sources' )
+RUN_STATE_SKIP = ( 'text_records', 'doc_segments', 'completions',
+                   'lease_expires' )
+
+
+def journal_path(file_name):
+  return file_name + doc_index.JOURNAL_EXT
+
+
+def doc_state(document):
+  return pickle.dumps({ key: value for (key, value)
+                        in document.__dict__.items()
+                        if key not in DOC_STATE_SKIP })
+
+
+def run_state(run_record):
+  return pickle.dumps({ key: value for (key, value)
+                        in run_record.__dict__.items()
+                        if key not in RUN_STATE_SKIP })
+
+
+def add_blobs(blobs, text_records):
+  for text_record in text_records:
+    source = text_record._source
+    if isinstance(source, CompressedText) and source.digest is not None:
+      blobs[source.digest] = source
+
+
+def document_blobs(document):
+  """
+  Return { digest: CompressedText } of the text records of document.
+  """
+  blobs = {}
+  for run_record in document.run_list:
+    add_blobs(blobs, run_record.text_records.values())
+  return blobs
+
+
+def saved_state(document):
+  """
+  Return what a Journal notes of a saved document.
+  """
+  runs = {}
+  for run_record in document.run_list:
+    runs[run_record.run_id] = (len(run_record.doc_segments),
+                               len(run_record.completions),
+                               run_state(run_record))
+  # Texts are shared only when compressed
+  blobs = set(document_blobs(document)) if COMPRESS else set()
+  return (document.doc_text, getattr(document, '_text_source', None),
+          doc_state(document), runs, blobs)
+
+
+def file_id(file_name):
+  stat = os.stat(file_name)
+  return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class Journal:
+  """
+  What is in the saved base and journal of a loaded document, to
+  find the changes to append on a save.
+  """
+  def __init__(self, file_name, storage=None):
+    self.lock = threading.Lock()
+    self.file_name = file_name
+    # How the base was saved
+    self.storage = storage
+    self.base_id = None
+    self.base_size = 0
+    self.size = 0
+    self.doc_text = None
+    self.text_source = None
+    self.doc_state = None
+    # run_id: (segments, completions, state) saved
+    self.runs = {}
+    # Digests of the compressed texts saved
+    self.blobs = set()
+
+  def copy(self):
+    journal = Journal.__new__(Journal)
+    journal.__dict__.update(self.__dict__)
+    journal.lock = threading.Lock()
+    journal.runs = dict(self.runs)
+    journal.blobs = set(self.blobs)
+    return journal
+
+  def set_saved(self, file_name, document, size, saved=None):
+    """
+    Note that the base and the journal of size bytes hold document.
+    saved is the saved_state of document, by default taken now.
+    """
+    if saved is None:
+      saved = saved_state(document)
+    self.file_name = file_name
+    self.base_id = file_id(file_name)
+    self.base_size = self.base_id[1]
+    self.size = size
+    (self.doc_text, self.text_source, self.doc_state, self.runs,
+     self.blobs) = saved
+
+  def can_append(self, file_name, document):
+    """
+    True if the changes to document may be appended to the journal.
+    """
+    # Documents pickled before journals were kept have no journal_id
+    if (not JOURNAL or self.base_id is None or
+        getattr(document, 'journal_id', None) is None or
+        file_name != self.file_name or self.storage != STORAGE or
+        document.doc_text is not self.doc_text or
+        getattr(document, '_text_source', None) is not self.text_source):
+      return False
+    if (self.storage == doc_store.PICKLE and
+        self.size > max(JOURNAL_MIN_BYTES, self.base_size * JOURNAL_RATIO)):
+      return False
+    # Another writer replaced the base
+    try:
+      if self.storage == doc_store.SQLITE:
+        # Saves change the time of the stub, a new base replaces it
+        return file_id(file_name)[0] == self.base_id[0]
+      return file_id(file_name) == self.base_id
+    except FileNotFoundError:
+      return False
+
+  def changes(self, document):
+    """
+    Return the records of the changes to document since the last save,
+    and note them as saved.
+    """
+    records = []
+    state = doc_state(document)
+    if state != self.doc_state:
+      records.append(('doc', state))
+      self.doc_state = state
+    for run_record in document.run_list:
+      (segments, completions, state) = self.runs.get(run_record.run_id,
+                                                     (0, 0, None))
+      new_state = run_state(run_record)
+      if new_state != state:
+        records.append(('run', run_record.run_id, new_state))
+      if (segments < len(run_record.doc_segments) or
+          completions < len(run_record.completions)):
+        records.append(('items', run_record.run_id,
+                        run_record.doc_segments[segments:],
+                        run_record.completions[completions:]))
+      self.runs[run_record.run_id] = (len(run_record.doc_segments),
+                                      len(run_record.completions),
+                                      new_state)
+    return records
+
+  def prepare_append(self, document):
+    """
+    Pickle the changes to document, and return the function that
+    appends them in the transaction of doc_index.write_document.
+    """
+    records = self.changes(document)
+    if len(records) == 0:
+      return lambda db: None
+    if self.storage == doc_store.SQLITE:
+      return doc_store.prepare_changes(self.file_name, records)
+    if self.size == 0:
+      records.insert(0, ('header', document.journal_id))
+    data = io.BytesIO()
+    pickler = pickle.Pickler(data)
+    written = set()
+    def blob_id(obj):
+      if isinstance(obj, CompressedText) and obj.digest is not None:
+        if obj.digest in self.blobs:
+          return obj.digest
+        written.add(obj.digest)
+      return None
+    pickler.persistent_id = blob_id
+    for record in records:
+      # Each record is read as its own pickle
+      pickler.dump(record)
+      pickler.clear_memo()
+      self.blobs.update(written)
+
+    def append(db):
+      with open(journal_path(self.file_name), 'ab') as f:
+        f.write(data.getvalue())
+      self.size += data.tell()
+    return append
+
+
+def prepare_base(file_name, document, storage=None):
+  """
+  Pickle the whole document, and return the function that writes it
+  and starts a new journal in the transaction of
+  doc_index.write_document. The document is kept as storage, by
+  default STORAGE. A document outside a user directory is always
+  pickled.
+  """
+  if storage is None:
+    storage = STORAGE
+  if doc_index.doc_name(file_name) is None:
+    storage = doc_store.PICKLE
+  document.journal_id = uuid.uuid4().hex
+  if storage == doc_store.SQLITE:
+    write_rows = doc_store.prepare_document(file_name, document)
+  else:
+    if isinstance(getattr(document, '_text_source', None),
+                  doc_store.DocTextSource):
+      # Keep the text of the rows removed below
+      document.doc_text = document.get_loaded_text()
+      document._text_source = None
+    data = io.BytesIO()
+    write_pickle(data, document)
+  saved = saved_state(document)
+
+  def write(db):
+    if storage == doc_store.SQLITE:
+      write_rows(db)
+    else:
+      # Write and rename to avoid a read of a partial write.
+      # TODO: use tmp file to avoid corruptiojn of two writes
+      with open(file_name + '.tmp', 'wb') as f:
+        f.write(data.getvalue())
+      os.replace(file_name + '.tmp', file_name)
+      if db is not None:
+        # Rows left if the document was kept in SQLite
+        doc_store.delete_rows(db, doc_index.doc_name(file_name))
+    # A journal left by a crash does not match journal_id
+    try:
+      os.remove(journal_path(file_name))
+    except FileNotFoundError:
+      pass
+    document._journal.storage = storage
+    document._journal.set_saved(file_name, document, 0, saved)
+  return write
+
+
+def read_journal(file_name, document):
+  """
+  Apply the journal of the file to the loaded base.
+  """
+  journal = Journal(file_name, doc_store.PICKLE)
+  document._journal = journal
+  try:
+    f = open(journal_path(file_name), 'rb')
+  except FileNotFoundError:
+    journal.set_saved(file_name, document, 0)
+    return
+  with f:
+    end = os.fstat(f.fileno()).st_size
+    complete = False
+    # Texts written as their digest, see Journal.append
+    blobs = document_blobs(document)
+    def load_blob_id(digest):
+      if digest not in blobs:
+        raise pickle.UnpicklingError("unknown text %s" % digest.hex())
+      return blobs[digest]
+    def load_record():
+      # Each record is its own pickle, with its own memo
+      unpickler = pickle.Unpickler(f)
+      unpickler.persistent_load = load_blob_id
+      return unpickler.load()
+    try:
+      header = load_record()
+      if header == ('header', getattr(document, 'journal_id', None)):
+        while f.tell() < end:
+          record = load_record()
+          apply_record(document, record)
+          if record[0] == 'items':
+            add_blobs(blobs, [ item.text_record
+                               for item in record[2] + record[3] ])
+        complete = True
+      else:
+        # Left from an older base
+        logging.warning("ignore journal of %s", file_name)
+    except (EOFError, pickle.UnpicklingError):
+      # A write was cut short
+      logging.warning("ignore end of journal of %s at %d", file_name,
+                      f.tell())
+  mark_final_results(document)
+  if complete:
+    journal.set_saved(file_name, document, end)
+  # Otherwise write a new base on the next save
+
+
+def mark_final_results(document):
+  """
+  Mark the result of each run, which may have been saved before the
+  run chose it.
+  """
+  for run_record in document.run_list:
+    for completion in run_record.completions:
+      if completion.id() == run_record.result_id:
+        completion.final_result = True
+
+
+def apply_record(document, record):
+  if record[0] == 'doc':
+    document.__dict__.update(pickle.loads(record[1]))
+    return
+
+  run_record = None
+  for item in document.run_list:
+    if item.run_id == record[1]:
+      run_record = item
+  if run_record is None:
+    run_record = RunRecord(record[1], 0, OP_TYPE_CONSOLIDATE)
+    document.run_list.append(run_record)
+
+  if record[0] == 'run':
+    next_text_id = run_record.next_text_id
+    run_record.__dict__.update(pickle.loads(record[2]))
+    run_record.next_text_id = max(next_text_id, run_record.next_text_id)
+  elif record[0] == 'items':
+    for (items, new_items) in [ (run_record.doc_segments, record[2]),
+                                (run_record.completions, record[3]) ]:
+      for item in new_items:
+        # Skip items saved twice by racing writers
+        if item.id() not in run_record.text_records:
+          run_record.text_records[item.id()] = item.text_record
+          items.append(item)
+          run_record.next_text_id = max(run_record.next_text_id,
+                                        item.id() + 1)
+
+
+def compact_document(file_name, storage=None):
+  """
+  Fold the journal of a document into its base, kept as storage, by
+  default STORAGE.
+  """
+  document = load_document(file_name)
+  with document._journal.lock:
+    doc_index.write_document(file_name, document,
+                             prepare_base(file_name, document, storage))
+
+
+# Bytes copied at a time from an uploaded file
+READ_BLOCK_SIZE = 1024 * 1024
+
+def spool_file(file):
+  """
+  Copy a file to a temporary file a block at a time, generating the
+  md5 sum and the key of the content as it goes.
+  Returns (tmp_file, md5_digest, content_key).
+  """
+  # Named so PDF pages can be read by other processes
+  tmp_file = tempfile.NamedTemporaryFile()
+  md5 = hashlib.md5()
+  sha = hashlib.sha256()
+  while True:
+    block = file.read(READ_BLOCK_SIZE)
+    if len(block) == 0:
+      break
+    md5.update(block)
+    sha.update(block)
+    tmp_file.write(block)
+  tmp_file.seek(0, 0)
+  return (tmp_file, md5.digest(), sha.hexdigest())
+
+
+def list_documents(user_dir, sort='modified'):
+  """
+  Return doc_index.DocInfo for each document in user_dir.
+  """
+  return doc_index.list_docs(user_dir, read_summary, sort)
+
+
+def store_doc_text(file_path, username):
+  """
+  Move the text of a saved document into the extract store, keyed
+  by a digest of the text.
+  """
+  document = load_document(file_path)
+  text = document.get_loaded_text()
+  if text is None:
+    return
+  key = 'text-' + hashlib.sha256(text.encode('utf-8')).hexdigest()
+  document.store_text(key, username)
+  save_document(file_path, document)
+
+
+def find_or_create_doc(user_dir, filename, file, progress=None):
   """
   Returns a doc name or None
 
   Given a file and filename, find an existing matching file or
-  create a new file. 
+  create a new file. If given, progress is called with (pages read,
+  page count) as the pages of a PDF are read.
 
   May throw exception on failure.
   """
-  # Read in file to a tmp file
-  # TODO: don't need a tempfile
-  tmp_file = tempfile.TemporaryFile()
-  tmp_file.write(file.read())
-  tmp_file.seek(0, 0)
-
-  # Generate an md5 sum
-  md5_digest = hashlib.md5(tmp_file.read()).digest()
-  tmp_file.seek(0, 0)
+  (tmp_file, md5_digest, content_key) = spool_file(file)
+  username = os.path.basename(os.path.normpath(user_dir))
+  store = extract_store.STORE
 
   # Find a matching name and md5_digest, or exit loop with a
   # unique filename
+  (matches, names) = doc_index.lookup(user_dir, read_summary, md5_digest)
   target_file = filename
   i = 0
   done = False
   while not done:
     file_path = os.path.join(user_dir, target_file + ".daf")
-    if os.path.exists(file_path):
-      document = load_document(file_path)
-      if document.md5_digest == md5_digest:
+    if target_file in names:
+      if target_file in matches:
         done = True
       else:
         # Try a different filename
@@ -819,8 +1778,20 @@ def find_or_create_doc(user_dir, filename, file):
     else:
       # File does not exist, create it
       done = True
-      document = Document()    
-      document.read_file(target_file, tmp_file, md5_digest)
+      document = Document()
+      entry = None
+      if store is not None:
+        entry = store.get(content_key)
+      if (entry is not None and
+          store.add_ref(username, target_file, content_key)):
+        document.use_stored_text(target_file, entry, md5_digest)
+      elif store is not None:
+        document.read_file_to_store(target_file, tmp_file, md5_digest,
+                                    content_key, username, progress,
+                                    filename)
+      else:
+        document.read_file(target_file, tmp_file, md5_digest, progress,
+                           filename)
       save_document(file_path, document)
 
   tmp_file.close()
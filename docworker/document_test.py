@@ -1,6 +1,10 @@
+from . import doc_convert
 from . import document
+from . import extract_store
 import unittest
 import tempfile
+import shutil
+import hashlib
 import os
 
 LONG_TEXT = """
@@ -200,6 +204,274 @@ class BasicDocumentTestCase(unittest.TestCase):
     self.assertNotEqual(filename1, filename3)
 
     
+  def testSharedText(self):
+    filename = 'PA utility.docx'
+    path = os.path.join(os.path.dirname(__file__),
+                        'samples/', filename)
+    store_dir = tempfile.TemporaryDirectory()
+    extract_store.STORE = extract_store.ExtractStore(store_dir.name)
+    # Plans are made from tokens read back in blocks
+    block_size = extract_store.TOKEN_BLOCK_SIZE
+    extract_store.TOKEN_BLOCK_SIZE = 500
+    try:
+      user_dirs = [ os.path.join(self.user_dir.name, name)
+                    for name in [ 'user1', 'user2' ] ]
+      docs = []
+      for user_dir in user_dirs:
+        os.makedirs(user_dir)
+        with open(path, 'rb') as f:
+          doc_name = document.find_or_create_doc(user_dir, filename, f)
+        docs.append(document.load_document(
+          os.path.join(user_dir, doc_name + '.daf')))
+      stats = extract_store.STORE.stats()
+      self.assertEqual(stats['entries'], 1)
+      self.assertEqual(stats['refs'], 2)
+      self.assertIsNone(docs[0].doc_text)
+      self.assertEqual(docs[0].text_key, docs[1].text_key)
+      self.assertEqual(docs[0].get_doc_text(), docs[1].get_doc_text())
+      self.assertEqual(docs[0].get_doc_token_count(),
+                       docs[1].get_doc_token_count())
+
+      # Segments from the stored plan match those of the text
+      doc = document.Document()
+      with open(path, 'rb') as f:
+        doc.read_file(filename, f, b'')
+      for op_type in [ document.OP_TYPE_CONSOLIDATE,
+                       document.OP_TYPE_TRANSFORM ]:
+        stored = docs[1].new_run_record(1, op_type)
+        expected = doc.new_run_record(1, op_type)
+        self.assertEqual([ (item.text(), item.token_count())
+                           for item in stored.doc_segments ],
+                         [ (item.text(), item.token_count())
+                           for item in expected.doc_segments ])
+
+      # Text is read from the fallback when the store is off
+      store = extract_store.STORE
+      extract_store.STORE = None
+      self.assertRaises(doc_convert.DocError, docs[0].get_doc_text)
+      extract_store.FALLBACK = store
+      self.assertEqual(docs[0].get_doc_text(), doc.get_doc_text())
+      extract_store.STORE = store
+    finally:
+      extract_store.TOKEN_BLOCK_SIZE = block_size
+      extract_store.FALLBACK = None
+      extract_store.STORE.close()
+      extract_store.STORE = None
+      store_dir.cleanup()
+
+  def testJournal(self):
+    doc_file = os.path.join(self.user_dir.name, 'doc.daf')
+    journal_file = doc_file + '.jnl'
+    document.save_document(doc_file, self.doc)
+    self.assertFalse(os.path.exists(journal_file))
+    base_size = os.path.getsize(doc_file)
+
+    # Changes are appended to the journal
+    doc = document.load_document(doc_file)
+    doc.set_status_message("status", self.run_id)
+    document.save_document(doc_file, doc)
+    size = os.path.getsize(journal_file)
+    doc.add_new_completion([ self.id3 ], LONG_TEXT, 50, 60)
+    document.save_document(doc_file, doc)
+    self.assertGreater(os.path.getsize(journal_file), size)
+    size = os.path.getsize(journal_file)
+    # Nothing changed, nothing written
+    document.save_document(doc_file, doc)
+    self.assertEqual(os.path.getsize(journal_file), size)
+
+    run_record = doc.new_run_record(doc.prompts.get_prompt_id("prompt 2"),
+                                    document.OP_TYPE_TRANSFORM)
+    run_record.add_new_segment("new run text", 3)
+    document.save_document(doc_file, doc)
+    self.assertEqual(os.path.getsize(doc_file), base_size)
+
+    doc2 = document.load_document(doc_file)
+    self.assertEqual(doc2.get_status_message(self.run_id), "status")
+    self.assertEqual(len(doc2.run_list), 2)
+    self.assertEqual(doc2.next_run_id, doc.next_run_id)
+    self.assertEqual(doc2.get_run_record(self.run_id).completions[-1].text(),
+                     LONG_TEXT)
+    self.assertEqual(doc2.get_run_record(run_record.run_id).get_src_text(),
+                     run_record.get_src_text())
+    self.assertEqual(doc2.prompts.get_prompt_id("prompt 2"),
+                     doc.prompts.get_prompt_id("prompt 2"))
+    self.assertEqual(doc2.get_run_record(self.run_id).next_text_id,
+                     doc.get_run_record(self.run_id).next_text_id)
+
+    # The journal is folded into the base when it grows
+    limit = document.JOURNAL_MIN_BYTES
+    document.JOURNAL_MIN_BYTES = 0
+    try:
+      doc2.set_status_message("status 2", self.run_id)
+      document.save_document(doc_file, doc2)
+      self.assertFalse(os.path.exists(journal_file))
+      doc2.set_status_message("status 3", self.run_id)
+      document.save_document(doc_file, doc2)
+      self.assertTrue(os.path.exists(journal_file))
+      document.compact_document(doc_file)
+      self.assertFalse(os.path.exists(journal_file))
+    finally:
+      document.JOURNAL_MIN_BYTES = limit
+    doc3 = document.load_document(doc_file)
+    self.assertEqual(doc3.get_status_message(self.run_id), "status 3")
+    self.assertEqual(len(doc3.run_list), 2)
+
+  def testOldFormat(self):
+    # Sample pickled before journals were kept
+    doc_file = os.path.join(self.user_dir.name, 'PA_utility.docx.daf')
+    shutil.copyfile(os.path.join(os.path.dirname(__file__), 'samples/',
+                                 'PA_utility.docx.daf'), doc_file)
+    doc = document.load_document(doc_file)
+    self.assertFalse(hasattr(doc, 'journal_id'))
+    doc.set_status_message("status 1")
+    document.save_document(doc_file, doc)
+    self.assertIsNotNone(doc.journal_id)
+    run_record = doc.new_run_record(doc.prompts.get_prompt_id("prompt"),
+                                    document.OP_TYPE_CONSOLIDATE)
+    doc.set_status_message("status 2")
+    document.save_document(doc_file, doc)
+    self.assertTrue(os.path.exists(doc_file + '.jnl'))
+    doc = document.load_document(doc_file)
+    self.assertEqual(doc.get_status_message(run_record.run_id), "status 2")
+
+  def testJournalRecovery(self):
+    doc_file = os.path.join(self.user_dir.name, 'doc.daf')
+    journal_file = doc_file + '.jnl'
+    document.save_document(doc_file, self.doc)
+    doc = document.load_document(doc_file)
+    doc.set_status_message("status", self.run_id)
+    document.save_document(doc_file, doc)
+    doc.set_status_message("status 2", self.run_id)
+    document.save_document(doc_file, doc)
+
+    with open(journal_file, 'rb') as f:
+      journal = f.read()
+
+    # A record cut short is ignored
+    with open(journal_file, 'r+b') as f:
+      f.truncate(len(journal) - 5)
+    doc = document.load_document(doc_file)
+    self.assertEqual(doc.get_status_message(self.run_id), "status")
+    # The next save writes a new base
+    doc.set_status_message("status 3", self.run_id)
+    document.save_document(doc_file, doc)
+    self.assertFalse(os.path.exists(journal_file))
+
+    # A journal of an older base is ignored
+    with open(journal_file, 'wb') as f:
+      f.write(journal)
+    doc = document.load_document(doc_file)
+    self.assertEqual(doc.get_status_message(self.run_id), "status 3")
+
+  def testCompressed(self):
+    doc_file = os.path.join(self.user_dir.name, 'doc.daf')
+    self.doc.doc_text = LONG_TEXT * 4
+    self.doc.md5_digest = b'1234'
+    self.doc.add_new_completion([ self.id1 ], LONG_TEXT, 50, 60)
+    document.save_document(doc_file, self.doc)
+    with open(doc_file, 'rb') as f:
+      self.assertEqual(f.read(len(document.FORMAT_MAGIC)),
+                       document.FORMAT_MAGIC)
+    self.assertEqual(document.read_summary(doc_file),
+                     (b'1234', self.doc.get_doc_token_count(), 1))
+
+    # Long text is read when used
+    doc = document.load_document(doc_file)
+    self.assertIsNone(doc.doc_text)
+    self.assertEqual(doc.get_doc_text(), LONG_TEXT * 4)
+    completion = doc.get_run_record(self.run_id).completions[-1]
+    self.assertIsNone(completion.text_record._text)
+    self.assertEqual(completion.text(), LONG_TEXT)
+    self.assertEqual(doc.get_run_record(self.run_id).completions[0].text(),
+                     "completion text")
+    # Changes are appended compressed
+    doc.add_new_completion([ self.id2 ], LONG_TEXT * 20, 50, 60)
+    document.save_document(doc_file, doc)
+    self.assertLess(os.path.getsize(doc_file + '.jnl'), len(LONG_TEXT) * 4)
+    doc = document.load_document(doc_file)
+    self.assertEqual(doc.get_run_record(self.run_id).completions[-1].text(),
+                     LONG_TEXT * 20)
+
+    # Documents saved without compression are read
+    document.COMPRESS = False
+    try:
+      document.compact_document(doc_file)
+    finally:
+      document.COMPRESS = True
+    doc = document.load_document(doc_file)
+    self.assertEqual(doc.doc_text, LONG_TEXT * 4)
+    self.assertEqual(len(doc.get_run_record(self.run_id).completions), 3)
+
+  def testSharedBlobs(self):
+    doc_file = os.path.join(self.user_dir.name, 'doc.daf')
+    # Text that does not compress well
+    text = ''.join([ hashlib.sha256(str(i).encode()).hexdigest()
+                     for i in range(0, 100) ])
+    self.doc.add_new_completion([ self.id1 ], text, 50, 60)
+    document.save_document(doc_file, self.doc)
+    size = os.path.getsize(doc_file)
+    # A second record with the text adds little to the file
+    self.doc.add_new_completion([ self.id2 ], text, 50, 60)
+    document.save_document(doc_file, self.doc)
+    document.compact_document(doc_file)
+    self.assertFalse(os.path.exists(doc_file + '.jnl'))
+    self.assertLess(os.path.getsize(doc_file), size + len(text) / 4)
+
+    doc = document.load_document(doc_file)
+    completions = doc.get_run_record(self.run_id).completions
+    self.assertIs(completions[-1].text_record._source,
+                  completions[-2].text_record._source)
+    self.assertEqual(completions[-1].text(), text)
+
+    # The journal writes the digest of a saved text
+    doc.add_new_completion([ self.id1 ], text, 50, 60)
+    document.save_document(doc_file, doc)
+    self.assertLess(os.path.getsize(doc_file + '.jnl'), len(text) / 4)
+    doc.add_new_completion([ self.id2 ], LONG_TEXT * 30, 50, 60)
+    doc.add_new_completion([ self.id2 ], LONG_TEXT * 30, 50, 60)
+    document.save_document(doc_file, doc)
+    doc = document.load_document(doc_file)
+    self.assertEqual([ item.text() for item in
+                       doc.get_run_record(self.run_id).completions[-5:] ],
+                     [ text ] * 3 + [ LONG_TEXT * 30 ] * 2)
+    self.assertIsNotNone(doc._journal.base_id)
+
+  def testSpanSegments(self):
+    doc = document.Document()
+    doc.doc_text = LONG_TEXT * 8
+    run_record = doc.new_run_record(doc.prompts.get_prompt_id("prompt"),
+                                    document.OP_TYPE_CONSOLIDATE)
+    # Segments hold offsets into the document text
+    segments = run_record.doc_segments
+    for segment in segments:
+      self.assertIsNone(segment.text_record._text)
+      self.assertIsInstance(segment.text_record._source, document.TextSpan)
+    (chunk_size, overlap) = document.chunk_params(run_record.op_type)
+    chunks = doc_convert.chunk_text(doc.doc_text, chunk_size, overlap)
+    self.assertEqual([ (item.text(), item.token_count()) for item in segments ],
+                     [ (chunk.get_text(), chunk.size) for chunk in chunks ])
+
+    doc_file = os.path.join(self.user_dir.name, 'spans.daf')
+    document.save_document(doc_file, doc)
+    doc2 = document.load_document(doc_file)
+    self.assertEqual(
+      [ item.text() for item in doc2.get_run_record(run_record.run_id).
+        doc_segments ], [ item.text() for item in segments ])
+
+  def testPageCounts(self):
+    filename = 'groff-dejoy.pdf'
+    path = os.path.join(os.path.dirname(__file__),
+                        'samples/', filename)
+    self.doc = document.Document()
+    with open(path, 'rb') as f:
+      self.doc.read_file(filename, f, b'')
+    counts = self.doc.get_page_counts()
+    self.assertGreater(len(counts), 1)
+    self.assertEqual(sum([ chars for (chars, tokens) in counts ]) +
+                     len(counts) - 1, len(self.doc.get_doc_text()))
+    for (chars, tokens) in counts:
+      self.assertLessEqual(tokens, chars)
+
   def testRunWithData(self):
     filename = 'PA utility.docx'
     path = os.path.join(os.path.dirname(__file__),
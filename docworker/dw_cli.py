@@ -3,6 +3,10 @@ Command line function to work with document functions.
 """
 from . import document
 from . import doc_gen
+from . import completion_cache
+from . import pdf_extract
+from . import extract_store
+from . import doc_index
 import argparse
 import os
 import openai
@@ -18,6 +22,7 @@ def run_dw_cli():
   group.add_argument('--prompts', action='store_true')  
   group.add_argument('--show', action='store_true')  
   group.add_argument('--run_docgen', action='store_true')    
+  group.add_argument('--resume_docgen', metavar='id', nargs=1)
   group.add_argument('--show_result', metavar='id', nargs=1)
   group.add_argument('--show_result_details', metavar='id', nargs=1)
   group.add_argument('--show_gen_items', metavar='id', nargs=1)
@@ -26,6 +31,24 @@ def run_dw_cli():
   parser.add_argument('--prompt')
   parser.add_argument('--doc')
   parser.add_argument('--fakeai', action='store_true')
+  parser.add_argument('--workers', type=int, default=1,
+                      help='completions to run at the same time')
+  parser.add_argument('--pipeline', action='store_true',
+                      help='consolidate results as they are ready')
+  parser.add_argument('--cache', metavar='file',
+                      help='cache completions in the given file')
+  parser.add_argument('--no_cache', action='store_true',
+                      help='do not use cached completions for this run')
+  parser.add_argument('--pdf_workers', type=int, default=0,
+                      help='processes to read PDF pages, 0 for none')
+  parser.add_argument('--pdf_timeout', type=int,
+                      default=pdf_extract.TIMEOUT,
+                      help='seconds allowed to read a PDF')
+  parser.add_argument('--pdf_max_pages', type=int,
+                      default=pdf_extract.MAX_PAGES,
+                      help='most pages read from a PDF')
+  parser.add_argument('--extract_store', metavar='dir',
+                      help='share extracted text in the given directory')
   parser.add_argument('data_directory')
 
   logging.basicConfig(level=logging.INFO)  
@@ -43,8 +66,21 @@ def run_dw_cli():
     print("Mock AI calls")
     doc_gen.FAKE_AI_COMPLETION=True
 
+  if args.cache:
+    doc_gen.COMPLETION_CACHE = completion_cache.CompletionCache(args.cache)
+
+  if args.extract_store:
+    extract_store.STORE = extract_store.ExtractStore(args.extract_store)
+
   if args.import_doc is not None:
+    pdf_extract.WORKERS = args.pdf_workers
+    pdf_extract.TIMEOUT = args.pdf_timeout
+    pdf_extract.MAX_PAGES = args.pdf_max_pages
     import_document(user_dir, args.import_doc)
+    pdf_extract.shutdown()
+    return
+  elif args.list:
+    list_documents(user_dir)
     return
   else:
     if not args.doc:
@@ -82,7 +118,12 @@ def run_dw_cli():
       print("Start completion requires a prompt")
       return
     path = doc_path(user_dir, args.doc)
-    run_doc_gen(path, doc, args.prompt)
+    run_doc_gen(path, doc, args.prompt, args.workers, args.pipeline,
+                not args.no_cache)
+
+  if args.resume_docgen:
+    path = doc_path(user_dir, args.doc)
+    resume_doc_gen(path, doc, int(args.resume_docgen[0]))
     
 
 def import_document(user_dir, path):
@@ -93,6 +134,12 @@ def import_document(user_dir, path):
   f.close()
   print("Doc file: %s" % doc_name)
 
+def list_documents(user_dir):
+  for info in document.list_documents(user_dir, 'name'):
+    print("%s: %d tokens, %d runs, changed %s" %
+          (info.name, info.doc_tokens, info.run_count,
+           doc_index.modified(info)))
+
 def doc_path(dirname, docname):
   filename = docname + '.daf'
   return os.path.join(dirname, filename)
@@ -110,9 +157,10 @@ def dump_prompts(doc):
 
 def show_doc(doc):
   token_cost = 0
-  doc_len = len(doc.doc_text)
+  doc_text = doc.get_doc_text()
+  doc_len = len(doc_text)
   print("Document: %s" % doc.name)
-  print("Text:\n%s..." % doc.snippet_text(doc.doc_text))
+  print("Text:\n%s..." % doc.snippet_text(doc_text))
 
   for run_record in doc.run_list:
     prompt = doc.prompts.get_prompt_str_by_id(run_record.prompt_id)
@@ -170,11 +218,24 @@ def show_completion_list(doc, run_id):
     print("%s" % doc.snippet_text(item.text()))
     
 
-def run_doc_gen(path, doc, prompt):
+def run_doc_gen(path, doc, prompt, workers=1, pipeline=False, use_cache=True):
   run_state = doc_gen.start_docgen(path, doc, prompt)
+  run_state.max_workers = workers
+  run_state.pipeline = pipeline
+  run_state.use_cache = use_cache
   print("Running doc completion")
   doc_gen.run_all_docgen(path, doc, run_state)    
   print("Complete")  
+
+
+def resume_doc_gen(path, doc, run_id):
+  run_state = doc_gen.load_run_state(doc, run_id)
+  if run_state is None:
+    print("Run %d can not be resumed" % run_id)
+    return
+  print("Resuming doc completion")
+  doc_gen.run_all_docgen(path, doc, run_state)
+  print("Complete")
   
     
 if __name__ == "__main__":
@@ -9,7 +9,10 @@ from docx.oxml.table import CT_Tbl
 from docx.oxml.text.paragraph import CT_P
 from docx.table import _Cell, Table
 from docx.text.paragraph import Paragraph
+from lxml import etree
 import io
+import posixpath
+import zipfile
 
 class DocXExtract:
     def __init__(self, structured=False):
@@ -67,14 +70,14 @@ class DocXExtract:
         """
         Generate table contents as a smiple grid
         """
-        if self.stuctured:
+        if self.structured:
             print('<table>', file=self.result)    
         for row in table.rows:
             items = []
             for c in row.cells:
                 items.append(self.strip_text(c.text))
             print(' | '.join(items), file=self.result)
-        if self.stuctured:
+        if self.structured:
             print('</table>', file=self.result)        
 
     def strip_text(self, text):
@@ -103,11 +106,11 @@ class DocXExtract:
             return
 
         # Reformat table cells into records
-        if self.stuctured:
+        if self.structured:
             print('<table>', file=self.result)
         for row in range(1, row_count):
             row_label = table.cell(row, 0)
-            if self.stuctured:
+            if self.structured:
                 print('<row>', file=self.result)
             for col in range(0, col_count):
                 cell_label = table.cell(0, col)
@@ -120,10 +123,264 @@ class DocXExtract:
                     print('%s: %s' % (self.strip_text(cell_label.text),
                                       self.strip_text(cell_contents.text)),
                           file=self.result)
-        if self.stuctured:
+        if self.structured:
             print('</table>', file=self.result) 
 
 
+W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+OFFICE_DOCUMENT = ('http://schemas.openxmlformats.org/officeDocument/2006/'
+                   'relationships/officeDocument')
+
+
+def w(tag):
+    return '{%s}%s' % (W_NS, tag)
+
+W_BODY = w('body')
+W_P = w('p')
+W_TBL = w('tbl')
+W_TR = w('tr')
+W_TC = w('tc')
+W_R = w('r')
+W_HYPERLINK = w('hyperlink')
+W_T = w('t')
+W_BR = w('br')
+W_VAL = w('val')
+
+# Text of run content other than w:t and w:br
+RUN_TEXT = {
+    w('cr'): '\n',
+    w('noBreakHyphen'): '-',
+    w('ptab'): '\t',
+    w('tab'): '\t',
+}
+
+
+class FastDocXExtract:
+    """
+    Extracts the same text as DocXExtract without the python-docx
+    object model. The body of word/document.xml is parsed one block
+    at a time, and the grid of each table is built once.
+    """
+    def __init__(self, structured=False):
+        self.result = io.StringIO()
+        self.structured = structured
+
+    def load_doc(self, file):
+        """
+        Load and parse docx content from a file.
+        Note: file should be open as 'rb'
+        """
+        with zipfile.ZipFile(file) as package:
+            with package.open(self.main_part(package)) as part:
+                for (event, elem) in etree.iterparse(
+                        part, events=('end',), tag=(W_P, W_TBL)):
+                    parent = elem.getparent()
+                    if parent is None or parent.tag != W_BODY:
+                        continue
+                    self.process_item(elem)
+                    # Free the blocks that have been read
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del parent[0]
+        self.result.seek(0)
+
+    def main_part(self, package):
+        """
+        Return the name of the main document part.
+        """
+        try:
+            rels = etree.fromstring(package.read('_rels/.rels'))
+        except KeyError:
+            return 'word/document.xml'
+        for rel in rels.iter('{%s}Relationship' % REL_NS):
+            if rel.get('Type') == OFFICE_DOCUMENT:
+                return posixpath.normpath(rel.get('Target').lstrip('/'))
+        return 'word/document.xml'
+
+    def get_result(self):
+        return self.result
+
+    def process_block(self, block):
+        # Process the paragraphs and tables in a body or cell
+        for child in block:
+            if child.tag == W_P or child.tag == W_TBL:
+                self.process_item(child)
+
+    def process_item(self, item):
+        if item.tag == W_TBL:
+            self.format_table(item)
+        else:
+            text = self.paragraph_text(item)
+            if len(text.strip()) == 0:
+                return
+            style = self.paragraph_style(item)
+            if (style is not None and self.structured and
+                (style.startswith('Heading') or style.startswith('Title'))):
+                print('<%s>' % style, file=self.result)
+            print(text, file=self.result)
+        print(file=self.result)
+
+    def paragraph_style(self, p):
+        style = p.find('%s/%s' % (w('pPr'), w('pStyle')))
+        if style is None:
+            return None
+        return style.get(W_VAL)
+
+    def paragraph_text(self, p):
+        values = []
+        for child in p:
+            if child.tag == W_R:
+                self.run_text(child, values)
+            elif child.tag == W_HYPERLINK:
+                for run in child.iterchildren(W_R):
+                    self.run_text(run, values)
+        return ''.join(values)
+
+    def run_text(self, run, values):
+        for child in run:
+            if child.tag == W_T:
+                values.append(child.text or '')
+            elif child.tag == W_BR:
+                if child.get(w('type'), 'textWrapping') == 'textWrapping':
+                    values.append('\n')
+            else:
+                text = RUN_TEXT.get(child.tag)
+                if text is not None:
+                    values.append(text)
+
+    def cell_text(self, tc):
+        return '\n'.join([ self.paragraph_text(p)
+                           for p in tc.iterchildren(W_P) ])
+
+    def strip_text(self, text):
+        # combine multiple lines into one
+        return text.replace('\n', ' ').replace('  ', ' ')
+
+    def grid_span(self, tc):
+        span = tc.find('%s/%s' % (w('tcPr'), w('gridSpan')))
+        if span is None:
+            return 1
+        return int(span.get(W_VAL))
+
+    def is_merged(self, tc):
+        # True if the cell continues a vertical merge
+        merge = tc.find('%s/%s' % (w('tcPr'), w('vMerge')))
+        return (merge is not None and
+                merge.get(W_VAL, 'continue') == 'continue')
+
+    def grid_before(self, tr):
+        before = tr.find('%s/%s' % (w('trPr'), w('gridBefore')))
+        if before is None:
+            return 0
+        return int(before.get(W_VAL))
+
+    def table_grid(self, rows, col_count):
+        """
+        Return the cells of the layout grid, row by row. A cell that
+        spans several grid cells appears in each.
+        """
+        cells = []
+        for tr in rows:
+            for tc in tr.iterchildren(W_TC):
+                for index in range(0, self.grid_span(tc)):
+                    if self.is_merged(tc):
+                        cells.append(cells[-col_count])
+                    elif index > 0:
+                        cells.append(cells[-1])
+                    else:
+                        cells.append(tc)
+        return cells
+
+    def row_cells(self, rows):
+        """
+        Return a list of the cells present in each row. A merged cell
+        is replaced by the cell it continues.
+        """
+        result = []
+        offsets = {}
+        for tr in rows:
+            cells = []
+            row_offsets = {}
+            offset = self.grid_before(tr)
+            for tc in tr.iterchildren(W_TC):
+                span = self.grid_span(tc)
+                root = tc
+                if self.is_merged(tc):
+                    root = offsets.get(offset, tc)
+                row_offsets[offset] = root
+                cells.extend([ root ] * span)
+                offset += span
+            offsets = row_offsets
+            result.append(cells)
+        return result
+
+    def dump_table(self, rows):
+        """
+        Generate table contents as a smiple grid
+        """
+        if self.structured:
+            print('<table>', file=self.result)
+        for cells in self.row_cells(rows):
+            items = []
+            for tc in cells:
+                items.append(self.strip_text(self.cell_text(tc)))
+            print(' | '.join(items), file=self.result)
+        if self.structured:
+            print('</table>', file=self.result)
+
+    def format_table(self, tbl):
+        """
+        Extract information from a table.
+        Large tables are converted to records that include
+        what is assumed to be row and column headers.
+        """
+        # Handle multi-cell spans, don't report same combination twice.
+        reported_tuples = {}
+
+        rows = list(tbl.iterchildren(W_TR))
+        grid = tbl.find(w('tblGrid'))
+        col_count = 0 if grid is None else len(grid.findall(w('gridCol')))
+        row_count = len(rows)
+        cells = self.table_grid(rows, col_count)
+
+        # Handle a 1x1 table as text.
+        if row_count == 1 and col_count == 1:
+            self.process_block(cells[0])
+            return
+
+        # Handle narrow tables as simple grids.
+        if col_count < 3:
+            self.dump_table(rows)
+            return
+
+        # Reformat table cells into records
+        texts = {}
+        def text(tc):
+            if tc not in texts:
+                texts[tc] = self.strip_text(self.cell_text(tc))
+            return texts[tc]
+
+        if self.structured:
+            print('<table>', file=self.result)
+        for row in range(1, row_count):
+            row_label = cells[row * col_count]
+            if self.structured:
+                print('<row>', file=self.result)
+            for col in range(0, col_count):
+                cell_label = cells[col]
+                cell_contents = cells[row * col_count + col]
+                if len(text(cell_contents)) == 0:
+                    continue
+                report = (row_label, cell_label, cell_contents)
+                if report not in reported_tuples:
+                    reported_tuples[report] = True
+                    print('%s: %s' % (text(cell_label), text(cell_contents)),
+                          file=self.result)
+        if self.structured:
+            print('</table>', file=self.result)
+
+
 def run_tests():
     file_name = 'DRAFT SCAP Key Actions and Work Plan (February 2023).docx'
     file = open(file_name, 'rb')
@@ -0,0 +1,80 @@
+from . import extract_docx
+import docx
+import io
+import os
+import unittest
+
+
+def build_doc():
+  """
+  Return a DOCX file with headings, tables and run content.
+  """
+  doc = docx.Document()
+  doc.add_heading('Title of the doc', 0)
+  doc.add_heading('First section', 1)
+  p = doc.add_paragraph('Some text ')
+  p.add_run('with\ttabs').bold = True
+  run = p.add_run('and a break')
+  run.add_break()
+  run.add_text('on the next line')
+  doc.add_paragraph('   ')
+
+  # Narrow table
+  table = doc.add_table(rows=3, cols=2)
+  for row in range(0, 3):
+    for col in range(0, 2):
+      table.cell(row, col).text = 'n%d%d\nline' % (row, col)
+
+  doc.add_heading('Second section', 2)
+  # Wide table with merged cells
+  table = doc.add_table(rows=4, cols=4)
+  for row in range(0, 4):
+    for col in range(0, 4):
+      table.cell(row, col).text = 'c%d%d' % (row, col)
+  table.cell(1, 1).merge(table.cell(2, 2))
+  table.cell(3, 0).merge(table.cell(3, 1))
+  table.cell(2, 3).text = ''
+
+  # Table of one cell with a table inside
+  table = doc.add_table(rows=1, cols=1)
+  cell = table.cell(0, 0)
+  cell.text = 'outer'
+  inner = cell.add_table(rows=2, cols=3)
+  for row in range(0, 2):
+    for col in range(0, 3):
+      inner.cell(row, col).text = 'i%d%d' % (row, col)
+  doc.add_paragraph('The end.')
+
+  f = io.BytesIO()
+  doc.save(f)
+  f.seek(0)
+  return f
+
+
+def extract(extract_class, file, structured):
+  file.seek(0)
+  docx_extract = extract_class(structured)
+  docx_extract.load_doc(file)
+  return docx_extract.get_result().read()
+
+
+class ExtractDocXTestCase(unittest.TestCase):
+
+  def testParity(self):
+    f = build_doc()
+    for structured in [ False, True ]:
+      expected = extract(extract_docx.DocXExtract, f, structured)
+      result = extract(extract_docx.FastDocXExtract, f, structured)
+      self.assertEqual(result, expected)
+    self.assertIn('<table>', result)
+    self.assertIn('<Heading2>', result)
+    self.assertIn('c03: c13', result)
+
+  def testSamples(self):
+    samples = os.path.join(os.path.dirname(__file__), 'samples')
+    for filename in [ 'PA utility.docx', 'PA Agenda.docx' ]:
+      with open(os.path.join(samples, filename), 'rb') as f:
+        for structured in [ False, True ]:
+          self.assertEqual(
+            extract(extract_docx.FastDocXExtract, f, structured),
+            extract(extract_docx.DocXExtract, f, structured))
@@ -0,0 +1,354 @@
+"""
+Store of the text extracted from documents, shared by all users.
+
+Entries are keyed by a digest of the uploaded file, so a file that
+was imported before by any user is not extracted again. An entry
+holds the text, the tokens of the cleaned text and the chunk plans
+used to start runs. Documents refer to an entry by key instead of
+holding their own copy of the text.
+
+Each document that refers to an entry is recorded, and an entry is
+removed when no document refers to it.
+"""
+import array
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS extract (
+  key TEXT PRIMARY KEY,
+  size INTEGER,
+  doc_tokens INTEGER,
+  page_counts TEXT,
+  plans TEXT,
+  refcount INTEGER NOT NULL DEFAULT 0,
+  created REAL
+);
+CREATE TABLE IF NOT EXISTS extract_ref (
+  username TEXT NOT NULL,
+  doc_name TEXT NOT NULL,
+  key TEXT NOT NULL,
+  PRIMARY KEY (username, doc_name)
+);
+CREATE INDEX IF NOT EXISTS extract_ref_key ON extract_ref (key);
+"""
+
+# Tokens read at a time from a file of tokens
+TOKEN_BLOCK_SIZE = 8192
+
+# Store used by documents, None to keep text in each document
+STORE = None
+
+# Store read by documents that already refer to stored text when STORE
+# is None, so they keep their text after the store is turned off
+FALLBACK = None
+
+
+def reader():
+  """
+  Return the store holding the text of documents with a text_key,
+  None if there is none.
+  """
+  if STORE is not None:
+    return STORE
+  return FALLBACK
+
+
+def plan_key(chunk_size, overlap):
+  return '%d:%s' % (chunk_size, overlap)
+
+
+class Entry:
+  """
+  Information about the text of a stored file.
+  """
+  def __init__(self, key, doc_tokens, page_counts, plans):
+    self.key = key
+    self.doc_tokens = doc_tokens
+    self.page_counts = page_counts
+    # Map of plan_key to a list of (start, end) token offsets
+    self.plans = plans
+
+  def get_plan(self, chunk_size, overlap):
+    return self.plans.get(plan_key(chunk_size, overlap))
+
+
+class EntryWriter:
+  """
+  Text and tokens of a new entry, written to temporary files as the
+  text is extracted, so the whole text is not kept in memory.
+  """
+  def __init__(self, path, key):
+    self.key = key
+    # Characters of text
+    self.size = 0
+    (fd, self.text_path) = tempfile.mkstemp(dir=path, suffix='.tmp')
+    self.text_file = os.fdopen(fd, 'wb')
+    (fd, self.tokens_path) = tempfile.mkstemp(dir=path, suffix='.tmp')
+    self.tokens_file = os.fdopen(fd, 'wb')
+
+  def write_text(self, text):
+    self.size += len(text)
+    self.text_file.write(text.encode('utf-8'))
+
+  def write_tokens(self, tokens):
+    array.array('I', tokens).tofile(self.tokens_file)
+
+  def token_blocks(self):
+    """
+    Yield the tokens written so far, TOKEN_BLOCK_SIZE at a time.
+    """
+    self.tokens_file.flush()
+    with open(self.tokens_path, 'rb') as f:
+      while True:
+        tokens = array.array('I')
+        try:
+          tokens.fromfile(f, TOKEN_BLOCK_SIZE)
+        except EOFError:
+          # Holds the tokens before the end
+          if len(tokens) > 0:
+            yield tokens.tolist()
+          return
+        yield tokens.tolist()
+
+  def close(self):
+    self.text_file.close()
+    self.tokens_file.close()
+
+  def discard(self):
+    self.close()
+    for path in [ self.text_path, self.tokens_path ]:
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+
+
+class ExtractStore:
+  """
+  Text and tokens in files under a directory, with the entries and
+  their references in a SQLite file.
+  """
+  def __init__(self, path):
+    self.path = path
+    os.makedirs(path, exist_ok=True)
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+    self.removed = 0
+    self.db = sqlite3.connect(os.path.join(path, 'extract.sqlite'),
+                              check_same_thread=False,
+                              isolation_level=None)
+    self.db.executescript(SCHEMA)
+
+  def file_path(self, key, ext):
+    return os.path.join(self.path, key[:2], key + ext)
+
+  def get(self, key):
+    """
+    Return the Entry for a key, None if there is none.
+    """
+    with self.lock:
+      row = self.db.execute(
+        "SELECT doc_tokens, page_counts, plans FROM extract WHERE key = ?",
+        (key,)).fetchone()
+      if row is None:
+        self.misses += 1
+        return None
+      self.hits += 1
+    plans = {}
+    for (name, spans) in json.loads(row[2]).items():
+      plans[name] = [ tuple(span) for span in spans ]
+    return Entry(key, row[0],
+                 [ tuple(counts) for counts in json.loads(row[1]) ], plans)
+
+  def get_text(self, key):
+    with open(self.file_path(key, '.txt'), 'rb') as f:
+      return f.read().decode('utf-8')
+
+  def get_tokens(self, key):
+    tokens = array.array('I')
+    with open(self.file_path(key, '.tok'), 'rb') as f:
+      tokens.frombytes(f.read())
+    return tokens
+
+  def new_entry(self, key):
+    """
+    Return an EntryWriter for the text of a file, added with put_entry.
+    """
+    return EntryWriter(self.path, key)
+
+  def put(self, key, text, tokens, doc_tokens, page_counts, plans,
+          username, doc_name):
+    """
+    Add the text of a file and a reference to it from a document.
+    """
+    writer = self.new_entry(key)
+    try:
+      writer.write_text(text)
+      writer.write_tokens(tokens)
+    except:
+      writer.discard()
+      raise
+    self.put_entry(writer, doc_tokens, page_counts, plans,
+                   username, doc_name)
+
+  def put_entry(self, writer, doc_tokens, page_counts, plans,
+                username, doc_name):
+    """
+    Add the entry written by writer and a reference to it from a
+    document. The files are dropped if the store has the entry.
+    """
+    key = writer.key
+    writer.close()
+    try:
+      with self.lock:
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+          # Files are moved in while the entry is locked, so a release
+          # of the last reference cannot remove them under the new entry.
+          row = self.db.execute("SELECT key FROM extract WHERE key = ?",
+                                (key,)).fetchone()
+          if row is None:
+            os.makedirs(os.path.dirname(self.file_path(key, '.txt')),
+                        exist_ok=True)
+            os.replace(writer.text_path, self.file_path(key, '.txt'))
+            os.replace(writer.tokens_path, self.file_path(key, '.tok'))
+            self.db.execute(
+              "INSERT INTO extract (key, size, doc_tokens, " +
+              "page_counts, plans, refcount, created) VALUES " +
+              "(?, ?, ?, ?, ?, 0, ?)",
+              (key, writer.size, doc_tokens, json.dumps(page_counts),
+               json.dumps(plans), time.time()))
+          self.add_ref_locked(username, doc_name, key)
+          self.db.execute("COMMIT")
+        except:
+          self.db.execute("ROLLBACK")
+          raise
+    finally:
+      writer.discard()
+
+  def add_ref(self, username, doc_name, key):
+    """
+    Record that a document refers to an entry. Returns False if the
+    entry no longer exists.
+    """
+    with self.lock:
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        row = self.db.execute("SELECT key FROM extract WHERE key = ?",
+                              (key,)).fetchone()
+        if row is not None:
+          self.add_ref_locked(username, doc_name, key)
+        self.db.execute("COMMIT")
+      except:
+        self.db.execute("ROLLBACK")
+        raise
+    return row is not None
+
+  def add_ref_locked(self, username, doc_name, key):
+    self.release_locked(username, doc_name)
+    self.db.execute("INSERT INTO extract_ref (username, doc_name, key) " +
+                    "VALUES (?, ?, ?)", (username, doc_name, key))
+    self.db.execute("UPDATE extract SET refcount = refcount + 1 " +
+                    "WHERE key = ?", (key,))
+
+  def release_locked(self, username, doc_name):
+    """
+    Remove the reference of a document. Returns the key of the entry
+    if it is no longer used.
+    """
+    row = self.db.execute("SELECT key FROM extract_ref " +
+                          "WHERE username = ? AND doc_name = ?",
+                          (username, doc_name)).fetchone()
+    if row is None:
+      return None
+    self.db.execute("DELETE FROM extract_ref " +
+                    "WHERE username = ? AND doc_name = ?",
+                    (username, doc_name))
+    self.db.execute("UPDATE extract SET refcount = refcount - 1 " +
+                    "WHERE key = ?", (row[0],))
+    (refcount,) = self.db.execute("SELECT refcount FROM extract " +
+                                  "WHERE key = ?", (row[0],)).fetchone()
+    if refcount > 0:
+      return None
+    self.db.execute("DELETE FROM extract WHERE key = ?", (row[0],))
+    return row[0]
+
+  def release(self, username, doc_name):
+    """
+    Remove the reference of a document, and the entry if no other
+    document refers to it.
+    """
+    self.release_docs(username, [ doc_name ])
+
+  def release_user(self, username):
+    """
+    Remove the references of all documents of a user.
+    """
+    with self.lock:
+      rows = self.db.execute("SELECT doc_name FROM extract_ref " +
+                             "WHERE username = ?", (username,)).fetchall()
+    self.release_docs(username, [ row[0] for row in rows ])
+
+  def release_docs(self, username, doc_names):
+    unused = []
+    with self.lock:
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        for doc_name in doc_names:
+          key = self.release_locked(username, doc_name)
+          if key is not None:
+            unused.append(key)
+        self.db.execute("COMMIT")
+      except:
+        self.db.execute("ROLLBACK")
+        raise
+      if len(unused) == 0:
+        return
+
+      # Another process may have stored the text again since the
+      # entries were removed, so only remove files without an entry.
+      self.db.execute("BEGIN IMMEDIATE")
+      try:
+        for key in unused:
+          row = self.db.execute("SELECT key FROM extract WHERE key = ?",
+                                (key,)).fetchone()
+          if row is not None:
+            continue
+          logging.info("remove extracted text %s", key)
+          for ext in [ '.txt', '.tok' ]:
+            try:
+              os.remove(self.file_path(key, ext))
+            except FileNotFoundError:
+              pass
+          self.removed += 1
+      finally:
+        self.db.execute("COMMIT")
+
+  def refcount(self, key):
+    with self.lock:
+      row = self.db.execute("SELECT refcount FROM extract WHERE key = ?",
+                            (key,)).fetchone()
+    return 0 if row is None else row[0]
+
+  def stats(self):
+    with self.lock:
+      (entries, size) = self.db.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM extract").fetchone()
+      (refs,) = self.db.execute("SELECT COUNT(*) FROM extract_ref").fetchone()
+      return { 'entries': entries,
+               'bytes': size,
+               'refs': refs,
+               'hits': self.hits,
+               'misses': self.misses,
+               'removed': self.removed }
+
+  def close(self):
+    with self.lock:
+      self.db.close()
@@ -0,0 +1,101 @@
+from . import extract_store
+import unittest
+import tempfile
+import os
+
+
+class ExtractStoreTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.store_dir = tempfile.TemporaryDirectory()
+    self.store = extract_store.ExtractStore(self.store_dir.name)
+    self.plans = { extract_store.plan_key(100, 0.1): [ (0, 2), (1, 3) ] }
+
+  def tearDown(self):
+    self.store.close()
+    self.store_dir.cleanup()
+
+  def testPutGet(self):
+    self.assertIsNone(self.store.get('key1'))
+    self.store.put('key1', 'some texté', [ 1, 2, 3 ], 3,
+                   [ (5, 2), (6, 1) ], self.plans, 'user1', 'doc1')
+    entry = self.store.get('key1')
+    self.assertEqual(entry.doc_tokens, 3)
+    self.assertEqual(entry.page_counts, [ (5, 2), (6, 1) ])
+    self.assertEqual(entry.get_plan(100, 0.1), [ (0, 2), (1, 3) ])
+    self.assertIsNone(entry.get_plan(100, 0))
+    self.assertEqual(self.store.get_text('key1'), 'some texté')
+    self.assertEqual(list(self.store.get_tokens('key1')), [ 1, 2, 3 ])
+
+    # Entries persist
+    self.store.close()
+    self.store = extract_store.ExtractStore(self.store_dir.name)
+    self.assertIsNotNone(self.store.get('key1'))
+    self.assertEqual(self.store.refcount('key1'), 1)
+
+  def testRefcount(self):
+    self.assertFalse(self.store.add_ref('user2', 'doc1', 'key1'))
+    self.store.put('key1', 'text', [ 1 ], 1, [], {}, 'user1', 'doc1')
+    self.assertTrue(self.store.add_ref('user2', 'doc1', 'key1'))
+    self.assertTrue(self.store.add_ref('user2', 'doc2', 'key1'))
+    # A document refers to one entry
+    self.assertTrue(self.store.add_ref('user2', 'doc2', 'key1'))
+    self.assertEqual(self.store.refcount('key1'), 3)
+
+    path = self.store.file_path('key1', '.txt')
+    self.store.release('user1', 'doc1')
+    self.store.release('user1', 'doc1')
+    self.assertEqual(self.store.refcount('key1'), 2)
+    self.assertTrue(os.path.exists(path))
+
+    # Removing the last reference removes the entry and its files
+    self.store.release_user('user2')
+    self.assertEqual(self.store.refcount('key1'), 0)
+    self.assertIsNone(self.store.get('key1'))
+    self.assertFalse(os.path.exists(path))
+    stats = self.store.stats()
+    self.assertEqual(stats['entries'], 0)
+    self.assertEqual(stats['refs'], 0)
+    self.assertEqual(stats['removed'], 1)
+
+  def testPutAgain(self):
+    self.store.put('key1', 'text', [ 1 ], 1, [], {}, 'user1', 'doc1')
+    path = self.store.file_path('key1', '.txt')
+    mtime = os.stat(path).st_mtime_ns
+
+    # The files of an entry are written once
+    self.store.put('key1', 'text', [ 1 ], 1, [], {}, 'user1', 'doc2')
+    self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+    self.assertEqual(self.store.refcount('key1'), 2)
+
+    # And again after the entry is removed
+    self.store.release_user('user1')
+    self.assertFalse(os.path.exists(path))
+    self.store.put('key1', 'text', [ 1 ], 1, [], {}, 'user1', 'doc1')
+    self.assertEqual(self.store.get_text('key1'), 'text')
+
+  def testEntryWriter(self):
+    block_size = extract_store.TOKEN_BLOCK_SIZE
+    extract_store.TOKEN_BLOCK_SIZE = 2
+    try:
+      writer = self.store.new_entry('key1')
+      writer.write_text('some ')
+      writer.write_text('texté')
+      writer.write_tokens([ 1, 2, 3 ])
+      writer.write_tokens([ 4, 5 ])
+      self.assertEqual(list(writer.token_blocks()),
+                       [ [ 1, 2 ], [ 3, 4 ], [ 5 ] ])
+    finally:
+      extract_store.TOKEN_BLOCK_SIZE = block_size
+    self.store.put_entry(writer, 5, [], {}, 'user1', 'doc1')
+    self.assertEqual(self.store.get_text('key1'), 'some texté')
+    self.assertEqual(list(self.store.get_tokens('key1')), [ 1, 2, 3, 4, 5 ])
+    self.assertEqual(self.store.stats()['bytes'], 10)
+
+    # The files of a stored entry are dropped
+    writer = self.store.new_entry('key1')
+    writer.write_text('other')
+    self.store.put_entry(writer, 1, [], {}, 'user1', 'doc2')
+    self.assertEqual(self.store.get_text('key1'), 'some texté')
+    self.assertEqual([ name for name in os.listdir(self.store_dir.name)
+                       if name.endswith('.tmp') ], [])
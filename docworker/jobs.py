@@ -0,0 +1,658 @@
+"""
+Persistent queue of background jobs and the pool of workers that
+run them.
+
+Jobs are stored in the job table of the application database. A
+worker claims a job by taking a lease, and keeps the lease current
+with heartbeats while the job runs. Jobs with an expired lease are
+claimed again by another worker, so jobs survive a restart.
+
+Workers run in the web server process, or in separate processes
+started with the docworker-worker command.
+
+Uploaded files are converted to documents by convert jobs, run by
+their own pool of workers so long conversions do not hold up runs.
+
+Async runs are owned by the doc gen event loop: the worker thread
+that claimed the job is free once the run is submitted, and the job
+is finished when the run is done.
+"""
+from . import document
+from . import doc_convert
+from . import doc_gen
+from . import doc_gen_async
+from . import users
+import argparse
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+
+# Job states
+STATE_QUEUED = 'queued'
+STATE_RUNNING = 'running'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+STATE_CANCELED = 'canceled'
+
+# Job kinds
+KIND_DOCGEN = 'docgen'
+KIND_CONVERT = 'convert'
+
+# Seconds a worker owns a job without a heartbeat
+LEASE_SECONDS = 60
+
+# Seconds between heartbeats
+HEARTBEAT_SECONDS = 15
+
+# Seconds between checks if a running job was canceled
+CANCEL_CHECK_SECONDS = 1
+
+# Number of times a job is claimed before it is marked failed
+MAX_ATTEMPTS = 3
+
+# Seconds between checks for new jobs by a long running worker
+POLL_SECONDS = 2
+
+# Seconds between updates of the progress of a job
+PROGRESS_SECONDS = 1
+
+# Async runs a pool keeps on the doc gen loop at once
+MAX_ASYNC_JOBS = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS job (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,
+  username TEXT NOT NULL,
+  doc_name TEXT NOT NULL,
+  run_id INTEGER,
+  options TEXT,
+  state TEXT NOT NULL,
+  worker TEXT,
+  lease_expires REAL DEFAULT 0,
+  attempts INTEGER DEFAULT 0,
+  created REAL,
+  updated REAL,
+  progress TEXT,
+  result TEXT,
+  error TEXT
+);
+CREATE INDEX IF NOT EXISTS job_state ON job (state, kind);
+CREATE INDEX IF NOT EXISTS job_doc ON job (username, doc_name);
+"""
+
+
+def ensure_schema(db):
+  """
+  Create the job table if it does not exist, and add columns
+  missing from an older table.
+  """
+  db.executescript(SCHEMA)
+  columns = [ row[1] for row in db.execute("PRAGMA table_info(job)") ]
+  for name in [ 'progress', 'result', 'error' ]:
+    if name not in columns:
+      db.execute("ALTER TABLE job ADD COLUMN %s TEXT" % name)
+  db.commit()
+
+
+def connect(db_path):
+  """
+  Open a database connection for use by a worker.
+  """
+  db = sqlite3.connect(db_path, timeout=30, isolation_level=None,
+                       detect_types=sqlite3.PARSE_DECLTYPES)
+  db.row_factory = sqlite3.Row
+  return db
+
+
+def enqueue(db, kind, username, doc_name, run_id=None, options=None):
+  """
+  Add a job to the queue and return the job id.
+  """
+  now = time.time()
+  cursor = db.execute(
+    "INSERT INTO job (kind, username, doc_name, run_id, options, state, " +
+    "created, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+    (kind, username, doc_name, run_id, json.dumps(options or {}),
+     STATE_QUEUED, now, now))
+  db.commit()
+  logging.info("queued %s job %d for %s", kind, cursor.lastrowid, doc_name)
+  return cursor.lastrowid
+
+
+def resume_run(db, username, doc_name, run_id):
+  """
+  Queue a docgen job to continue a run, unless one is already
+  queued or running. Return the job id.
+  """
+  row = db.execute(
+    "SELECT id, state, options FROM job WHERE kind = ? AND username = ? " +
+    "AND doc_name = ? AND run_id = ? ORDER BY id DESC LIMIT 1",
+    (KIND_DOCGEN, username, doc_name, run_id)).fetchone()
+  if row is not None and row['state'] in (STATE_QUEUED, STATE_RUNNING):
+    return row['id']
+  options = {}
+  if row is not None:
+    options = json.loads(row['options'] or '{}')
+  return enqueue(db, KIND_DOCGEN, username, doc_name, run_id, options)
+
+
+def claim(db, worker, kinds, fail_fn=None):
+  """
+  Take a lease on the next queued job, or a job with an expired lease.
+  Return the job row, or None if no job is available.
+
+  A job whose lease expired after MAX_ATTEMPTS claims stopped its
+  worker each time, so it is marked failed instead, and fail_fn is
+  called with its row.
+  """
+  now = time.time()
+  marks = ','.join('?' * len(kinds))
+  db.execute("BEGIN IMMEDIATE")
+  try:
+    failed = db.execute(
+      "SELECT * FROM job WHERE kind IN (%s) AND " % marks +
+      "state = ? AND lease_expires < ? AND attempts >= ?",
+      tuple(kinds) + (STATE_RUNNING, now, MAX_ATTEMPTS)).fetchall()
+    for row in failed:
+      db.execute("UPDATE job SET state = ?, lease_expires = 0, " +
+                 "updated = ? WHERE id = ?", (STATE_FAILED, now, row['id']))
+    job = db.execute(
+      "SELECT * FROM job WHERE kind IN (%s) AND " % marks +
+      "(state = ? OR (state = ? AND lease_expires < ?)) " +
+      "ORDER BY id LIMIT 1",
+      tuple(kinds) + (STATE_QUEUED, STATE_RUNNING, now)).fetchone()
+    if job is not None:
+      db.execute(
+        "UPDATE job SET state = ?, worker = ?, lease_expires = ?, " +
+        "attempts = attempts + 1, updated = ? WHERE id = ?",
+        (STATE_RUNNING, worker, now + LEASE_SECONDS, now, job['id']))
+      job = db.execute("SELECT * FROM job WHERE id = ?",
+                       (job['id'],)).fetchone()
+    db.execute("COMMIT")
+  except:
+    db.execute("ROLLBACK")
+    raise
+  for row in failed:
+    logging.error("job %d failed after %d attempts", row['id'],
+                  row['attempts'])
+    if fail_fn is not None:
+      try:
+        fail_fn(row)
+      except Exception:
+        logging.exception("failed to clean up job %d", row['id'])
+  return job
+
+
+def heartbeat(db, job_id, worker):
+  """
+  Extend the lease on a job. Returns False if the worker no
+  longer owns the job.
+  """
+  now = time.time()
+  cursor = db.execute(
+    "UPDATE job SET lease_expires = ?, updated = ? " +
+    "WHERE id = ? AND worker = ? AND state = ?",
+    (now + LEASE_SECONDS, now, job_id, worker, STATE_RUNNING))
+  db.commit()
+  return cursor.rowcount == 1
+
+
+def cancel_run(db, username, doc_name, run_id):
+  """
+  Cancel the queued or running job for a run. Returns the state of
+  the job before it was canceled, None if there was no such job.
+  A worker stops a running job when it sees the job was canceled.
+  """
+  db.execute("BEGIN IMMEDIATE")
+  try:
+    row = db.execute(
+      "SELECT id, state FROM job WHERE kind = ? AND username = ? AND " +
+      "doc_name = ? AND run_id = ? AND state IN (?, ?) " +
+      "ORDER BY id DESC LIMIT 1",
+      (KIND_DOCGEN, username, doc_name, run_id,
+       STATE_QUEUED, STATE_RUNNING)).fetchone()
+    if row is not None:
+      db.execute("UPDATE job SET state = ?, updated = ? WHERE id = ?",
+                 (STATE_CANCELED, time.time(), row['id']))
+    db.execute("COMMIT")
+  except:
+    db.execute("ROLLBACK")
+    raise
+  if row is None:
+    return None
+  logging.info("canceled job %d", row['id'])
+  return row['state']
+
+
+def get_job(db, job_id, username):
+  """
+  Return the job row with the id for the user, None if there is none.
+  """
+  return db.execute("SELECT * FROM job WHERE id = ? AND username = ?",
+                    (job_id, username)).fetchone()
+
+
+def get_active_jobs(db, username, kind):
+  """
+  Return the queued and running jobs of a kind for a user.
+  """
+  return db.execute(
+    "SELECT * FROM job WHERE username = ? AND kind = ? AND " +
+    "state IN (?, ?) ORDER BY id",
+    (username, kind, STATE_QUEUED, STATE_RUNNING)).fetchall()
+
+
+def set_progress(db, job_id, progress):
+  db.execute("UPDATE job SET progress = ?, updated = ? WHERE id = ?",
+             (progress, time.time(), job_id))
+  db.commit()
+
+
+def set_result(db, job_id, result, error=None):
+  db.execute("UPDATE job SET result = ?, error = ?, updated = ? " +
+             "WHERE id = ?", (result, error, time.time(), job_id))
+  db.commit()
+
+
+def is_canceled(db, job_id):
+  row = db.execute("SELECT state FROM job WHERE id = ?",
+                   (job_id,)).fetchone()
+  return row is not None and row['state'] == STATE_CANCELED
+
+
+def finish(db, job_id, worker, state=STATE_DONE):
+  """
+  Mark a job owned by the worker as done or failed.
+  """
+  db.execute(
+    "UPDATE job SET state = ?, lease_expires = 0, updated = ? " +
+    "WHERE id = ? AND worker = ? AND state != ?",
+    (state, time.time(), job_id, worker, STATE_CANCELED))
+  db.commit()
+
+
+def next_lease_expiry(db, kinds, worker_prefix):
+  """
+  Return the time the next lease held by another process expires,
+  None if there are no such leases.
+  """
+  marks = ','.join('?' * len(kinds))
+  row = db.execute(
+    "SELECT MIN(lease_expires) FROM job WHERE kind IN (%s) " % marks +
+    "AND state = ? AND worker NOT LIKE ?",
+    tuple(kinds) + (STATE_RUNNING, worker_prefix + '%')).fetchone()
+  return row[0]
+
+
+def get_run_leases(db, username, doc_name):
+  """
+  Return a dictionary of run_id to lease expiration time for the
+  docgen jobs of a document that are not finished. Queued jobs
+  do not expire.
+  """
+  result = {}
+  for row in db.execute(
+      "SELECT run_id, state, lease_expires FROM job " +
+      "WHERE username = ? AND doc_name = ? AND kind = ?",
+      (username, doc_name, KIND_DOCGEN)).fetchall():
+    if row['state'] == STATE_QUEUED:
+      result[row['run_id']] = float('inf')
+    elif row['state'] == STATE_RUNNING:
+      result[row['run_id']] = row['lease_expires']
+    else:
+      result[row['run_id']] = 0
+  return result
+
+
+def apply_run_leases(db, username, doc_name, doc):
+  """
+  Set the lease on the run records of a document so is_running
+  reflects the state of the job queue.
+  """
+  for (run_id, lease) in get_run_leases(db, username, doc_name).items():
+    run_record = doc.get_run_record(run_id)
+    if run_record is not None:
+      run_record.lease_expires = lease
+
+
+def charge_run_cost(db, username, doc, run_state, result_id):
+  """
+  Charge the user for the tokens consumed by a run.
+  """
+  if run_state.abandon.is_set():
+    # Charged by the worker that took over the run
+    return
+  if result_id is not None or run_state.cancel.is_set():
+    family = doc.get_completion_list(run_state.run_id)
+    tokens = sum(item.token_cost for item in family)
+    users.increment_tokens(db, username, tokens)
+    logging.info("updated cost for %s of %d tokens", username, tokens)
+
+
+class JobCancel(threading.Event):
+  """
+  Set to stop a running job. lease_lost is set as well when another
+  worker may have claimed the job, so the job must not save its
+  results or charge for them.
+  """
+  def __init__(self):
+    super().__init__()
+    self.lease_lost = threading.Event()
+
+
+class Deferred:
+  """
+  Returned by a job handler whose work goes on after it returns. The
+  job is finished when future is done, after complete_fn(db, result)
+  is called with a connection of its own.
+  """
+  def __init__(self, future, complete_fn):
+    self.future = future
+    self.complete_fn = complete_fn
+
+
+def doc_file_path(instance_path, username, doc_name):
+  return os.path.join(instance_path, username, doc_name + '.daf')
+
+
+def run_docgen_job(db, instance_path, job, cancel):
+  """
+  Run the doc generation for a job. Setting the cancel event
+  stops the run.
+  """
+  file_path = doc_file_path(instance_path, job['username'], job['doc_name'])
+  doc = document.load_document(file_path)
+  run_state = doc_gen.load_run_state(doc, job['run_id'])
+  if run_state is None:
+    # The run was interrupted before checkpoints and can not be continued.
+    doc.mark_cancel_run("Run was interrupted.", job['run_id'])
+    document.save_document(file_path, doc)
+    return
+
+  options = json.loads(job['options'] or '{}')
+  run_state.max_workers = options.get('max_workers', run_state.max_workers)
+  run_state.pipeline = options.get('pipeline', run_state.pipeline)
+  run_state.use_cache = options.get('use_cache', run_state.use_cache)
+  run_state.cancel = cancel
+  run_state.abandon = cancel.lease_lost
+
+  if options.get('async'):
+    # The loop owns the run, the cost is charged when it is done
+    future = doc_gen_async.get_docgen_loop().submit(
+      doc_gen_async.run_all_docgen_async(file_path, doc, run_state))
+    return Deferred(future,
+                    lambda db, result_id: charge_run_cost(
+                      db, job['username'], doc, run_state, result_id))
+  result_id = doc_gen.run_all_docgen(file_path, doc, run_state)
+  charge_run_cost(db, job['username'], doc, run_state, result_id)
+
+
+def fail_docgen_job(instance_path, job):
+  """
+  Mark the run of a failed job as complete.
+  """
+  file_path = doc_file_path(instance_path, job['username'], job['doc_name'])
+  doc = document.load_document(file_path)
+  run_record = doc.get_run_record(job['run_id'])
+  if run_record is not None and run_record.stop_time is None:
+    doc.mark_cancel_run("Run failed.", job['run_id'])
+    document.save_document(file_path, doc)
+
+
+def upload_dir(instance_path):
+  return os.path.join(instance_path, 'uploads')
+
+
+def save_upload(instance_path, file):
+  """
+  Copy an uploaded file to the upload directory for a convert job.
+  Returns the name of the copy.
+  """
+  os.makedirs(upload_dir(instance_path), exist_ok=True)
+  (fd, path) = tempfile.mkstemp(dir=upload_dir(instance_path),
+                                suffix='.upload')
+  with os.fdopen(fd, 'wb') as f:
+    shutil.copyfileobj(file, f, document.READ_BLOCK_SIZE)
+  return os.path.basename(path)
+
+
+def remove_upload(instance_path, job):
+  options = json.loads(job['options'] or '{}')
+  try:
+    os.remove(os.path.join(upload_dir(instance_path), options['upload']))
+  except (KeyError, FileNotFoundError):
+    pass
+
+
+def run_convert_job(db, instance_path, job, cancel):
+  """
+  Create a document from an uploaded file. The name of the document,
+  or the reason the file could not be read, is the job result.
+  """
+  options = json.loads(job['options'] or '{}')
+  user_dir = os.path.join(instance_path, job['username'])
+  last_update = time.monotonic()
+
+  def progress(pages, count):
+    nonlocal last_update
+    if time.monotonic() - last_update >= PROGRESS_SECONDS or pages == count:
+      last_update = time.monotonic()
+      set_progress(db, job['id'], "page %d of %d" % (pages, count))
+
+  set_progress(db, job['id'], "reading")
+  try:
+    with open(os.path.join(upload_dir(instance_path),
+                           options['upload']), 'rb') as f:
+      doc_name = document.find_or_create_doc(user_dir, job['doc_name'], f,
+                                             progress)
+    set_result(db, job['id'], doc_name)
+  except doc_convert.DocError as err:
+    set_result(db, job['id'], None, str(err))
+  remove_upload(instance_path, job)
+
+
+def fail_convert_job(instance_path, job):
+  remove_upload(instance_path, job)
+
+
+class WorkerPool:
+  """
+  A fixed size set of threads that claim and run jobs.
+
+  With idle_exit set, worker threads exit when there is no work and
+  are started again by notify. Otherwise they poll for new jobs.
+  """
+  def __init__(self, db_path, instance_path, size, idle_exit=True,
+               kinds=None):
+    self.db_path = db_path
+    self.instance_path = instance_path
+    self.size = size
+    self.idle_exit = idle_exit
+    self.kinds = kinds or [ KIND_DOCGEN ]
+    self.handlers = { KIND_DOCGEN: (run_docgen_job, fail_docgen_job),
+                      KIND_CONVERT: (run_convert_job, fail_convert_job) }
+    self.lock = threading.Lock()
+    self.threads = []
+    # Deferred jobs not yet finished, see run_job
+    self.async_count = 0
+    self.async_done = threading.Condition(self.lock)
+    self.worker_prefix = "%s:%d:%d:" % (socket.gethostname(), os.getpid(),
+                                        id(self))
+    self.next_worker = 0
+    self.stopping = False
+
+  def add_handler(self, kind, run_fn, fail_fn):
+    """
+    Add a function to run jobs of a kind.
+    """
+    self.kinds.append(kind)
+    self.handlers[kind] = (run_fn, fail_fn)
+
+  def fail_job(self, job):
+    """
+    Clean up after a job that will not be run again.
+    """
+    (run_fn, fail_fn) = self.handlers[job['kind']]
+    fail_fn(self.instance_path, job)
+
+  def notify(self):
+    """
+    Start worker threads, up to the pool size, to look for work.
+    """
+    with self.lock:
+      self.threads = [ x for x in self.threads if x.is_alive() ]
+      while len(self.threads) < self.size:
+        name = self.worker_prefix + str(self.next_worker)
+        self.next_worker += 1
+        thread = threading.Thread(target=self.worker_loop, args=(name,),
+                                  name=name, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+
+  def stop(self):
+    self.stopping = True
+    for thread in list(self.threads):
+      thread.join()
+    with self.lock:
+      while self.async_count > 0:
+        self.async_done.wait()
+
+  def run_forever(self):
+    """
+    Run workers in the current process until interrupted.
+    """
+    self.notify()
+    try:
+      while True:
+        time.sleep(POLL_SECONDS)
+        self.notify()
+    except KeyboardInterrupt:
+      self.stop()
+
+  def worker_loop(self, name):
+    db = connect(self.db_path)
+    try:
+      while not self.stopping:
+        job = claim(db, name, self.kinds, self.fail_job)
+        if job is not None:
+          self.run_job(db, name, job)
+          continue
+
+        # Wait for new jobs, or leases of other processes to expire
+        expires = next_lease_expiry(db, self.kinds, self.worker_prefix)
+        if self.idle_exit and expires is None:
+          break
+        wait = POLL_SECONDS
+        if self.idle_exit:
+          wait = max(0.1, expires - time.time() + 0.1)
+        time.sleep(wait)
+    finally:
+      db.close()
+
+  def run_job(self, db, name, job):
+    run_fn = self.handlers[job['kind']][0]
+    done = threading.Event()
+    cancel = JobCancel()
+
+    def send_heartbeats():
+      hb_db = connect(self.db_path)
+      last_beat = time.monotonic()
+      while not done.wait(CANCEL_CHECK_SECONDS):
+        if not cancel.is_set() and is_canceled(hb_db, job['id']):
+          logging.info("stopping canceled job %d", job['id'])
+          cancel.set()
+        if time.monotonic() - last_beat >= HEARTBEAT_SECONDS:
+          last_beat = time.monotonic()
+          if (not heartbeat(hb_db, job['id'], name) and
+              not cancel.is_set() and not is_canceled(hb_db, job['id'])):
+            logging.warning("lost lease on job %d, stopping", job['id'])
+            cancel.lease_lost.set()
+            cancel.set()
+      hb_db.close()
+
+    def failed_state():
+      logging.exception("job %d failed", job['id'])
+      if job['attempts'] < MAX_ATTEMPTS or cancel.lease_lost.is_set():
+        return STATE_QUEUED
+      try:
+        self.fail_job(job)
+      except Exception:
+        logging.exception("failed to clean up job %d", job['id'])
+      return STATE_FAILED
+
+    def finish_deferred(deferred):
+      finish_db = connect(self.db_path)
+      try:
+        try:
+          deferred.complete_fn(finish_db, deferred.future.result())
+          state = STATE_DONE
+        except Exception:
+          state = failed_state()
+        done.set()
+        hb_thread.join()
+        finish(finish_db, job['id'], name, state)
+      finally:
+        finish_db.close()
+        with self.lock:
+          self.async_count -= 1
+          self.async_done.notify_all()
+
+    hb_thread = threading.Thread(target=send_heartbeats, daemon=True)
+    hb_thread.start()
+    state = STATE_DONE
+    deferred = None
+    try:
+      logging.info("%s running job %d", name, job['id'])
+      deferred = run_fn(db, self.instance_path, job, cancel)
+    except Exception:
+      state = failed_state()
+
+    if isinstance(deferred, Deferred):
+      with self.lock:
+        while self.async_count >= MAX_ASYNC_JOBS:
+          self.async_done.wait()
+        self.async_count += 1
+      # Finish on a thread of its own, the future may be done on the
+      # doc gen loop
+      deferred.future.add_done_callback(
+        lambda future: threading.Thread(target=finish_deferred,
+                                        args=(deferred,),
+                                        daemon=True).start())
+      return
+    done.set()
+    hb_thread.join()
+    finish(db, job['id'], name, state)
+
+
+def main():
+  """
+  Entry point for docworker-worker: run jobs outside the web server.
+  """
+  from . import analysis_app
+  parser = argparse.ArgumentParser(description='DocWorker job worker.')
+  parser.add_argument('--workers', type=int, default=2)
+  parser.add_argument('--convert_workers', type=int, default=1)
+  parser.add_argument('--fakeai', action='store_true')
+  args = parser.parse_args()
+
+  app = analysis_app.create_app(fakeai=args.fakeai,
+                                start_workers=False)
+  if args.convert_workers > 0:
+    convert_pool = analysis_app.create_worker_pool(
+      app, args.convert_workers, idle_exit=False, kinds=[ KIND_CONVERT ])
+    logging.info("starting %d convert workers", args.convert_workers)
+    convert_pool.notify()
+  pool = analysis_app.create_worker_pool(app, args.workers, idle_exit=False)
+  logging.info("starting %d workers", args.workers)
+  pool.run_forever()
+
+
+if __name__ == "__main__":
+  main()
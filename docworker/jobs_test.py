@@ -0,0 +1,332 @@
+from . import jobs
+from . import document
+from . import doc_gen
+from . import users
+import concurrent.futures
+import unittest
+import tempfile
+import time
+import os
+
+
+class JobQueueTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.db = jobs.connect(os.path.join(self.dir.name, 'test.sqlite'))
+    jobs.ensure_schema(self.db)
+
+  def tearDown(self):
+    self.db.close()
+    self.dir.cleanup()
+
+  def testClaimOrder(self):
+    id1 = jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', 'doc1', 1)
+    id2 = jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', 'doc2', 1)
+    self.assertEqual(jobs.claim(self.db, 'w1', [jobs.KIND_DOCGEN])['id'], id1)
+    self.assertEqual(jobs.claim(self.db, 'w2', [jobs.KIND_DOCGEN])['id'], id2)
+    self.assertIsNone(jobs.claim(self.db, 'w3', [jobs.KIND_DOCGEN]))
+    self.assertIsNone(jobs.claim(self.db, 'w3', ['other']))
+
+  def testExpiredLease(self):
+    id = jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', 'doc', 1)
+    job = jobs.claim(self.db, 'w1', [jobs.KIND_DOCGEN])
+    self.assertTrue(jobs.heartbeat(self.db, id, 'w1'))
+    self.assertIsNone(jobs.claim(self.db, 'w2', [jobs.KIND_DOCGEN]))
+
+    # Expire the lease, another worker takes over
+    self.db.execute("UPDATE job SET lease_expires = ?", (time.time() - 1,))
+    job = jobs.claim(self.db, 'w2', [jobs.KIND_DOCGEN])
+    self.assertEqual(job['id'], id)
+    self.assertEqual(job['attempts'], 2)
+    self.assertFalse(jobs.heartbeat(self.db, id, 'w1'))
+
+    jobs.finish(self.db, id, 'w2')
+    self.assertEqual(jobs.get_run_leases(self.db, 'user', 'doc'), { 1: 0 })
+
+  def testWorkerDied(self):
+    id = jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', 'doc', 1)
+    failed = []
+    # Each worker stops without finishing the job
+    for i in range(jobs.MAX_ATTEMPTS):
+      job = jobs.claim(self.db, 'w%d' % i, [jobs.KIND_DOCGEN], failed.append)
+      self.assertEqual(job['id'], id)
+      self.db.execute("UPDATE job SET lease_expires = ?", (time.time() - 1,))
+
+    # The job is not claimed again, the fail function cleans up
+    self.assertIsNone(jobs.claim(self.db, 'w', [jobs.KIND_DOCGEN],
+                                 failed.append))
+    self.assertEqual([ row['id'] for row in failed ], [ id ])
+    row = self.db.execute("SELECT state FROM job WHERE id = ?",
+                          (id,)).fetchone()
+    self.assertEqual(row['state'], jobs.STATE_FAILED)
+    self.assertIsNone(jobs.claim(self.db, 'w', [jobs.KIND_DOCGEN],
+                                 failed.append))
+    self.assertEqual(len(failed), 1)
+
+  def testCancel(self):
+    id = jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', 'doc', 1)
+    self.assertEqual(jobs.cancel_run(self.db, 'user', 'doc', 1),
+                     jobs.STATE_QUEUED)
+    self.assertIsNone(jobs.claim(self.db, 'w1', [jobs.KIND_DOCGEN]))
+    self.assertTrue(jobs.is_canceled(self.db, id))
+    self.assertIsNone(jobs.cancel_run(self.db, 'user', 'doc', 1))
+
+    id = jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', 'doc', 2)
+    jobs.claim(self.db, 'w1', [jobs.KIND_DOCGEN])
+    self.assertEqual(jobs.cancel_run(self.db, 'user', 'doc', 2),
+                     jobs.STATE_RUNNING)
+    self.assertFalse(jobs.heartbeat(self.db, id, 'w1'))
+    # The canceled state is kept when the worker finishes
+    jobs.finish(self.db, id, 'w1')
+    self.assertTrue(jobs.is_canceled(self.db, id))
+
+  def testRunLeases(self):
+    jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', 'doc', 1)
+    jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', 'doc', 2)
+    jobs.claim(self.db, 'w1', [jobs.KIND_DOCGEN])
+    leases = jobs.get_run_leases(self.db, 'user', 'doc')
+    self.assertGreater(leases[1], time.time())
+    self.assertEqual(leases[2], float('inf'))
+
+
+  def testAddColumns(self):
+    self.db.execute("DROP TABLE job")
+    self.db.execute("CREATE TABLE job (id INTEGER PRIMARY KEY, " +
+                    "kind TEXT, username TEXT, doc_name TEXT, " +
+                    "run_id INTEGER, options TEXT, state TEXT, worker TEXT, " +
+                    "lease_expires REAL DEFAULT 0, attempts INTEGER DEFAULT 0, " +
+                    "created REAL, updated REAL)")
+    jobs.ensure_schema(self.db)
+    id = jobs.enqueue(self.db, jobs.KIND_CONVERT, 'user', 'doc')
+    jobs.set_progress(self.db, id, 'page 1 of 2')
+    jobs.set_result(self.db, id, 'doc')
+    job = jobs.get_job(self.db, id, 'user')
+    self.assertEqual(job['progress'], 'page 1 of 2')
+    self.assertEqual(job['result'], 'doc')
+    self.assertIsNone(jobs.get_job(self.db, id, 'other'))
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.dir = tempfile.TemporaryDirectory()
+    self.db_path = os.path.join(self.dir.name, 'test.sqlite')
+    self.db = jobs.connect(self.db_path)
+    with open(os.path.join(os.path.dirname(__file__), 'schema.sql')) as f:
+      self.db.executescript(f.read())
+    users.add_or_update_user(self.db, 'user', 100000)
+
+    user_dir = os.path.join(self.dir.name, 'user')
+    os.mkdir(user_dir)
+    orig_file = 'PA utility.docx'
+    path = os.path.join(os.path.dirname(__file__), 'samples/', orig_file)
+    with open(path, 'rb') as f:
+      self.doc_name = document.find_or_create_doc(user_dir, orig_file, f)
+    self.doc_path = jobs.doc_file_path(self.dir.name, 'user', self.doc_name)
+    doc_gen.FAKE_AI_COMPLETION=True
+    doc_gen.FAKE_AI_SLEEP=0
+
+  def tearDown(self):
+    self.db.close()
+    self.dir.cleanup()
+
+  def wait_jobs(self):
+    for i in range(0, 100):
+      row = self.db.execute("SELECT COUNT(*) FROM job WHERE state IN (?, ?)",
+                            (jobs.STATE_QUEUED, jobs.STATE_RUNNING)).fetchone()
+      if row[0] == 0:
+        return
+      time.sleep(0.1)
+    self.fail("jobs did not complete")
+
+  def testRunJob(self):
+    doc = document.load_document(self.doc_path)
+    run_state = doc_gen.start_docgen(self.doc_path, doc, 'a prompt')
+    jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', self.doc_name,
+                 run_state.run_id)
+    jobs.apply_run_leases(self.db, 'user', self.doc_name, doc)
+    self.assertTrue(doc.is_running())
+
+    pool = jobs.WorkerPool(self.db_path, self.dir.name, 2)
+    pool.notify()
+    self.wait_jobs()
+    pool.stop()
+
+    doc = document.load_document(self.doc_path)
+    jobs.apply_run_leases(self.db, 'user', self.doc_name, doc)
+    self.assertFalse(doc.is_running())
+    self.assertIsNotNone(doc.get_result_item(run_state.run_id))
+    self.assertLess(users.token_count(self.db, 'user'), 100000)
+
+  def testFailedRun(self):
+    doc = document.load_document(self.doc_path)
+    run_state = doc_gen.start_docgen(self.doc_path, doc, 'a prompt')
+    id = jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', self.doc_name,
+                      run_state.run_id)
+    # Workers stopped by the job on every attempt
+    self.db.execute("UPDATE job SET state = ?, attempts = ?, " +
+                    "lease_expires = ? WHERE id = ?",
+                    (jobs.STATE_RUNNING, jobs.MAX_ATTEMPTS,
+                     time.time() - 1, id))
+    doc = document.load_document(self.doc_path)
+    newer = doc_gen.start_docgen(self.doc_path, doc, 'another prompt')
+
+    pool = jobs.WorkerPool(self.db_path, self.dir.name, 1)
+    pool.notify()
+    self.wait_jobs()
+    pool.stop()
+
+    self.assertEqual(jobs.get_job(self.db, id, 'user')['state'],
+                     jobs.STATE_FAILED)
+    doc = document.load_document(self.doc_path)
+    self.assertIsNotNone(doc.get_run_record(run_state.run_id).stop_time)
+    # A newer run of the document is not stopped
+    self.assertIsNone(doc.get_run_record(newer.run_id).stop_time)
+
+  def run_interrupted(self, checkpoint):
+    doc = document.load_document(self.doc_path)
+    run_state = doc_gen.start_docgen(self.doc_path, doc, 'a prompt')
+    doc_gen.run_next_docgen(self.doc_path, doc, run_state)
+    if not checkpoint:
+      doc.set_run_checkpoint(None, run_state.run_id)
+    document.save_document(self.doc_path, doc)
+    jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', self.doc_name,
+                 run_state.run_id)
+
+    pool = jobs.WorkerPool(self.db_path, self.dir.name, 1)
+    pool.notify()
+    self.wait_jobs()
+    pool.stop()
+
+    doc = document.load_document(self.doc_path)
+    self.assertFalse(doc.is_running())
+    return doc.get_run_record(run_state.run_id)
+
+  def testResumedRun(self):
+    run_record = self.run_interrupted(True)
+    self.assertNotEqual(run_record.result_id, 0)
+    self.assertIsNone(run_record.checkpoint)
+    # The first segment was not run again
+    first = run_record.doc_segments[0].id()
+    self.assertEqual(len([ x for x in run_record.completions
+                           if first in x.input_ids ]), 1)
+
+  def testInterruptedRun(self):
+    # Runs without a checkpoint can not continue
+    run_record = self.run_interrupted(False)
+    self.assertEqual(run_record.result_id, 0)
+
+  def testDeferredJobs(self):
+    futures = []
+    completed = []
+    def run_fn(db, instance_path, job, cancel):
+      futures.append(concurrent.futures.Future())
+      return jobs.Deferred(
+        futures[-1], lambda db, result: completed.append(result))
+    pool = jobs.WorkerPool(self.db_path, self.dir.name, 1, kinds=[])
+    pool.add_handler('deferred', run_fn, lambda instance_path, job: None)
+    for i in range(0, 2):
+      jobs.enqueue(self.db, 'deferred', 'user', self.doc_name)
+    pool.notify()
+
+    # One worker took both jobs without waiting for the first
+    for i in range(0, 100):
+      if len(futures) == 2:
+        break
+      time.sleep(0.1)
+    self.assertEqual(len(futures), 2)
+    self.assertEqual(len(jobs.get_active_jobs(self.db, 'user', 'deferred')),
+                     2)
+    for (i, future) in enumerate(futures):
+      future.set_result(i)
+    self.wait_jobs()
+    pool.stop()
+    self.assertEqual(sorted(completed), [ 0, 1 ])
+
+  def testLostLease(self):
+    lost = []
+    def run_fn(db, instance_path, job, cancel):
+      # Another worker takes the job
+      db.execute("UPDATE job SET worker = 'other' WHERE id = ?",
+                 (job['id'],))
+      cancel.wait(10)
+      lost.append(cancel.lease_lost.is_set())
+    heartbeat_seconds = jobs.HEARTBEAT_SECONDS
+    jobs.HEARTBEAT_SECONDS = 0
+    try:
+      # Polls, rather than wait for the lease of the other worker
+      pool = jobs.WorkerPool(self.db_path, self.dir.name, 1,
+                             idle_exit=False, kinds=[])
+      pool.add_handler('lost', run_fn, lambda instance_path, job: None)
+      id = jobs.enqueue(self.db, 'lost', 'user', self.doc_name)
+      pool.notify()
+      for i in range(0, 100):
+        if len(lost) > 0:
+          break
+        time.sleep(0.1)
+      pool.stop()
+    finally:
+      jobs.HEARTBEAT_SECONDS = heartbeat_seconds
+    self.assertEqual(lost, [ True ])
+    # The job is left to the other worker
+    job = jobs.get_job(self.db, id, 'user')
+    self.assertEqual((job['state'], job['worker']),
+                     (jobs.STATE_RUNNING, 'other'))
+
+    # An abandoned run is not charged
+    doc = document.load_document(self.doc_path)
+    run_state = doc_gen.start_docgen(self.doc_path, doc, 'a prompt')
+    run_state.cancel.set()
+    run_state.abandon.set()
+    jobs.charge_run_cost(self.db, 'user', doc, run_state, None)
+    self.assertEqual(users.token_count(self.db, 'user'), 100000)
+
+  def testAsyncRun(self):
+    doc = document.load_document(self.doc_path)
+    run_state = doc_gen.start_docgen(self.doc_path, doc, 'a prompt')
+    jobs.enqueue(self.db, jobs.KIND_DOCGEN, 'user', self.doc_name,
+                 run_state.run_id, { 'async': True })
+    pool = jobs.WorkerPool(self.db_path, self.dir.name, 1)
+    pool.notify()
+    self.wait_jobs()
+    pool.stop()
+    doc = document.load_document(self.doc_path)
+    self.assertIsNotNone(doc.get_result_item(run_state.run_id))
+    self.assertLess(users.token_count(self.db, 'user'), 100000)
+
+  def testConvertJob(self):
+    ids = []
+    for filename in [ 'groff-dejoy.pdf', 'PA_utility.docx.daf' ]:
+      path = os.path.join(os.path.dirname(__file__), 'samples/', filename)
+      with open(path, 'rb') as f:
+        upload = jobs.save_upload(self.dir.name, f)
+      ids.append(jobs.enqueue(self.db, jobs.KIND_CONVERT, 'user', filename,
+                              options={ 'upload': upload }))
+    self.assertEqual(len(jobs.get_active_jobs(self.db, 'user',
+                                              jobs.KIND_CONVERT)), 2)
+
+    # Docgen workers do not take convert jobs
+    pool = jobs.WorkerPool(self.db_path, self.dir.name, 1)
+    pool.notify()
+    pool.stop()
+    self.assertEqual(len(jobs.get_active_jobs(self.db, 'user',
+                                              jobs.KIND_CONVERT)), 2)
+
+    pool = jobs.WorkerPool(self.db_path, self.dir.name, 1,
+                           kinds=[ jobs.KIND_CONVERT ])
+    pool.notify()
+    self.wait_jobs()
+    pool.stop()
+
+    job = jobs.get_job(self.db, ids[0], 'user')
+    self.assertEqual(job['result'], 'groff-dejoy.pdf')
+    self.assertTrue(job['progress'].startswith('page '))
+    doc = document.load_document(
+      jobs.doc_file_path(self.dir.name, 'user', job['result']))
+    self.assertGreater(len(doc.get_page_counts()), 1)
+
+    job = jobs.get_job(self.db, ids[1], 'user')
+    self.assertIsNone(job['result'])
+    self.assertIsNotNone(job['error'])
+    self.assertEqual(os.listdir(jobs.upload_dir(self.dir.name)), [])
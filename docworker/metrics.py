@@ -0,0 +1,43 @@
+"""
+Process wide counters reported by the /metrics page.
+"""
+import threading
+
+_lock = threading.Lock()
+_counters = {}
+_sources = {}
+
+
+def incr(name, count=1):
+  """
+  Add count to the named counter.
+  """
+  with _lock:
+    _counters[name] = _counters.get(name, 0) + count
+
+
+def get(name):
+  with _lock:
+    return _counters.get(name, 0)
+
+
+def register_source(name, stats_fn):
+  """
+  Register a function that returns a dict of values to report
+  under the given name.
+  """
+  with _lock:
+    _sources[name] = stats_fn
+
+
+def snapshot():
+  """
+  Return a sorted list of (name, value) for all counters and sources.
+  """
+  with _lock:
+    result = dict(_counters)
+    sources = list(_sources.items())
+  for (prefix, stats_fn) in sources:
+    for (key, value) in stats_fn().items():
+      result['%s.%s' % (prefix, key)] = value
+  return sorted(result.items())
@@ -0,0 +1,323 @@
+"""
+Extract the text of PDF pages.
+
+Extraction is pure Python work that holds the GIL, so pages may be
+extracted by a pool of processes. Ranges of pages are given to the
+processes and the text is returned in page order. A document is
+limited in the number of pages and the time taken, to bound the
+work done for pathological files. The tasks of a document that runs
+out of time stop themselves, so the pool keeps serving other
+documents.
+
+Pages are read one at a time and their parsed objects released once
+the text is read, so memory does not grow with the number of pages.
+A task finds its first page by the page counts of the page tree, and
+a document keeps only a few tasks in the pool at a time.
+
+The memory of the pool processes is limited by MEMORY_LIMIT_MB. Pages
+read in the calling process, with WORKERS set to 0, have no limit.
+"""
+import collections
+import itertools
+import multiprocessing
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+import pdfplumber
+import pdfplumber.page
+from pdfminer.pdfpage import PDFPage, LITERAL_PAGE, LITERAL_PAGES
+from pdfminer.pdftypes import dict_value, list_value, resolve1
+
+# Processes that extract pages, 0 to extract in the calling thread
+WORKERS = 0
+
+# Pages given to a process at a time
+PAGES_PER_TASK = 8
+
+# Tasks of a document in the pool at a time, for each process
+TASKS_PER_WORKER = 2
+
+# Seconds allowed to extract a document, 0 for no limit
+TIMEOUT = 300
+
+# Most pages extracted from a document, 0 for no limit
+MAX_PAGES = 2000
+
+# Megabytes of memory a pool process may use, 0 for no limit. Not
+# applied when WORKERS is 0.
+MEMORY_LIMIT_MB = 0
+
+# Seconds between checks that a pool was not stopped
+POLL_SECONDS = 1
+
+
+class ExtractError(Exception):
+  pass
+
+
+def iter_page_objects(pdf, first=0, last=None):
+  """
+  Yield pages first to last - 1 of an open PDF one at a time. Unlike
+  pdf.pages, the pages are not kept by the PDF.
+  """
+  page_objs = iter_pdf_pages(pdf.doc, first)
+  if last is not None:
+    page_objs = itertools.islice(page_objs, max(0, last - first))
+  for (index, page_obj) in enumerate(page_objs, first):
+    yield pdfplumber.page.Page(pdf, page_obj, page_number=index + 1)
+
+
+def iter_pdf_pages(doc, first):
+  """
+  Yield the PDFPage of each page of a document from page first, as
+  PDFPage.create_pages does. Parts of the page tree before first are
+  skipped by their Count, without reading their pages.
+  """
+  if 'Pages' in doc.catalog:
+    skip = first
+    visited = set()
+
+    def search(obj, parent):
+      nonlocal skip
+      if isinstance(obj, int):
+        (objid, attrs) = (obj, dict_value(doc.getobj(obj)).copy())
+      else:
+        (objid, attrs) = (obj.objid, dict_value(obj).copy())
+      if objid in visited:
+        return
+      visited.add(objid)
+      for (name, value) in parent.items():
+        if name in PDFPage.INHERITABLE_ATTRS and name not in attrs:
+          attrs[name] = value
+      kind = attrs.get('Type', attrs.get('type'))
+      if kind is LITERAL_PAGES and 'Kids' in attrs:
+        count = resolve1(attrs.get('Count'))
+        if isinstance(count, int) and 0 <= count <= skip:
+          skip -= count
+          return
+        for child in list_value(attrs['Kids']):
+          yield from search(child, attrs)
+      elif kind is LITERAL_PAGE:
+        if skip > 0:
+          skip -= 1
+        else:
+          yield PDFPage(doc, objid, attrs, None)
+
+    found = False
+    for page_obj in search(doc.catalog['Pages'], doc.catalog):
+      found = True
+      yield page_obj
+    if found or skip < first:
+      return
+  # No page tree, pages are found the slow way
+  yield from itertools.islice(PDFPage.create_pages(doc), first, None)
+
+
+def page_count(pdf):
+  count = 0
+  for page_obj in PDFPage.create_pages(pdf.doc):
+    count += 1
+  return count
+
+
+def extract_page(page):
+  text = page.extract_text_simple()
+  # Drop the parsed objects of the page
+  page.close()
+  return text
+
+
+class TaskTimeout(Exception):
+  pass
+
+
+def raise_timeout(signum, frame):
+  raise TaskTimeout()
+
+
+def extract_pages(path, first, last, end=None):
+  """
+  Return the text of pages first to last - 1 of a PDF file, stopping
+  at end, a time.time(), if given. Run in the pool processes.
+  """
+  if end is not None:
+    remaining = end - time.time()
+    if remaining <= 0:
+      raise ExtractError("PDF took too long to read")
+    # Stops a page that never finishes, again if the parser swallows
+    # the exception
+    signal.signal(signal.SIGALRM, raise_timeout)
+    signal.setitimer(signal.ITIMER_REAL, remaining, POLL_SECONDS)
+  try:
+    texts = []
+    with pdfplumber.open(path) as pdf:
+      for page in iter_page_objects(pdf, first, last):
+        if end is not None and time.time() >= end:
+          raise TaskTimeout()
+        texts.append(extract_page(page))
+    return texts
+  except Exception:
+    # pdfplumber may wrap the TaskTimeout
+    if end is not None and time.time() >= end:
+      raise ExtractError("PDF took too long to read")
+    raise
+  finally:
+    if end is not None:
+      signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def init_process(memory_limit_mb):
+  if memory_limit_mb > 0:
+    import resource
+    limit = memory_limit_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+  """
+  Return the process wide pool of extraction processes.
+  """
+  global _pool
+  with _pool_lock:
+    if _pool is None:
+      # Spawn to avoid forking the threads of the web server
+      context = multiprocessing.get_context('spawn')
+      _pool = context.Pool(WORKERS, initializer=init_process,
+                           initargs=(MEMORY_LIMIT_MB,),
+                           maxtasksperchild=100)
+    return _pool
+
+
+def shutdown():
+  global _pool
+  with _pool_lock:
+    pool = _pool
+    _pool = None
+  if pool is not None:
+    pool.close()
+    pool.join()
+
+
+class Deadline:
+  def __init__(self, timeout):
+    self.end = time.monotonic() + timeout if timeout > 0 else None
+
+  def remaining(self):
+    if self.end is None:
+      return None
+    return max(0.0, self.end - time.monotonic())
+
+  def wall_time(self):
+    """
+    Return the end as a time.time(), for other processes.
+    """
+    if self.end is None:
+      return None
+    return time.time() + self.remaining()
+
+  def check(self):
+    if self.end is not None and time.monotonic() > self.end:
+      raise ExtractError("PDF took too long to read")
+
+
+def check_pages(count):
+  if MAX_PAGES > 0 and count > MAX_PAGES:
+    raise ExtractError("PDF has %d pages, the limit is %d" %
+                       (count, MAX_PAGES))
+
+
+def iter_pages(file, progress=None):
+  """
+  Yield the text of each page of a PDF file in order.
+  If given, progress is called with (pages read, page count) as
+  each page is read.
+  """
+  deadline = Deadline(TIMEOUT)
+  if WORKERS <= 0:
+    pages = iter_pages_serial(file, deadline)
+  else:
+    path = getattr(file, 'name', None)
+    if isinstance(path, str) and os.path.isfile(path):
+      pages = iter_pages_pool(path, deadline)
+    else:
+      pages = iter_pages_copy(file, deadline)
+
+  # The first item is the page count
+  count = next(pages)
+  for (index, text) in enumerate(pages):
+    yield text
+    if progress is not None:
+      progress(index + 1, count)
+
+
+def iter_pages_copy(file, deadline):
+  # The processes need a file to open
+  with tempfile.NamedTemporaryFile(suffix='.pdf') as tmp_file:
+    shutil.copyfileobj(file, tmp_file)
+    tmp_file.flush()
+    yield from iter_pages_pool(tmp_file.name, deadline)
+
+
+def iter_pages_serial(file, deadline):
+  with pdfplumber.open(file) as pdf:
+    count = page_count(pdf)
+    check_pages(count)
+    yield count
+    for page in iter_page_objects(pdf):
+      deadline.check()
+      yield extract_page(page)
+
+
+def iter_pages_pool(path, deadline):
+  with pdfplumber.open(path) as pdf:
+    count = page_count(pdf)
+  check_pages(count)
+  yield count
+
+  pool = get_pool()
+  end = deadline.wall_time()
+  # Queue a few tasks at a time, so other documents are not held up
+  # behind all the pages of a long one
+  starts = iter(range(0, count, PAGES_PER_TASK))
+  results = collections.deque()
+  while True:
+    while len(results) < max(1, WORKERS * TASKS_PER_WORKER):
+      first = next(starts, None)
+      if first is None:
+        break
+      results.append(pool.apply_async(
+        extract_pages,
+        (path, first, min(count, first + PAGES_PER_TASK), end)))
+    if len(results) == 0:
+      break
+    for text in wait_result(pool, results.popleft(), deadline):
+      yield text
+
+
+def wait_result(pool, result, deadline):
+  while True:
+    remaining = deadline.remaining()
+    wait = POLL_SECONDS if remaining is None else min(POLL_SECONDS,
+                                                      remaining)
+    try:
+      return result.get(wait)
+    except multiprocessing.TimeoutError:
+      pass
+    except MemoryError:
+      raise ExtractError("PDF needs too much memory to read")
+    if remaining is not None and remaining <= 0:
+      # The tasks of the document stop at the same deadline
+      raise ExtractError("PDF took too long to read")
+    if get_pool_if_running() is not pool:
+      raise ExtractError("PDF reading was stopped")
+
+
+def get_pool_if_running():
+  with _pool_lock:
+    return _pool
@@ -0,0 +1,106 @@
+from . import pdf_extract
+import io
+import pdfplumber
+import os
+import time
+import unittest
+import unittest.mock
+
+
+PDF_PATH = os.path.join(os.path.dirname(__file__), 'samples',
+                        'groff-dejoy.pdf')
+
+
+class PdfExtractTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.settings = (pdf_extract.WORKERS, pdf_extract.PAGES_PER_TASK,
+                     pdf_extract.TIMEOUT, pdf_extract.MAX_PAGES)
+
+  def tearDown(self):
+    pdf_extract.shutdown()
+    (pdf_extract.WORKERS, pdf_extract.PAGES_PER_TASK,
+     pdf_extract.TIMEOUT, pdf_extract.MAX_PAGES) = self.settings
+
+  def read_pages(self):
+    with open(PDF_PATH, 'rb') as f:
+      return list(pdf_extract.iter_pages(f))
+
+  def testPool(self):
+    pdf_extract.WORKERS = 0
+    expected = self.read_pages()
+    self.assertGreater(len(expected), 2)
+
+    pdf_extract.WORKERS = 2
+    pdf_extract.PAGES_PER_TASK = 2
+    self.assertEqual(self.read_pages(), expected)
+
+    # A file without a name is copied for the processes
+    with open(PDF_PATH, 'rb') as f:
+      data = io.BytesIO(f.read())
+    self.assertEqual(list(pdf_extract.iter_pages(data)), expected)
+
+  def testMaxPages(self):
+    pdf_extract.MAX_PAGES = 2
+    for workers in [ 0, 2 ]:
+      pdf_extract.WORKERS = workers
+      with self.assertRaises(pdf_extract.ExtractError):
+        self.read_pages()
+
+  def testTimeout(self):
+    pdf_extract.TIMEOUT = 0.001
+    for workers in [ 0, 2 ]:
+      pdf_extract.WORKERS = workers
+      with self.assertRaises(pdf_extract.ExtractError):
+        self.read_pages()
+    # A task stops within a page
+    with self.assertRaises(pdf_extract.ExtractError):
+      pdf_extract.extract_pages(PDF_PATH, 0, None, time.time() + 0.01)
+    # Other documents are still read by the pool
+    pool = pdf_extract.get_pool_if_running()
+    self.assertIsNotNone(pool)
+    pdf_extract.TIMEOUT = 300
+    self.assertGreater(len(self.read_pages()), 2)
+    self.assertIs(pdf_extract.get_pool_if_running(), pool)
+
+  def testStreamPages(self):
+    with pdfplumber.open(PDF_PATH) as pdf:
+      expected = [ page.extract_text_simple() for page in pdf.pages ]
+    with pdfplumber.open(PDF_PATH) as pdf:
+      self.assertEqual(pdf_extract.page_count(pdf), len(expected))
+      texts = [ pdf_extract.extract_page(page)
+                for page in pdf_extract.iter_page_objects(pdf, 1, 3) ]
+    self.assertEqual(texts, expected[1:3])
+
+  def testSkipPages(self):
+    # Pages before the first are not built
+    built = []
+    class CountedPage(pdf_extract.PDFPage):
+      def __init__(self, *args):
+        built.append(args[1])
+        super().__init__(*args)
+    with pdfplumber.open(PDF_PATH) as pdf:
+      expected = [ page.extract_text_simple() for page in pdf.pages[20:23] ]
+    with unittest.mock.patch.object(pdf_extract, 'PDFPage', CountedPage):
+      with pdfplumber.open(PDF_PATH) as pdf:
+        texts = [ pdf_extract.extract_page(page)
+                  for page in pdf_extract.iter_page_objects(pdf, 20, 23) ]
+    self.assertEqual(texts, expected)
+    self.assertEqual(len(built), 3)
+
+  def testTaskWindow(self):
+    pdf_extract.WORKERS = 1
+    pdf_extract.PAGES_PER_TASK = 1
+    pool = pdf_extract.get_pool()
+    queued = []
+    apply_async = pool.apply_async
+    def record_task(fn, args):
+      queued.append(args[1])
+      return apply_async(fn, args)
+    with unittest.mock.patch.object(pool, 'apply_async', record_task):
+      pages = pdf_extract.iter_pages_pool(PDF_PATH, pdf_extract.Deadline(300))
+      count = next(pages)
+      next(pages)
+      self.assertEqual(queued, [ 0, 1 ])
+      self.assertEqual(len(list(pages)), count - 1)
+    self.assertEqual(queued, list(range(count)))
@@ -0,0 +1,125 @@
+"""
+Scheduler to keep AI requests within the requests per minute and
+tokens per minute limits of a model.
+
+Each request reserves its estimated tokens before it is sent. When
+the budget is used up, callers wait in the order they arrived
+instead of failing with rate limit errors.
+"""
+import threading
+import time
+import asyncio
+
+# Requests per minute and tokens per minute for each model
+MODEL_LIMITS = {
+  'gpt-3.5-turbo': (3500, 90000),
+  'gpt-3.5-turbo-16k': (3500, 180000),
+  'gpt-4': (200, 40000),
+}
+
+# Portion of a minute of budget that may be used in a burst
+BURST_FRACTION = 0.25
+
+
+class TokenBucket:
+  """
+  Bucket that refills at rate per second up to capacity.
+  The level may go negative, callers wait for it to refill.
+  """
+  def __init__(self, per_minute, now):
+    self.rate = per_minute / 60.0
+    self.capacity = max(1.0, per_minute * BURST_FRACTION)
+    self.level = self.capacity
+    self.last = now
+
+  def refill(self, now):
+    self.level = min(self.capacity,
+                     self.level + (now - self.last) * self.rate)
+    self.last = now
+
+  def take(self, count):
+    """
+    Remove count from the bucket and return the seconds until
+    the level is no longer negative.
+    """
+    self.level -= count
+    if self.level >= 0:
+      return 0.0
+    return -self.level / self.rate
+
+  def give(self, count):
+    self.level = min(self.capacity, self.level + count)
+
+
+class RateLimiter:
+  """
+  Process wide scheduler for requests and tokens per minute.
+  """
+  def __init__(self, requests_per_minute, tokens_per_minute,
+               clock=time.monotonic):
+    self.clock = clock
+    self.lock = threading.Lock()
+    now = self.clock()
+    self.requests = TokenBucket(requests_per_minute, now)
+    self.tokens = TokenBucket(tokens_per_minute, now)
+    self.request_count = 0
+    self.wait_count = 0
+    self.wait_seconds = 0.0
+
+  def reserve(self, token_count):
+    """
+    Reserve budget for a request and return the number of seconds
+    the caller must wait before sending it.
+    """
+    with self.lock:
+      now = self.clock()
+      self.requests.refill(now)
+      self.tokens.refill(now)
+      delay = max(self.requests.take(1), self.tokens.take(token_count))
+      self.request_count += 1
+      if delay > 0:
+        self.wait_count += 1
+        self.wait_seconds += delay
+      return delay
+
+  def acquire(self, token_count):
+    """
+    Wait until a request of token_count may be sent.
+    """
+    delay = self.reserve(token_count)
+    if delay > 0:
+      time.sleep(delay)
+
+  async def acquire_async(self, token_count):
+    delay = self.reserve(token_count)
+    if delay > 0:
+      await asyncio.sleep(delay)
+
+  def adjust(self, reserved, used):
+    """
+    Return the unused portion of a reservation once the actual
+    token count of a request is known.
+    """
+    with self.lock:
+      self.tokens.refill(self.clock())
+      self.tokens.give(reserved - used)
+
+  def stats(self):
+    with self.lock:
+      return { 'requests': self.request_count,
+               'waits': self.wait_count,
+               'wait_seconds': round(self.wait_seconds, 3) }
+
+
+def limiter_for_model(model, requests_per_minute=None,
+                      tokens_per_minute=None):
+  """
+  Create a RateLimiter using the known limits for the model,
+  unless given.
+  """
+  (rpm, tpm) = MODEL_LIMITS.get(model, MODEL_LIMITS['gpt-3.5-turbo'])
+  if requests_per_minute is not None:
+    rpm = requests_per_minute
+  if tokens_per_minute is not None:
+    tpm = tokens_per_minute
+  return RateLimiter(rpm, tpm)
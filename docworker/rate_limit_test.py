@@ -0,0 +1,55 @@
+from . import rate_limit
+import unittest
+
+
+class FakeClock:
+  def __init__(self):
+    self.now = 100.0
+
+  def __call__(self):
+    return self.now
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    # 60 requests and 6000 tokens a minute
+    self.limiter = rate_limit.RateLimiter(60, 6000, clock=self.clock)
+
+  def testBurst(self):
+    # Burst capacity is 1500 tokens
+    self.assertEqual(self.limiter.reserve(1000), 0)
+    self.assertEqual(self.limiter.reserve(500), 0)
+    # Next request waits for 1000 tokens at 100 a second
+    self.assertAlmostEqual(self.limiter.reserve(1000), 10.0)
+    # Later callers queue behind
+    self.assertAlmostEqual(self.limiter.reserve(100), 11.0)
+    self.assertEqual(self.limiter.stats()['waits'], 2)
+
+  def testRefill(self):
+    self.assertEqual(self.limiter.reserve(1500), 0)
+    self.clock.now += 5
+    self.assertEqual(self.limiter.reserve(500), 0)
+    self.clock.now += 60
+    # Refill is limited to the burst capacity
+    self.assertAlmostEqual(self.limiter.reserve(2500), 10.0)
+
+  def testRequestLimit(self):
+    # 15 request burst at one a second
+    for i in range(0, 15):
+      self.assertEqual(self.limiter.reserve(1), 0)
+    self.assertAlmostEqual(self.limiter.reserve(1), 1.0)
+
+  def testAdjust(self):
+    self.assertEqual(self.limiter.reserve(1500), 0)
+    # Only 500 tokens were used
+    self.limiter.adjust(1500, 500)
+    self.assertEqual(self.limiter.reserve(1000), 0)
+    self.assertGreater(self.limiter.reserve(100), 0)
+
+  def testModelLimits(self):
+    limiter = rate_limit.limiter_for_model('gpt-3.5-turbo')
+    self.assertEqual(limiter.tokens.rate, 1500)
+    limiter = rate_limit.limiter_for_model('unknown', 60, 600)
+    self.assertEqual(limiter.tokens.rate, 10)
@@ -0,0 +1,242 @@
+"""
+Policy for retrying failed AI completion requests.
+
+Errors are classified to decide if a request is tried again and how
+long to wait. Waits honor the Retry-After header of a response and
+use decorrelated jitter so concurrent runs do not retry in lockstep.
+
+A circuit breaker shared by all runs stops requests when the
+service appears to be down, so waiting runs make one probe request
+instead of each working through their retries.
+"""
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+import openai
+
+
+# Error classes
+ERROR_RATE_LIMIT = 'rate_limit'
+ERROR_TIMEOUT = 'timeout'
+ERROR_SERVER = 'server'
+ERROR_CONNECTION = 'connection'
+ERROR_FATAL = 'fatal'
+
+# Errors that indicate the service is not available
+OUTAGE_ERRORS = ( ERROR_TIMEOUT, ERROR_SERVER, ERROR_CONNECTION )
+
+
+def classify_error(err):
+  """
+  Return the error class for an exception raised by a completion call.
+  """
+  if isinstance(err, openai.error.RateLimitError):
+    return ERROR_RATE_LIMIT
+  if isinstance(err, (openai.error.Timeout, asyncio.TimeoutError,
+                      TimeoutError)):
+    return ERROR_TIMEOUT
+  if isinstance(err, (openai.error.APIConnectionError, ConnectionError)):
+    return ERROR_CONNECTION
+  if isinstance(err, (openai.error.ServiceUnavailableError,
+                      openai.error.TryAgain)):
+    return ERROR_SERVER
+  if isinstance(err, (openai.error.InvalidRequestError,
+                      openai.error.AuthenticationError,
+                      openai.error.PermissionError)):
+    return ERROR_FATAL
+  status = getattr(err, 'http_status', None)
+  if status == 429:
+    return ERROR_RATE_LIMIT
+  if status is not None and status < 500:
+    return ERROR_FATAL
+  return ERROR_SERVER
+
+
+def retry_after(err):
+  """
+  Return the seconds to wait given by the response headers of an
+  error, None if there is no such header.
+  """
+  headers = getattr(err, 'headers', None) or {}
+  values = {}
+  for (name, value) in headers.items():
+    values[name.lower()] = value
+  try:
+    if 'retry-after-ms' in values:
+      return max(0.0, float(values['retry-after-ms']) / 1000)
+    if 'retry-after' in values:
+      value = values['retry-after']
+      try:
+        return max(0.0, float(value))
+      except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time())
+  except (TypeError, ValueError):
+    logging.warning("bad retry-after header: %s", values)
+  return None
+
+
+class RetryPolicy:
+  """
+  Decides if and when a failed completion is tried again.
+  Replace doc_gen.RETRY_POLICY with a subclass to change the policy.
+  """
+  def __init__(self, max_try=5, base_wait=5, max_wait=120,
+               timeout_growth=1.5, max_timeout=300, rng=None):
+    self.max_try = max_try
+    self.base_wait = base_wait
+    self.max_wait = max_wait
+    self.timeout_growth = timeout_growth
+    self.max_timeout = max_timeout
+    self.rng = rng or random.Random()
+
+  def classify(self, err):
+    return classify_error(err)
+
+  def should_retry(self, kind, count):
+    """
+    Return True if a request that failed count times with an error
+    of the given class is tried again.
+    """
+    return kind != ERROR_FATAL and count < self.max_try
+
+  def next_wait(self, kind, prev_wait, err=None):
+    """
+    Return the seconds to wait before the next try. Uses decorrelated
+    jitter based on the previous wait, and at least the time given
+    by a Retry-After header.
+    """
+    wait = min(self.max_wait,
+               self.rng.uniform(self.base_wait,
+                                max(self.base_wait, prev_wait * 3)))
+    after = retry_after(err) if err is not None else None
+    if after is not None:
+      # Spread out callers told to come back at the same time
+      wait = max(after * self.rng.uniform(1.0, 1.2),
+                 min(wait, after + self.base_wait))
+    return wait
+
+  def request_timeout(self, base_timeout, timeouts):
+    """
+    Return the timeout for a request after the given number of
+    timed out tries.
+    """
+    return min(self.max_timeout,
+               base_timeout * (self.timeout_growth ** timeouts))
+
+
+class CircuitBreaker:
+  """
+  Tracks service failures across all runs. After failure_threshold
+  outage errors in a row the circuit opens and requests wait. After
+  reset_seconds one request is allowed through as a probe; success
+  closes the circuit and failure opens it again.
+  """
+  CLOSED = 'closed'
+  OPEN = 'open'
+  HALF_OPEN = 'half_open'
+
+  def __init__(self, failure_threshold=5, reset_seconds=30,
+               clock=time.monotonic):
+    self.failure_threshold = failure_threshold
+    self.reset_seconds = reset_seconds
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.state = self.CLOSED
+    self.failures = 0
+    self.opened_at = 0
+    self.probe_out = False
+    self.trips = 0
+    self.waits = 0
+    self.wait_seconds = 0.0
+
+  def reserve(self):
+    """
+    Return 0 if a request may be made now, otherwise the seconds
+    to wait before asking again.
+    """
+    with self.lock:
+      if self.state == self.CLOSED:
+        return 0
+      now = self.clock()
+      if self.state == self.OPEN:
+        remaining = self.opened_at + self.reset_seconds - now
+        if remaining > 0:
+          return remaining
+        self.state = self.HALF_OPEN
+        self.probe_out = False
+      if not self.probe_out:
+        # Let one request through to test the service
+        self.probe_out = True
+        return 0
+      return min(self.reset_seconds, 1.0)
+
+  def wait(self):
+    """
+    Block until a request may be made. Returns the seconds waited.
+    """
+    waited = 0.0
+    delay = self.reserve()
+    while delay > 0:
+      self.note_wait(delay)
+      time.sleep(delay)
+      waited += delay
+      delay = self.reserve()
+    return waited
+
+  async def wait_async(self):
+    waited = 0.0
+    delay = self.reserve()
+    while delay > 0:
+      self.note_wait(delay)
+      await asyncio.sleep(delay)
+      waited += delay
+      delay = self.reserve()
+    return waited
+
+  def note_wait(self, delay):
+    with self.lock:
+      self.waits += 1
+      self.wait_seconds += delay
+
+  def record_success(self):
+    with self.lock:
+      if self.state != self.CLOSED:
+        logging.info("circuit closed")
+      self.state = self.CLOSED
+      self.failures = 0
+      self.probe_out = False
+
+  def record_failure(self, kind):
+    """
+    Note a failed request. Only errors that indicate an outage
+    count toward opening the circuit.
+    """
+    with self.lock:
+      if kind not in OUTAGE_ERRORS:
+        # The service answered
+        if self.state == self.HALF_OPEN:
+          self.state = self.CLOSED
+        self.failures = 0
+        self.probe_out = False
+        return
+      self.failures += 1
+      if (self.state == self.HALF_OPEN or
+          (self.state == self.CLOSED and
+           self.failures >= self.failure_threshold)):
+        logging.warning("circuit open after %d failures", self.failures)
+        self.state = self.OPEN
+        self.opened_at = self.clock()
+        self.probe_out = False
+        self.trips += 1
+
+  def stats(self):
+    with self.lock:
+      return { 'state': self.state,
+               'failures': self.failures,
+               'trips': self.trips,
+               'waits': self.waits,
+               'wait_seconds': round(self.wait_seconds, 3) }
@@ -0,0 +1,121 @@
+from . import retry_policy
+import unittest
+import random
+import openai
+
+
+class FakeClock:
+  def __init__(self):
+    self.now = 100.0
+
+  def __call__(self):
+    return self.now
+
+
+class ClassifyTestCase(unittest.TestCase):
+
+  def testClasses(self):
+    self.assertEqual(retry_policy.classify_error(
+      openai.error.RateLimitError("slow down")),
+                     retry_policy.ERROR_RATE_LIMIT)
+    self.assertEqual(retry_policy.classify_error(
+      openai.error.Timeout("timed out")), retry_policy.ERROR_TIMEOUT)
+    self.assertEqual(retry_policy.classify_error(
+      openai.error.APIConnectionError("refused")),
+                     retry_policy.ERROR_CONNECTION)
+    self.assertEqual(retry_policy.classify_error(
+      openai.error.InvalidRequestError("too long", None)),
+                     retry_policy.ERROR_FATAL)
+    self.assertEqual(retry_policy.classify_error(
+      openai.error.APIError("bad gateway", http_status=502)),
+                     retry_policy.ERROR_SERVER)
+    self.assertEqual(retry_policy.classify_error(
+      openai.error.APIError("bad request", http_status=400)),
+                     retry_policy.ERROR_FATAL)
+
+  def testRetryAfter(self):
+    err = openai.error.RateLimitError("slow down",
+                                      headers={ 'Retry-After': '7' })
+    self.assertEqual(retry_policy.retry_after(err), 7.0)
+    err = openai.error.RateLimitError("slow down",
+                                      headers={ 'retry-after-ms': '250' })
+    self.assertEqual(retry_policy.retry_after(err), 0.25)
+    err = openai.error.RateLimitError("slow down")
+    self.assertIsNone(retry_policy.retry_after(err))
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.policy = retry_policy.RetryPolicy(max_try=3, base_wait=5,
+                                           max_wait=60,
+                                           rng=random.Random(1))
+
+  def testShouldRetry(self):
+    self.assertTrue(self.policy.should_retry(retry_policy.ERROR_SERVER, 1))
+    self.assertFalse(self.policy.should_retry(retry_policy.ERROR_SERVER, 3))
+    self.assertFalse(self.policy.should_retry(retry_policy.ERROR_FATAL, 1))
+
+  def testJitter(self):
+    wait = 0
+    waits = []
+    for i in range(0, 20):
+      wait = self.policy.next_wait(retry_policy.ERROR_SERVER, wait)
+      self.assertGreaterEqual(wait, 5)
+      self.assertLessEqual(wait, 60)
+      waits.append(wait)
+    # Waits are spread out
+    self.assertGreater(len(set(waits)), 10)
+
+  def testHonorRetryAfter(self):
+    err = openai.error.RateLimitError("slow down",
+                                      headers={ 'retry-after': '30' })
+    for i in range(0, 10):
+      wait = self.policy.next_wait(retry_policy.ERROR_RATE_LIMIT, 0, err)
+      self.assertGreaterEqual(wait, 30)
+      self.assertLessEqual(wait, 36)
+
+  def testTimeout(self):
+    self.assertEqual(self.policy.request_timeout(60, 0), 60)
+    self.assertEqual(self.policy.request_timeout(60, 2), 135)
+    self.assertEqual(self.policy.request_timeout(60, 10), 300)
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = FakeClock()
+    self.breaker = retry_policy.CircuitBreaker(3, 30, clock=self.clock)
+
+  def testTrip(self):
+    self.breaker.record_failure(retry_policy.ERROR_SERVER)
+    self.breaker.record_failure(retry_policy.ERROR_TIMEOUT)
+    self.assertEqual(self.breaker.reserve(), 0)
+    # Rate limits mean the service is up
+    self.breaker.record_failure(retry_policy.ERROR_RATE_LIMIT)
+    self.breaker.record_failure(retry_policy.ERROR_SERVER)
+    self.assertEqual(self.breaker.reserve(), 0)
+
+    self.breaker.record_failure(retry_policy.ERROR_SERVER)
+    self.breaker.record_failure(retry_policy.ERROR_CONNECTION)
+    self.assertAlmostEqual(self.breaker.reserve(), 30)
+    self.assertEqual(self.breaker.stats()['trips'], 1)
+
+  def testProbe(self):
+    for i in range(0, 3):
+      self.breaker.record_failure(retry_policy.ERROR_SERVER)
+    self.clock.now += 31
+    # One probe is allowed, others wait
+    self.assertEqual(self.breaker.reserve(), 0)
+    self.assertGreater(self.breaker.reserve(), 0)
+
+    # Failed probe opens the circuit again
+    self.breaker.record_failure(retry_policy.ERROR_SERVER)
+    self.assertAlmostEqual(self.breaker.reserve(), 30)
+
+    self.clock.now += 31
+    self.assertEqual(self.breaker.reserve(), 0)
+    self.breaker.record_success()
+    self.assertEqual(self.breaker.reserve(), 0)
+    self.assertEqual(self.breaker.reserve(), 0)
+    self.assertEqual(self.breaker.stats()['state'], 'closed')
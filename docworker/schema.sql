@@ -1,4 +1,5 @@
 DROP TABLE IF EXISTS user;
+DROP TABLE IF EXISTS job;
 
 CREATE TABLE user (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -12,4 +13,23 @@ CREATE TABLE user (
   last_email INTEGER DEFAULT 0  
 );
 
-  
+CREATE TABLE job (
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  kind TEXT NOT NULL,
+  username TEXT NOT NULL,
+  doc_name TEXT NOT NULL,
+  run_id INTEGER,
+  options TEXT,
+  state TEXT NOT NULL,
+  worker TEXT,
+  lease_expires REAL DEFAULT 0,
+  attempts INTEGER DEFAULT 0,
+  created REAL,
+  updated REAL,
+  progress TEXT,
+  result TEXT,
+  error TEXT
+);
+
+CREATE INDEX job_state ON job (state, kind);
+CREATE INDEX job_doc ON job (username, doc_name);
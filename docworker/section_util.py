@@ -8,8 +8,8 @@ TODO:
 """
 
 import re
-import tiktoken
 import logging
+from . import tokenizers
 
 TEXT_EMBEDDING_CHUNK_SIZE = 3000
 MAX_TEXT_LINE_LEN = TEXT_EMBEDDING_CHUNK_SIZE / 2
@@ -22,11 +22,10 @@ def chunks_from_structured_file(file):
   """
   top_section = parse_sections(file)
   #walk_section(top_section)  
-  tokenizer = tiktoken.encoding_for_model(AI_MODEL)
-  return chunks(top_section, tokenizer)
+  return chunks(top_section, get_tokenizer())
 
 def get_tokenizer():
-  return tiktoken.encoding_for_model(AI_MODEL)
+  return tokenizers.get_tokenizer(AI_MODEL)
 
 class Chunk:
   """
@@ -0,0 +1,172 @@
+"""
+Process wide registry of tokenizers.
+
+Loading a tokenizer is slow, so one instance per model is shared by
+all threads. Token counts of text are kept in a bounded LRU keyed by
+a hash of the text, so counting the same segment again is free.
+
+Encodes are counted for the whole process and for the current scope.
+A web request or a doc gen run sets an EncodeCounter as the scope
+with counting(); work done for it in other threads or tasks is
+counted when run in a copy of the caller's context.
+"""
+import collections
+import contextlib
+import contextvars
+import hashlib
+import logging
+import threading
+import tiktoken
+
+# Number of token counts kept, 0 to disable
+COUNT_CACHE_SIZE = 10000
+
+_lock = threading.Lock()
+_tokenizers = {}
+_count_cache = collections.OrderedDict()
+_stats = { 'encodes': 0, 'encoded_chars': 0,
+           'count_hits': 0, 'count_misses': 0 }
+_scope = contextvars.ContextVar('tokenizer_scope', default=None)
+
+
+class EncodeCounter:
+  """
+  Count of encodes done for a request or run. Threads running in
+  copies of the same context share the counter.
+  """
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.encodes = 0
+    self.encoded_chars = 0
+    self.count_hits = 0
+
+  def add_encode(self, chars):
+    with self.lock:
+      self.encodes += 1
+      self.encoded_chars += chars
+
+  def add_hit(self):
+    with self.lock:
+      self.count_hits += 1
+
+  def stats(self):
+    with self.lock:
+      return { 'encodes': self.encodes,
+               'encoded_chars': self.encoded_chars,
+               'count_hits': self.count_hits }
+
+
+def start_counting(counter):
+  """
+  Count encodes done in the current context with the given counter.
+  Returns a token for stop_counting.
+  """
+  return _scope.set(counter)
+
+
+def stop_counting(token):
+  _scope.reset(token)
+
+
+@contextlib.contextmanager
+def counting(counter):
+  token = start_counting(counter)
+  try:
+    yield counter
+  finally:
+    stop_counting(token)
+
+
+def note_encode(text):
+  chars = len(text)
+  with _lock:
+    _stats['encodes'] += 1
+    _stats['encoded_chars'] += chars
+  counter = _scope.get()
+  if counter is not None:
+    counter.add_encode(chars)
+
+
+class Tokenizer:
+  """
+  Shared tokenizer for a model. Wraps a tiktoken encoding and
+  counts encodes.
+  """
+  def __init__(self, model, encoding):
+    self.model = model
+    self.encoding = encoding
+
+  def encode(self, text):
+    note_encode(text)
+    return self.encoding.encode(text)
+
+  def decode(self, tokens):
+    return self.encoding.decode(tokens)
+
+  def decode_single_token_bytes(self, token):
+    return self.encoding.decode_single_token_bytes(token)
+
+  def count(self, text, cache=True):
+    """
+    Return the number of tokens in text. Set cache to False for text
+    that is not likely to be counted again.
+    """
+    if not cache or COUNT_CACHE_SIZE <= 0:
+      return len(self.encode(text))
+    key = (self.model,
+           hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest())
+    with _lock:
+      count = _count_cache.get(key)
+      if count is not None:
+        _count_cache.move_to_end(key)
+        _stats['count_hits'] += 1
+    if count is not None:
+      counter = _scope.get()
+      if counter is not None:
+        counter.add_hit()
+      return count
+
+    count = len(self.encode(text))
+    with _lock:
+      _stats['count_misses'] += 1
+      _count_cache[key] = count
+      while len(_count_cache) > COUNT_CACHE_SIZE:
+        _count_cache.popitem(last=False)
+    return count
+
+
+def get_tokenizer(model):
+  """
+  Return the shared tokenizer for a model, loading it on first use.
+  """
+  with _lock:
+    tokenizer = _tokenizers.get(model)
+    if tokenizer is None:
+      logging.info("load tokenizer for %s", model)
+      tokenizer = Tokenizer(model, tiktoken.encoding_for_model(model))
+      _tokenizers[model] = tokenizer
+    return tokenizer
+
+
+def warm(models):
+  """
+  Load the tokenizers for the given models.
+  """
+  for model in models:
+    get_tokenizer(model)
+
+
+def set_cache_size(size):
+  global COUNT_CACHE_SIZE
+  with _lock:
+    COUNT_CACHE_SIZE = size
+    while len(_count_cache) > max(0, size):
+      _count_cache.popitem(last=False)
+
+
+def stats():
+  with _lock:
+    result = dict(_stats)
+    result['cached_counts'] = len(_count_cache)
+    result['models'] = len(_tokenizers)
+  return result
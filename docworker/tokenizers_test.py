@@ -0,0 +1,84 @@
+from . import tokenizers
+from . import section_util
+import concurrent.futures
+import contextvars
+import unittest
+
+
+class TokenizerTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.cache_size = tokenizers.COUNT_CACHE_SIZE
+    tokenizers.set_cache_size(0)
+    tokenizers.set_cache_size(10)
+
+  def tearDown(self):
+    tokenizers.set_cache_size(self.cache_size)
+
+  def testShared(self):
+    tokenizer = tokenizers.get_tokenizer(section_util.AI_MODEL)
+    self.assertIs(tokenizer, section_util.get_tokenizer())
+    self.assertEqual(tokenizer.decode(tokenizer.encode("Some text")),
+                     "Some text")
+
+  def testCountCache(self):
+    tokenizer = section_util.get_tokenizer()
+    counter = tokenizers.EncodeCounter()
+    with tokenizers.counting(counter):
+      count = tokenizer.count("Four score and seven years ago")
+      self.assertEqual(tokenizer.count("Four score and seven years ago"),
+                       count)
+      tokenizer.count("Four score and seven years ago", cache=False)
+    self.assertEqual(count,
+                     len(tokenizer.encode("Four score and seven years ago")))
+    self.assertEqual(counter.encodes, 2)
+    self.assertEqual(counter.count_hits, 1)
+
+    # Oldest counts are dropped
+    for i in range(0, 20):
+      tokenizer.count("text %d" % i)
+    self.assertEqual(tokenizers.stats()['cached_counts'], 10)
+    with tokenizers.counting(counter):
+      tokenizer.count("text 19")
+      tokenizer.count("text 0")
+    self.assertEqual(counter.count_hits, 2)
+    self.assertEqual(counter.encodes, 3)
+
+  def testCountScope(self):
+    tokenizer = section_util.get_tokenizer()
+    outer = tokenizers.EncodeCounter()
+    inner = tokenizers.EncodeCounter()
+    with tokenizers.counting(outer):
+      tokenizer.encode("one")
+      with tokenizers.counting(inner):
+        tokenizer.encode("two")
+        # Work in other threads is counted when run in the context
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as pool:
+          pool.submit(contextvars.copy_context().run,
+                      tokenizer.encode, "three").result()
+          pool.submit(tokenizer.encode, "four").result()
+      tokenizer.encode("five")
+    self.assertEqual(outer.encodes, 2)
+    self.assertEqual(inner.encodes, 2)
+    self.assertEqual(inner.encoded_chars, len("two") + len("three"))
+
+
+  def testSharedCounter(self):
+    # Threads of a pool count into the same counter
+    tokenizer = section_util.get_tokenizer()
+    counter = tokenizers.EncodeCounter()
+
+    def encode_all():
+      for i in range(0, 200):
+        tokenizer.encode("word")
+        tokenizer.count("word")
+
+    with tokenizers.counting(counter):
+      with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        futures = [ pool.submit(contextvars.copy_context().run, encode_all)
+                    for i in range(0, 8) ]
+        for future in futures:
+          future.result()
+    stats = counter.stats()
+    self.assertEqual(stats['encodes'] + stats['count_hits'], 8 * 200 * 2)
+    self.assertEqual(stats['encoded_chars'], stats['encodes'] * len("word"))
@@ -5,6 +5,8 @@ import shutil
 import pkg_resources
 import datetime
 import docworker
+from . import document
+from . import extract_store
 import uuid
 import logging
 
@@ -167,6 +169,11 @@ def delete_user(db, name, storage_dir):
   else:
     user_dir = None
 
+  # Release the shared text of the user's documents
+  store = extract_store.reader()
+  if store is not None and name:
+    store.release_user(name)
+
   if user_dir is not None and os.path.exists(user_dir):
     for filename in os.listdir(user_dir):
       os.remove(os.path.join(user_dir, filename))
@@ -189,6 +196,10 @@ def populate_samples(user_dir):
     if filename.endswith(".daf"):
       shutil.copyfile(os.path.join(samples_dir, filename),
                       os.path.join(user_dir, filename))
+      if extract_store.STORE is not None:
+        # Share one copy of the sample text among users
+        document.store_doc_text(os.path.join(user_dir, filename),
+                                os.path.basename(os.path.normpath(user_dir)))
   print("done")
   
 
@@ -1,4 +1,6 @@
 from . import users
+from . import extract_store
+from . import document
 import unittest
 import sqlite3
 import tempfile
@@ -78,4 +80,30 @@ class UsersDBTestCase(unittest.TestCase):
     users.delete_user(self.db, name, self.storage_dir.name)
     self.assertEqual(users.count_users(self.db), 0)
 
+  def testSharedSamples(self):
+    store_dir = tempfile.TemporaryDirectory()
+    extract_store.STORE = extract_store.ExtractStore(store_dir.name)
+    try:
+      for name in [ USER_NAME, USER_NAME_2 ]:
+        users.add_or_update_user(self.db, name, 100)
+        users.check_initialized_user(self.db, self.storage_dir.name, name)
+      stats = extract_store.STORE.stats()
+      self.assertGreater(stats['entries'], 0)
+      self.assertEqual(stats['refs'], 2 * stats['entries'])
+      user_dir = os.path.join(self.storage_dir.name, USER_NAME)
+      for info in document.list_documents(user_dir):
+        doc = document.load_document(os.path.join(user_dir,
+                                                  info.name + '.daf'))
+        self.assertIsNone(doc.doc_text)
+        self.assertGreater(len(doc.get_doc_text()), 0)
 
+      # Text is removed with the last user that refers to it
+      users.delete_user(self.db, USER_NAME, self.storage_dir.name)
+      self.assertEqual(extract_store.STORE.stats()['refs'],
+                       stats['entries'])
+      users.delete_user(self.db, USER_NAME_2, self.storage_dir.name)
+      self.assertEqual(extract_store.STORE.stats()['entries'], 0)
+    finally:
+      extract_store.STORE.close()
+      extract_store.STORE = None
+      store_dir.cleanup()
@@ -0,0 +1,13 @@
+
+def test_metrics(app, client, auth):
+  response = client.get('/metrics')
+  assert response.status_code == 302
+
+  auth.login('test1')
+  response = client.get('/metrics')
+  assert response.status_code == 403
+
+  app.config['METRICS_USERS'] = [ 'test1' ]
+  response = client.get('/metrics')
+  assert response.status_code == 200
+  assert b'completion_cache.hits' in response.data
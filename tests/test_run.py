@@ -1,7 +1,9 @@
 from docworker.analysis_app import get_db
 import docworker
 from docworker import analysis_app
+from docworker import users
 import time
+import json
 
 
 def test_start_run(app, client, auth, mocker):
@@ -35,3 +37,35 @@ def test_start_run(app, client, auth, mocker):
 
 
 
+
+
+def test_no_cache(app, client, auth, mocker):
+  mocker.patch('docworker.doc_gen.FAKE_AI_SLEEP', 0)
+  with app.app_context():
+    users.add_or_update_user(get_db(), 'test1', 100000)
+  auth.login('test1')
+
+  response = client.get('/?doc=PA_utility.docx')
+  assert b'name="no_cache"' in response.data
+
+  response = client.post('/',
+                         data={'run': 'run',
+                               'prompt': 'a sample prompt',
+                               'doc': 'PA_utility.docx',
+                               'no_cache': '1',
+                               }
+                         )
+  assert response.status_code == 302
+
+  with app.app_context():
+    row = get_db().execute(
+      "SELECT id, options FROM job ORDER BY id DESC LIMIT 1").fetchone()
+    assert json.loads(row['options'])['use_cache'] is False
+
+    # Let the run finish before the instance is removed
+    for i in range(50):
+      state = get_db().execute("SELECT state FROM job WHERE id = ?",
+                               (row['id'],)).fetchone()['state']
+      if state not in ('queued', 'running'):
+        break
+      time.sleep(0.2)
@@ -0,0 +1,55 @@
+import os
+import time
+
+
+def upload(client, filename):
+  path = os.path.join(os.path.dirname(__file__), '..', 'docworker',
+                      'samples', filename)
+  with open(path, 'rb') as f:
+    return client.post('/doclist',
+                       data={ 'upload': 'Upload',
+                              'file': (f, filename) },
+                       content_type='multipart/form-data')
+
+
+def wait_convert(client, location):
+  # Poll the doc list until the upload is converted
+  for i in range(0, 100):
+    response = client.get(location)
+    if response.status_code == 302:
+      return response
+    time.sleep(0.2)
+  assert False, "upload was not converted"
+
+
+def test_upload(client, auth):
+  auth.login('test1')
+
+  response = upload(client, 'groff-dejoy.pdf')
+  assert response.status_code == 302
+  assert 'job=' in response.location
+
+  response = wait_convert(client, response.location)
+  assert 'doc=groff-dejoy.pdf' in response.location
+
+  response = client.get('/doclist')
+  assert b'groff-dejoy.pdf' in response.data
+  assert b'processing' not in response.data
+
+
+def test_upload_error(client, auth):
+  auth.login('test1')
+
+  response = upload(client, 'PA_utility.docx.daf')
+  assert response.status_code == 302
+  response = wait_convert(client, response.location)
+  assert response.location.endswith('/doclist')
+  response = client.get(response.location)
+  assert b'Error loading file' in response.data
+
+
+def test_bad_job(client, auth):
+  auth.login('test1')
+
+  response = client.get('/doclist?job=abc')
+  assert response.status_code == 200